@@ -0,0 +1,202 @@
+import os
+import time
+import shutil
+import struct
+import concurrent.futures
+from backend.analysis import dicom_io
+
+# DICOM de-identification
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# Patient identifiers are rewritten at the byte level using the element offsets from dicom_io.
+# Every other element, including pixel data, is written back as the original bytes (memoryview
+# slices of the file buffer) so nothing is decoded or re-encoded and a file is one read and one
+# write. Files are written to a temporary file and renamed, so files can be de-identified in place.
+#
+# Only top level elements are rewritten. Sequences that carry patient details are removed
+# whole. UIDs are kept so series / studies still group correctly. The output is the same
+# if a file is de-identified twice, so re-running is safe.
+
+PSEUDONYM = "pseudonym"  # replaced with the pseudonym (e.g. sub_id)
+EMPTY = "empty"          # kept with an empty value (type 2 elements)
+REMOVE = "remove"
+
+PHI_TAGS = {dicom_io.tag(0x0008, 0x0050): ["AccessionNumber", EMPTY],
+            dicom_io.tag(0x0008, 0x0080): ["InstitutionName", REMOVE],
+            dicom_io.tag(0x0008, 0x0081): ["InstitutionAddress", REMOVE],
+            dicom_io.tag(0x0008, 0x0090): ["ReferringPhysicianName", EMPTY],
+            dicom_io.tag(0x0008, 0x0092): ["ReferringPhysicianAddress", REMOVE],
+            dicom_io.tag(0x0008, 0x0094): ["ReferringPhysicianTelephoneNumbers", REMOVE],
+            dicom_io.tag(0x0008, 0x1010): ["StationName", REMOVE],
+            dicom_io.tag(0x0008, 0x1040): ["InstitutionalDepartmentName", REMOVE],
+            dicom_io.tag(0x0008, 0x1048): ["PhysiciansOfRecord", REMOVE],
+            dicom_io.tag(0x0008, 0x1050): ["PerformingPhysicianName", REMOVE],
+            dicom_io.tag(0x0008, 0x1060): ["NameOfPhysiciansReadingStudy", REMOVE],
+            dicom_io.tag(0x0008, 0x1070): ["OperatorsName", REMOVE],
+            dicom_io.tag(0x0008, 0x1120): ["ReferencedPatientSequence", REMOVE],
+            dicom_io.tag(0x0010, 0x0010): ["PatientName", PSEUDONYM],
+            dicom_io.tag(0x0010, 0x0020): ["PatientID", PSEUDONYM],
+            dicom_io.tag(0x0010, 0x0030): ["PatientBirthDate", EMPTY],
+            dicom_io.tag(0x0010, 0x0032): ["PatientBirthTime", REMOVE],
+            dicom_io.tag(0x0010, 0x1000): ["OtherPatientIDs", REMOVE],
+            dicom_io.tag(0x0010, 0x1001): ["OtherPatientNames", REMOVE],
+            dicom_io.tag(0x0010, 0x1002): ["OtherPatientIDsSequence", REMOVE],
+            dicom_io.tag(0x0010, 0x1005): ["PatientBirthName", REMOVE],
+            dicom_io.tag(0x0010, 0x1040): ["PatientAddress", REMOVE],
+            dicom_io.tag(0x0010, 0x1060): ["PatientMotherBirthName", REMOVE],
+            dicom_io.tag(0x0010, 0x2154): ["PatientTelephoneNumbers", REMOVE],
+            dicom_io.tag(0x0010, 0x21B0): ["AdditionalPatientHistory", REMOVE],
+            dicom_io.tag(0x0010, 0x4000): ["PatientComments", REMOVE],
+            dicom_io.tag(0x0032, 0x1032): ["RequestingPhysician", REMOVE],
+            dicom_io.tag(0x0040, 0x0275): ["RequestAttributesSequence", REMOVE]}
+
+AUDIT_COLUMNS = ["time", "source", "destination", "status", "changed_tags"]
+
+
+class DeidentifyResult():
+    """
+    status: "deidentified" (tags were changed), "unchanged" (no identifiers found) or
+            "failed" (not an uncompressed DICOM dicom_io can read, or it could not be read / written.
+            Nothing is written to the destination, a file de-identified in place is left as is)
+    """
+    def __init__(self, source, destination, status, changed_tags, message=""):
+        self.source = source
+        self.destination = destination
+        self.status = status
+        self.changed_tags = changed_tags
+        self.message = message
+
+    def succeeded(self):
+        return self.status != "failed"
+
+    def get_audit_line(self):
+        return "\t".join([time.strftime("%Y-%m-%dT%H:%M:%S"),
+                          self.source,
+                          self.destination,
+                          self.status if not self.message else "{0}: {1}".format(self.status, self.message),
+                          ",".join(self.changed_tags)])
+
+
+def deidentify_files(jobs, pseudonym, num_workers=None, audit_filepath=None):
+    """
+    De-identify jobs (list of (source_filepath, destination_filepath), the same path to
+    de-identify in place) across a process pool of num_workers (default all cores). Each
+    file is written once to its destination. Files that cannot be de-identified are reported
+    as failed and not written, so identifiers are never copied.
+
+    If audit_filepath is given one line per file (AUDIT_COLUMNS) is appended to it.
+    Return list of DeidentifyResult in the same order as jobs.
+    """
+    if not jobs:
+        return []
+
+    num_workers = min(num_workers or os.cpu_count() or 1, len(jobs))
+    job_args = [[source, destination, pseudonym] for source, destination in jobs]
+
+    if num_workers == 1:
+        results = [_deidentify_job(args) for args in job_args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as pool:
+            results = list(pool.map(_deidentify_job, job_args,
+                                    chunksize=max(1, len(job_args) // (num_workers * 4))))
+
+    if audit_filepath:
+        write_audit(audit_filepath, results)
+
+    return results
+
+def _deidentify_job(args):
+    source, destination, pseudonym = args
+    try:
+        return deidentify_file(source, destination, pseudonym)
+    except (dicom_io.DicomReadError, struct.error, ValueError, IndexError, OSError) as error:
+        if os.path.isfile(destination + ".partial"):
+            os.remove(destination + ".partial")
+        return DeidentifyResult(source, destination, "failed", [], str(error))
+
+def deidentify_file(source, destination, pseudonym):
+    """
+    Write a de-identified copy of source to destination (may be the same file).
+    """
+    dicom_file = dicom_io.read_dicom(source)
+    parts, changed_tags = get_deidentified_parts(dicom_file, pseudonym)
+
+    in_place = os.path.abspath(source) == os.path.abspath(destination)
+    if in_place and not changed_tags:
+        return DeidentifyResult(source, destination, "unchanged", [])
+
+    partial_filepath = destination + ".partial"
+    with open(partial_filepath, "wb") as file:
+        file.writelines(parts)
+    if not in_place:
+        shutil.copystat(source, partial_filepath)
+    os.replace(partial_filepath, destination)
+
+    return DeidentifyResult(source, destination, "deidentified" if changed_tags else "unchanged", changed_tags)
+
+def get_deidentified_parts(dicom_file, pseudonym):
+    """
+    Return (list of bytes / memoryview to write, list of changed tag names). Retired group
+    length elements of changed groups are dropped as they would no longer be correct.
+    """
+    buffer = memoryview(dicom_file.buffer)
+    dataset_elements = [element for element in dicom_file.elements.values()
+                        if element.start_offset >= dicom_file.dataset_offset]
+
+    changed_tags = []
+    changed_groups = set()
+    for element in dataset_elements:
+        if element.tag in PHI_TAGS and _get_new_value(element, dicom_file, pseudonym) != \
+                dicom_file.get_bytes(element.tag):
+            changed_tags.append(PHI_TAGS[element.tag][0])
+            changed_groups.add(element.tag >> 16)
+
+    if not changed_tags:
+        return [buffer], []
+
+    parts = [buffer[:dicom_file.dataset_offset]]
+    end_offset = dicom_file.dataset_offset
+    for element in dataset_elements:
+        end_offset = element.end_offset
+
+        if (element.tag & 0xFFFF) == 0 and (element.tag >> 16) in changed_groups:
+            continue
+
+        if element.tag not in PHI_TAGS:
+            parts.append(buffer[element.start_offset:element.end_offset])
+            continue
+
+        new_value = _get_new_value(element, dicom_file, pseudonym)
+        if new_value is not None:
+            parts.append(encode_element(element.tag, element.vr, new_value, dicom_file.explicit_vr))
+
+    parts.append(buffer[end_offset:])
+    return parts, changed_tags
+
+def _get_new_value(element, dicom_file, pseudonym):
+    """
+    The new value bytes of a PHI element, or None if it is removed
+    """
+    action = PHI_TAGS[element.tag][1]
+    if action == REMOVE or element.length == dicom_io.UNDEFINED_LENGTH:
+        return None
+    if action == EMPTY:
+        return b""
+    value = pseudonym.encode("latin-1")
+    return value + b" " if len(value) % 2 else value
+
+def encode_element(tag_, vr, value, explicit_vr):
+    group_element = struct.pack("<HH", tag_ >> 16, tag_ & 0xFFFF)
+    if not explicit_vr:
+        return group_element + struct.pack("<I", len(value)) + value
+    if vr in dicom_io.LONG_LENGTH_VRS:
+        return group_element + vr.encode("latin-1") + b"\0\0" + struct.pack("<I", len(value)) + value
+    return group_element + vr.encode("latin-1") + struct.pack("<H", len(value)) + value
+
+def write_audit(audit_filepath, results):
+    write_header = not os.path.isfile(audit_filepath)
+    with open(audit_filepath, "a") as file:
+        if write_header:
+            file.write("\t".join(AUDIT_COLUMNS) + "\n")
+        for result in results:
+            file.write(result.get_audit_line() + "\n")
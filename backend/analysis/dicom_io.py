@@ -0,0 +1,319 @@
+import struct
+import collections
+
+# Minimal DICOM reader
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# Reads the elements of uncompressed little endian DICOM (explicit or implicit VR) straight
+# from the file bytes. Values are not decoded until requested and pixel data is never
+# copied or decoded, only its offset / length in the buffer are stored, so it can be
+# read with numpy.frombuffer or copied as raw bytes (see deidentify.py).
+#
+# Anything else (big endian, compressed / encapsulated pixel data) raises DicomReadError
+# so callers can fall back to a full DICOM toolkit (e.g. dcm2niix).
+
+IMPLICIT_VR_LITTLE_ENDIAN = "1.2.840.10008.1.2"
+EXPLICIT_VR_LITTLE_ENDIAN = "1.2.840.10008.1.2.1"
+UNCOMPRESSED_LITTLE_ENDIAN = [IMPLICIT_VR_LITTLE_ENDIAN, EXPLICIT_VR_LITTLE_ENDIAN]
+
+LONG_LENGTH_VRS = ["OB", "OD", "OF", "OL", "OV", "OW", "SQ", "SV", "UC", "UN", "UR", "UT", "UV"]
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+ITEM = 0xFFFEE000
+ITEM_DELIMITATION = 0xFFFEE00D
+SEQUENCE_DELIMITATION = 0xFFFEE0DD
+
+def tag(group, element):
+    return (group << 16) | element
+
+TRANSFER_SYNTAX_UID = tag(0x0002, 0x0010)
+IMAGE_TYPE = tag(0x0008, 0x0008)
+SOP_CLASS_UID = tag(0x0008, 0x0016)
+SERIES_DESCRIPTION = tag(0x0008, 0x103E)
+SLICE_THICKNESS = tag(0x0018, 0x0050)
+REPETITION_TIME = tag(0x0018, 0x0080)
+ECHO_TIME = tag(0x0018, 0x0081)
+IMAGING_FREQUENCY = tag(0x0018, 0x0084)
+ECHO_NUMBERS = tag(0x0018, 0x0086)
+SPACING_BETWEEN_SLICES = tag(0x0018, 0x0088)
+PROTOCOL_NAME = tag(0x0018, 0x1030)
+SPECTRAL_WIDTH = tag(0x0018, 0x9052)
+TRANSMITTER_FREQUENCY = tag(0x0018, 0x9098)
+SIEMENS_NUMBER_OF_IMAGES_IN_MOSAIC = tag(0x0019, 0x100A)
+SERIES_INSTANCE_UID = tag(0x0020, 0x000E)
+ACQUISITION_NUMBER = tag(0x0020, 0x0012)
+INSTANCE_NUMBER = tag(0x0020, 0x0013)
+IMAGE_POSITION_PATIENT = tag(0x0020, 0x0032)
+IMAGE_ORIENTATION_PATIENT = tag(0x0020, 0x0037)
+SAMPLES_PER_PIXEL = tag(0x0028, 0x0002)
+NUMBER_OF_FRAMES = tag(0x0028, 0x0008)
+ROWS = tag(0x0028, 0x0010)
+COLUMNS = tag(0x0028, 0x0011)
+PIXEL_SPACING = tag(0x0028, 0x0030)
+BITS_ALLOCATED = tag(0x0028, 0x0100)
+PIXEL_REPRESENTATION = tag(0x0028, 0x0103)
+RESCALE_INTERCEPT = tag(0x0028, 0x1052)
+RESCALE_SLOPE = tag(0x0028, 0x1053)
+DATA_POINT_ROWS = tag(0x0028, 0x9001)
+DATA_POINT_COLUMNS = tag(0x0028, 0x9002)
+DATA_REPRESENTATION = tag(0x0028, 0x9108)
+SIEMENS_CSA_IMAGE_HEADER = tag(0x0029, 0x1010)
+SIEMENS_CSA_SPECTROSCOPY_HEADER = tag(0x0029, 0x1110)  # Siemens spectroscopy uses the 0x11 private block
+SPECTROSCOPY_DATA = tag(0x5600, 0x0020)
+SIEMENS_CSA_NON_IMAGE_DATA = tag(0x7FE1, 0x1010)
+PIXEL_DATA = tag(0x7FE0, 0x0010)
+
+KNOWN_VRS = {TRANSFER_SYNTAX_UID: "UI", IMAGE_TYPE: "CS", SOP_CLASS_UID: "UI", SERIES_DESCRIPTION: "LO",
+             SLICE_THICKNESS: "DS", REPETITION_TIME: "DS", ECHO_TIME: "DS", IMAGING_FREQUENCY: "DS",
+             ECHO_NUMBERS: "IS", SPECTRAL_WIDTH: "FD", TRANSMITTER_FREQUENCY: "FD",
+             SPACING_BETWEEN_SLICES: "DS", PROTOCOL_NAME: "LO", SIEMENS_NUMBER_OF_IMAGES_IN_MOSAIC: "US",
+             SERIES_INSTANCE_UID: "UI", ACQUISITION_NUMBER: "IS", INSTANCE_NUMBER: "IS",
+             IMAGE_POSITION_PATIENT: "DS", IMAGE_ORIENTATION_PATIENT: "DS", SAMPLES_PER_PIXEL: "US",
+             NUMBER_OF_FRAMES: "IS", ROWS: "US", COLUMNS: "US", PIXEL_SPACING: "DS", BITS_ALLOCATED: "US",
+             PIXEL_REPRESENTATION: "US", DATA_POINT_ROWS: "UL", DATA_POINT_COLUMNS: "UL",
+             DATA_REPRESENTATION: "CS", RESCALE_INTERCEPT: "DS", RESCALE_SLOPE: "DS",
+             SIEMENS_CSA_IMAGE_HEADER: "OB", SIEMENS_CSA_SPECTROSCOPY_HEADER: "OB", SPECTROSCOPY_DATA: "OF",
+             SIEMENS_CSA_NON_IMAGE_DATA: "OB",
+             PIXEL_DATA: "OW"}
+
+BINARY_INT_FORMATS = {"US": "<H", "SS": "<h", "UL": "<I", "SL": "<i"}
+BINARY_FLOAT_FORMATS = {"FL": "<f", "FD": "<d"}
+
+
+class DicomReadError(Exception):
+    pass
+
+
+class DicomElement():
+    """
+    A top level data element. start_offset / end_offset span the whole element
+    (header and value), value_offset / length span the value only.
+    """
+    __slots__ = ["tag", "vr", "start_offset", "value_offset", "length", "end_offset"]
+
+    def __init__(self, tag_, vr, start_offset, value_offset, length, end_offset):
+        self.tag = tag_
+        self.vr = vr
+        self.start_offset = start_offset
+        self.value_offset = value_offset
+        self.length = length
+        self.end_offset = end_offset
+
+
+class DicomFile():
+    """
+    Parsed top level elements of a DICOM file held in memory. Access values with
+    the get_ methods, e.g. dicom_file.get_int(dicom_io.ROWS)
+    """
+    def __init__(self, buffer, filepath=None):
+        self.buffer = buffer
+        self.filepath = filepath
+        self.elements = collections.OrderedDict()
+
+        offset = self._read_preamble()
+        offset = self._read_meta_elements(offset)
+
+        self.transfer_syntax = self.get_str(TRANSFER_SYNTAX_UID) or IMPLICIT_VR_LITTLE_ENDIAN
+        if self.transfer_syntax not in UNCOMPRESSED_LITTLE_ENDIAN:
+            raise DicomReadError("unsupported transfer syntax {0} for {1}".format(self.transfer_syntax, filepath))
+
+        self.explicit_vr = self.transfer_syntax == EXPLICIT_VR_LITTLE_ENDIAN
+        self.dataset_offset = offset
+
+        for element in iter_elements(buffer, offset, len(buffer), self.explicit_vr):
+            self.elements[element.tag] = element
+
+    def _read_preamble(self):
+        if self.buffer[128:132] == b"DICM":
+            return 132
+        return 0  # no preamble, dataset starts at the first byte
+
+    def _read_meta_elements(self, offset):
+        """
+        File meta (group 0002) is always explicit VR little endian
+        """
+        if offset == 0:
+            return 0
+        for element in iter_elements(self.buffer, offset, len(self.buffer), explicit_vr=True,
+                                     stop_after_group=0x0002):
+            self.elements[element.tag] = element
+            offset = element.end_offset
+        return offset
+
+    def __contains__(self, tag_):
+        return tag_ in self.elements
+
+    def get_bytes(self, tag_):
+        if tag_ not in self.elements:
+            return None
+        element = self.elements[tag_]
+        return self.buffer[element.value_offset:element.value_offset + element.length]
+
+    def get_str(self, tag_):
+        value = self.get_bytes(tag_)
+        if value is None:
+            return None
+        return value.decode("latin-1").rstrip("\0 ").lstrip()
+
+    def get_strs(self, tag_):
+        value = self.get_str(tag_)
+        if value is None:
+            return None
+        return [item.strip() for item in value.split("\\")]
+
+    def get_floats(self, tag_):
+        element = self.elements.get(tag_)
+        if element is None:
+            return None
+        if element.vr in BINARY_FLOAT_FORMATS:
+            item_format = BINARY_FLOAT_FORMATS[element.vr]
+            return list(struct.unpack("<{0}{1}".format(element.length // struct.calcsize(item_format),
+                                                       item_format[1]), self.get_bytes(tag_)))
+        return [float(item) for item in self.get_strs(tag_) if item]
+
+    def get_float(self, tag_, default=None):
+        values = self.get_floats(tag_)
+        return values[0] if values else default
+
+    def get_int(self, tag_, default=None):
+        element = self.elements.get(tag_)
+        if element is None or element.length == 0:
+            return default
+        if element.vr in BINARY_INT_FORMATS:
+            return struct.unpack_from(BINARY_INT_FORMATS[element.vr], self.buffer, element.value_offset)[0]
+        return int(float(self.get_str(tag_)))
+
+    def get_pixel_data_span(self):
+        """
+        Return (offset, length) of the pixel data in the buffer
+        """
+        element = self.elements.get(PIXEL_DATA)
+        if element is None:
+            return None
+        if element.length == UNDEFINED_LENGTH:
+            raise DicomReadError("encapsulated pixel data is not supported for {0}".format(self.filepath))
+        return element.value_offset, element.length
+
+
+def read_dicom(filepath):
+    with open(filepath, "rb") as file:
+        buffer = file.read()
+    return DicomFile(buffer, filepath)
+
+def is_dicom_file(filepath):
+    with open(filepath, "rb") as file:
+        return file.read(132)[128:132] == b"DICM"
+
+# Element parsing ------------------------------------------------------------------------------------------------------
+
+def iter_elements(buffer, offset, end, explicit_vr, stop_after_group=None):
+    """
+    Yield DicomElement for each element between offset and end. Sequences are
+    stepped over whole (nested elements are not yielded).
+    """
+    while offset + 8 <= end:
+        group, element_num = struct.unpack_from("<HH", buffer, offset)
+        tag_ = (group << 16) | element_num
+
+        if stop_after_group is not None and group != stop_after_group:
+            return
+
+        if tag_ in [ITEM_DELIMITATION, SEQUENCE_DELIMITATION]:
+            return
+
+        start_offset = offset
+        vr, length, value_offset = _read_element_header(buffer, offset, tag_, explicit_vr)
+
+        if length == UNDEFINED_LENGTH:
+            if tag_ == PIXEL_DATA:  # encapsulated, only the offset is needed
+                yield DicomElement(tag_, vr, start_offset, value_offset, length, end)
+                return
+            end_offset = _skip_undefined_length_sequence(buffer, value_offset, end, explicit_vr)
+        else:
+            end_offset = value_offset + length
+
+        if end_offset > end:
+            raise DicomReadError("element {0:08X} runs past the end of the file".format(tag_))
+
+        yield DicomElement(tag_, vr, start_offset, value_offset, length, end_offset)
+        offset = end_offset
+
+def _read_element_header(buffer, offset, tag_, explicit_vr):
+    """
+    Return (vr, value length, value offset)
+    """
+    if (tag_ >> 16) == 0xFFFE:  # item / delimiters have no VR
+        length, = struct.unpack_from("<I", buffer, offset + 4)
+        return None, length, offset + 8
+
+    if explicit_vr:
+        vr = buffer[offset + 4:offset + 6].decode("latin-1")
+        if vr in LONG_LENGTH_VRS:
+            length, = struct.unpack_from("<I", buffer, offset + 8)
+            return vr, length, offset + 12
+        length, = struct.unpack_from("<H", buffer, offset + 6)
+        return vr, length, offset + 8
+
+    length, = struct.unpack_from("<I", buffer, offset + 4)
+    return KNOWN_VRS.get(tag_, "UN"), length, offset + 8
+
+def _skip_undefined_length_sequence(buffer, offset, end, explicit_vr):
+    """
+    Return the offset just past the sequence delimitation item.
+    """
+    while offset + 8 <= end:
+        item_tag = (struct.unpack_from("<H", buffer, offset)[0] << 16) | struct.unpack_from("<H", buffer, offset + 2)[0]
+        item_length, = struct.unpack_from("<I", buffer, offset + 4)
+        offset += 8
+
+        if item_tag == SEQUENCE_DELIMITATION:
+            return offset
+
+        if item_tag != ITEM:
+            raise DicomReadError("unexpected tag {0:08X} in sequence".format(item_tag))
+
+        if item_length != UNDEFINED_LENGTH:
+            offset += item_length
+            continue
+
+        # undefined length item, step over nested elements up to the item delimitation
+        for element in iter_elements(buffer, offset, end, explicit_vr):
+            offset = element.end_offset
+        delimiter_tag = (struct.unpack_from("<H", buffer, offset)[0] << 16) | struct.unpack_from("<H", buffer, offset + 2)[0]
+        if delimiter_tag != ITEM_DELIMITATION:
+            raise DicomReadError("missing item delimitation in sequence")
+        offset += 8
+
+    raise DicomReadError("missing sequence delimitation")
+
+# Siemens CSA header ---------------------------------------------------------------------------------------------------
+
+def parse_siemens_csa_header(csa_bytes):
+    """
+    Parse a Siemens CSA2 ("SV10") header e.g. from (0029,1010) and return a dict
+    {tag name: list of str values}. Return empty dict if not CSA2.
+    """
+    if csa_bytes is None or csa_bytes[:4] != b"SV10":
+        return {}
+
+    num_tags, = struct.unpack_from("<I", csa_bytes, 8)
+    offset = 16
+    result = {}
+
+    for __ in range(num_tags):
+        name = csa_bytes[offset:offset + 64].split(b"\0")[0].decode("latin-1")
+        num_items, = struct.unpack_from("<i", csa_bytes, offset + 76)
+        offset += 84
+
+        values = []
+        for __ in range(num_items):
+            item_length, = struct.unpack_from("<i", csa_bytes, offset + 4)
+            offset += 16
+            value = csa_bytes[offset:offset + item_length].split(b"\0")[0].decode("latin-1").strip()
+            if value:
+                values.append(value)
+            offset += (item_length + 3) // 4 * 4
+
+        result[name] = values
+
+    return result
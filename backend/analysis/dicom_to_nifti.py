@@ -0,0 +1,277 @@
+import os
+import json
+import math
+import struct
+import numpy as np
+import nibabel as nib
+from backend.analysis import dicom_io
+
+# In-process DICOM to NIfTI conversion for simple series
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# Small series (e.g. b0 / b1 maps) are dominated by dcm2niix process startup. Simple
+# series are converted here by reading the pixel data with numpy straight from the DICOM
+# buffers. Supported:
+#
+#   single-frame:   one 2D slice per file, optionally repeated over time (same slice positions
+#                   in each volume) -> 3D or 4D
+#   mosaic:         Siemens mosaic, one volume per file -> 3D or 4D. Requires the CSA image header.
+#
+# Anything else (enhanced multi-frame, compressed, mixed orientation / size, multi-echo
+# with uneven echoes...) raises NotSimpleSeries so the caller falls back to dcm2niix.
+
+SIDECAR_FIELDS = [["SeriesDescription", dicom_io.SERIES_DESCRIPTION, "str"],
+                  ["ProtocolName", dicom_io.PROTOCOL_NAME, "str"],
+                  ["ImageType", dicom_io.IMAGE_TYPE, "strs"],
+                  ["RepetitionTime", dicom_io.REPETITION_TIME, "seconds"],
+                  ["EchoTime", dicom_io.ECHO_TIME, "seconds"],
+                  ["SliceThickness", dicom_io.SLICE_THICKNESS, "float"]]
+
+
+class NotSimpleSeries(Exception):
+    pass
+
+
+def convert_series_to_nifti(source_dir, output_dir, name):
+    """
+    Convert all DICOM in source_dir to output_dir/name.nii.gz with a BIDS-style sidecar
+    output_dir/name.json. Return (nifti_files, {json_filepath: sidecar}) in the same form as
+    mri_preprocessing_wrappers.collect_dcm2niix_outputs(). Raise NotSimpleSeries if the
+    series must be converted with dcm2niix.
+    """
+    dicom_files = read_series(source_dir)
+
+    check_series_is_simple(dicom_files)
+
+    if is_mosaic(dicom_files[0]):
+        data, affine = get_mosaic_data_and_affine(dicom_files)
+    else:
+        data, affine = get_single_frame_data_and_affine(dicom_files)
+
+    repetition_time = dicom_files[0].get_float(dicom_io.REPETITION_TIME)
+
+    image = nib.Nifti1Image(data, affine)
+    image.header.set_qform(affine, code=1)  # scanner coordinates
+    image.header.set_sform(affine, code=1)
+    image.header.set_xyzt_units("mm", "sec")
+    if data.ndim == 4 and repetition_time:
+        image.header.set_zooms(image.header.get_zooms()[:3] + (repetition_time / 1000,))
+
+    os.makedirs(output_dir, exist_ok=True)
+    nifti_filepath = os.path.join(output_dir, name + ".nii.gz")
+    image.to_filename(nifti_filepath)
+
+    sidecar = get_sidecar(dicom_files[0])
+    sidecar_filepath = os.path.join(output_dir, name + ".json")
+    with open(sidecar_filepath, "w") as file:
+        json.dump(sidecar, file, indent=4)
+
+    return [nifti_filepath], {sidecar_filepath: sidecar}
+
+def read_series(source_dir):
+    filepaths = sorted(entry.path for entry in os.scandir(source_dir) if entry.is_file())
+    if not filepaths:
+        raise NotSimpleSeries("no files in {0}".format(source_dir))
+
+    try:
+        return [dicom_io.read_dicom(filepath) for filepath in filepaths]
+    except (dicom_io.DicomReadError, struct.error, ValueError, IndexError) as error:
+        raise NotSimpleSeries(str(error))
+
+def check_series_is_simple(dicom_files):
+    first = dicom_files[0]
+
+    if first.get_int(dicom_io.NUMBER_OF_FRAMES, 1) != 1:
+        raise NotSimpleSeries("multi-frame DICOM")
+
+    if first.get_int(dicom_io.SAMPLES_PER_PIXEL, 1) != 1:
+        raise NotSimpleSeries("colour DICOM")
+
+    if first.get_int(dicom_io.BITS_ALLOCATED) not in [8, 16, 32]:
+        raise NotSimpleSeries("unsupported bits allocated")
+
+    for tag_ in [dicom_io.IMAGE_POSITION_PATIENT, dicom_io.IMAGE_ORIENTATION_PATIENT, dicom_io.PIXEL_SPACING]:
+        if tag_ not in first:
+            raise NotSimpleSeries("missing geometry tag {0:08X}".format(tag_))
+
+    for tag_ in [dicom_io.SERIES_INSTANCE_UID, dicom_io.ROWS, dicom_io.COLUMNS, dicom_io.BITS_ALLOCATED,
+                 dicom_io.PIXEL_REPRESENTATION, dicom_io.PIXEL_SPACING, dicom_io.IMAGE_TYPE,
+                 dicom_io.ECHO_NUMBERS]:  # echoes are written as separate files by dcm2niix
+        if len(set(dicom_file.get_bytes(tag_) for dicom_file in dicom_files)) != 1:
+            raise NotSimpleSeries("tag {0:08X} differs across the series".format(tag_))
+
+    orientations = [np.array(dicom_file.get_floats(dicom_io.IMAGE_ORIENTATION_PATIENT)) for dicom_file in dicom_files]
+    if any(not np.allclose(orientation, orientations[0], atol=1e-4) for orientation in orientations):
+        raise NotSimpleSeries("orientation differs across the series")
+
+    for dicom_file in dicom_files:
+        if dicom_file.get_pixel_data_span() is None:
+            raise NotSimpleSeries("no pixel data in {0}".format(dicom_file.filepath))
+
+def is_mosaic(dicom_file):
+    return "MOSAIC" in (dicom_file.get_strs(dicom_io.IMAGE_TYPE) or [])
+
+# Pixel data -----------------------------------------------------------------------------------------------------------
+
+def get_pixel_array(dicom_file):
+    """
+    Return the 2D pixel array (rows, columns) as a view on the DICOM buffer, or
+    rescaled float32 copy if a rescale slope / intercept is set.
+    """
+    rows = dicom_file.get_int(dicom_io.ROWS)
+    columns = dicom_file.get_int(dicom_io.COLUMNS)
+    bits_allocated = dicom_file.get_int(dicom_io.BITS_ALLOCATED)
+    signed = dicom_file.get_int(dicom_io.PIXEL_REPRESENTATION, 0) == 1
+
+    dtype = np.dtype("<{0}{1}".format("i" if signed else "u", bits_allocated // 8))
+    offset, length = dicom_file.get_pixel_data_span()
+
+    if length < rows * columns * dtype.itemsize:
+        raise NotSimpleSeries("pixel data is shorter than rows x columns for {0}".format(dicom_file.filepath))
+
+    pixels = np.frombuffer(dicom_file.buffer, dtype=dtype, count=rows * columns, offset=offset).reshape(rows, columns)
+
+    if is_rescaled(dicom_file):
+        pixels = pixels.astype(np.float32) * dicom_file.get_float(dicom_io.RESCALE_SLOPE, 1.0) + \
+            dicom_file.get_float(dicom_io.RESCALE_INTERCEPT, 0.0)
+
+    return pixels
+
+def is_rescaled(dicom_file):
+    return dicom_file.get_float(dicom_io.RESCALE_SLOPE, 1.0) != 1.0 or \
+        dicom_file.get_float(dicom_io.RESCALE_INTERCEPT, 0.0) != 0.0
+
+def get_data_dtype(dicom_files, first_pixels):
+    """
+    float32 if any file is rescaled (see get_pixel_array()), otherwise the stored dtype
+    """
+    return np.float32 if any(is_rescaled(dicom_file) for dicom_file in dicom_files) else first_pixels.dtype
+
+def get_row_column_normal_cosines(dicom_file):
+    orientation = np.array(dicom_file.get_floats(dicom_io.IMAGE_ORIENTATION_PATIENT))
+    row_cosine, column_cosine = orientation[:3], orientation[3:]
+    return row_cosine, column_cosine, np.cross(row_cosine, column_cosine)
+
+def get_affine(row_cosine, column_cosine, slice_vector, first_position, row_spacing, column_spacing):
+    """
+    Voxel (i, j, k) to scanner RAS+ mm, where i indexes columns, j rows and k slices.
+    DICOM patient coordinates are LPS so the first two rows are flipped.
+    """
+    affine = np.eye(4)
+    affine[:3, 0] = row_cosine * column_spacing
+    affine[:3, 1] = column_cosine * row_spacing
+    affine[:3, 2] = slice_vector
+    affine[:3, 3] = first_position
+    affine[:2, :] *= -1
+    return affine
+
+def get_single_frame_data_and_affine(dicom_files):
+    """
+    One slice per file. Files at the same slice position are volumes in time,
+    ordered by acquisition then instance number.
+    """
+    row_cosine, column_cosine, normal = get_row_column_normal_cosines(dicom_files[0])
+
+    slices = {}
+    for dicom_file in dicom_files:
+        position = np.array(dicom_file.get_floats(dicom_io.IMAGE_POSITION_PATIENT))
+        slices.setdefault(round(float(np.dot(position, normal)), 3), []).append([position, dicom_file])
+
+    num_volumes = len(next(iter(slices.values())))
+    if any(len(files_at_position) != num_volumes for files_at_position in slices.values()):
+        raise NotSimpleSeries("uneven number of files per slice position (e.g. multi-echo)")
+
+    slice_distances = sorted(slices.keys())
+    positions = [slices[distance][0][0] for distance in slice_distances]
+
+    if len(slice_distances) > 1:
+        spacings = np.diff(slice_distances)
+        if not np.allclose(spacings, spacings[0], rtol=1e-2):
+            raise NotSimpleSeries("slices are not evenly spaced")
+        slice_vector = (positions[-1] - positions[0]) / (len(positions) - 1)
+    else:
+        slice_vector = normal * dicom_files[0].get_float(dicom_io.SLICE_THICKNESS, 1.0)
+
+    row_spacing, column_spacing = dicom_files[0].get_floats(dicom_io.PIXEL_SPACING)
+    rows = dicom_files[0].get_int(dicom_io.ROWS)
+    columns = dicom_files[0].get_int(dicom_io.COLUMNS)
+
+    first_slice = get_pixel_array(dicom_files[0])
+    data = np.empty((columns, rows, len(slice_distances), num_volumes), dtype=get_data_dtype(dicom_files, first_slice))
+
+    for slice_idx, distance in enumerate(slice_distances):
+        files_at_position = sorted(slices[distance],
+                                   key=lambda item: (item[1].get_int(dicom_io.ACQUISITION_NUMBER, 0),
+                                                     item[1].get_int(dicom_io.INSTANCE_NUMBER, 0)))
+        for volume_idx, (__, dicom_file) in enumerate(files_at_position):
+            data[:, :, slice_idx, volume_idx] = get_pixel_array(dicom_file).T
+
+    affine = get_affine(row_cosine, column_cosine, slice_vector, positions[0], row_spacing, column_spacing)
+
+    return (data[..., 0] if num_volumes == 1 else data), affine
+
+def get_mosaic_data_and_affine(dicom_files):
+    """
+    Siemens mosaic, each file is a volume of num_slices tiles. The stored image position
+    is the corner of the whole mosaic so is shifted to the corner of the first tile.
+    """
+    first = dicom_files[0]
+    csa = dicom_io.parse_siemens_csa_header(first.get_bytes(dicom_io.SIEMENS_CSA_IMAGE_HEADER))
+
+    num_slices = first.get_int(dicom_io.SIEMENS_NUMBER_OF_IMAGES_IN_MOSAIC)
+    if not num_slices and csa.get("NumberOfImagesInMosaic"):
+        num_slices = int(float(csa["NumberOfImagesInMosaic"][0]))
+    if not num_slices or len(csa.get("SliceNormalVector", [])) != 3:
+        raise NotSimpleSeries("mosaic without CSA slice information")
+
+    tiles_per_side = int(math.ceil(math.sqrt(num_slices)))
+    mosaic_rows = first.get_int(dicom_io.ROWS)
+    mosaic_columns = first.get_int(dicom_io.COLUMNS)
+    if mosaic_rows % tiles_per_side or mosaic_columns % tiles_per_side:
+        raise NotSimpleSeries("mosaic size is not a multiple of the tile size")
+    rows, columns = mosaic_rows // tiles_per_side, mosaic_columns // tiles_per_side
+
+    row_cosine, column_cosine, __ = get_row_column_normal_cosines(first)
+    normal = np.array([float(value) for value in csa["SliceNormalVector"]])
+    row_spacing, column_spacing = first.get_floats(dicom_io.PIXEL_SPACING)
+
+    slice_spacing = first.get_float(dicom_io.SPACING_BETWEEN_SLICES) or first.get_float(dicom_io.SLICE_THICKNESS, 1.0)
+
+    mosaic_position = np.array(first.get_floats(dicom_io.IMAGE_POSITION_PATIENT))
+    first_position = mosaic_position + \
+        row_cosine * column_spacing * (mosaic_columns - columns) / 2 + \
+        column_cosine * row_spacing * (mosaic_rows - rows) / 2
+
+    volumes = sorted(dicom_files, key=lambda dicom_file: (dicom_file.get_int(dicom_io.ACQUISITION_NUMBER, 0),
+                                                          dicom_file.get_int(dicom_io.INSTANCE_NUMBER, 0)))
+    first_mosaic = get_pixel_array(volumes[0])
+    data = np.empty((columns, rows, num_slices, len(volumes)), dtype=get_data_dtype(volumes, first_mosaic))
+
+    for volume_idx, dicom_file in enumerate(volumes):
+        mosaic = first_mosaic if volume_idx == 0 else get_pixel_array(dicom_file)
+        tiles = mosaic.reshape(tiles_per_side, rows, tiles_per_side, columns).transpose(0, 2, 1, 3)
+        tiles = tiles.reshape(tiles_per_side * tiles_per_side, rows, columns)[:num_slices]
+        data[..., volume_idx] = tiles.transpose(2, 1, 0)
+
+    affine = get_affine(row_cosine, column_cosine, normal * slice_spacing, first_position, row_spacing, column_spacing)
+
+    return (data[..., 0] if len(volumes) == 1 else data), affine
+
+# Sidecar --------------------------------------------------------------------------------------------------------------
+
+def get_sidecar(dicom_file):
+    sidecar = {}
+    for field, tag_, value_type in SIDECAR_FIELDS:
+        if tag_ not in dicom_file:
+            continue
+        if value_type == "str":
+            sidecar[field] = dicom_file.get_str(tag_)
+        elif value_type == "strs":
+            sidecar[field] = dicom_file.get_strs(tag_)
+        elif value_type == "seconds":
+            sidecar[field] = dicom_file.get_float(tag_) / 1000
+        else:
+            sidecar[field] = dicom_file.get_float(tag_)
+
+    sidecar["ConversionSoftware"] = "mri_project_manager in-process converter"
+    return sidecar
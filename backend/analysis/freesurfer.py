@@ -0,0 +1,120 @@
+import os
+import shutil
+from backend.utils import commands
+
+# FreeSurfer recon-all orchestration
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# recon-all takes many hours per subject so jobs are
+#   - run with -openmp N -parallel so each job uses a fixed number of threads,
+#   - packed onto the available cores (num_cores // threads_per_job jobs at once),
+#   - resumed from the last finished autorecon stage found in scripts/recon-all-status.log
+#     rather than started again.
+#
+# recon-all-status.log has one "#@# <step> <date>" line per step as it starts. The stages
+# run in order, so a stage is finished once the first step of the next stage has started,
+# and autorecon3 is finished once scripts/recon-all.done is written (with no recon-all.error).
+
+AUTORECON_STAGES = ["autorecon1", "autorecon2", "autorecon3"]
+
+FIRST_STEPS_OF_STAGE = {"autorecon2": ["EM Registration"],
+                        "autorecon3": ["Sphere lh", "Sphere rh"]}  # lh / rh may start in either order with -parallel
+
+
+def get_finished_stages(subjects_dir, subject_id):
+    """
+    Return list of the autorecon stages finished for the subject (e.g. ["autorecon1"]).
+    """
+    scripts_path = os.path.join(subjects_dir, subject_id, "scripts")
+
+    if os.path.isfile(os.path.join(scripts_path, "recon-all.done")) and \
+            not os.path.isfile(os.path.join(scripts_path, "recon-all.error")):
+        return list(AUTORECON_STAGES)
+
+    started_steps = read_started_steps(os.path.join(scripts_path, "recon-all-status.log"))
+
+    finished_stages = []
+    for stage, next_stage in zip(AUTORECON_STAGES[:-1], AUTORECON_STAGES[1:]):
+        if not any(step_has_started(started_steps, step) for step in FIRST_STEPS_OF_STAGE[next_stage]):
+            break
+        finished_stages.append(stage)
+
+    return finished_stages
+
+def read_started_steps(status_log_filepath):
+    """
+    Return the "<step> <date>" part of every "#@# " line in recon-all-status.log
+    """
+    if not os.path.isfile(status_log_filepath):
+        return []
+
+    with open(status_log_filepath, "r", errors="replace") as file:
+        return [line[4:].strip() for line in file if line.startswith("#@# ")]
+
+def step_has_started(started_steps, step):
+    return any(started_step.startswith(step + " ") for started_step in started_steps)
+
+def is_finished(subjects_dir, subject_id):
+    return get_finished_stages(subjects_dir, subject_id) == AUTORECON_STAGES
+
+def get_recon_all_command(subjects_dir, subject_id, t1_filepath, threads_per_job=1, recon_all_path="recon-all"):
+    """
+    Return the recon-all argv to run (or resume) the subject, or None if recon-all is finished.
+
+    New subjects are imported from t1_filepath with -i. For existing subjects only the
+    autorecon stages not yet finished are run, with -no-isrunning as a killed job leaves
+    scripts/IsRunning.* behind (the subject must not be running elsewhere).
+    """
+    command = [recon_all_path, "-s", subject_id, "-sd", subjects_dir]
+
+    if not has_imported_t1(subjects_dir, subject_id):
+        command += ["-i", t1_filepath, "-all"]
+    else:
+        finished_stages = get_finished_stages(subjects_dir, subject_id)
+        if finished_stages == AUTORECON_STAGES:
+            return None
+        command += ["-" + stage for stage in AUTORECON_STAGES if stage not in finished_stages]
+        command += ["-no-isrunning"]
+
+    if threads_per_job > 1:
+        command += ["-openmp", str(threads_per_job), "-parallel"]
+
+    return command
+
+def has_imported_t1(subjects_dir, subject_id):
+    return os.path.isfile(os.path.join(subjects_dir, subject_id, "mri", "orig", "001.mgz"))
+
+def remove_failed_import(subjects_dir, subject_id):
+    """
+    recon-all -i will not run if the subject dir exists, so remove a subject dir
+    left by a job that failed before the T1 was imported.
+    """
+    subject_path = os.path.join(subjects_dir, subject_id)
+    if os.path.isdir(subject_path) and not has_imported_t1(subjects_dir, subject_id):
+        shutil.rmtree(subject_path)
+
+def get_num_concurrent_jobs(num_cores, threads_per_job):
+    return max(1, num_cores // max(1, threads_per_job))
+
+def run_recon_all_jobs(jobs, num_cores, threads_per_job, recon_all_path="recon-all", command_log=None):
+    """
+    Run recon-all for every job, num_cores // threads_per_job jobs at once.
+
+    jobs: list of (subjects_dir, subject_id, t1_filepath)
+
+    Jobs already finished are not run. Return list of CommandResult (None for jobs already
+    finished) in the same order as jobs.
+    """
+    job_commands = []
+    for subjects_dir, subject_id, t1_filepath in jobs:
+        os.makedirs(subjects_dir, exist_ok=True)
+        remove_failed_import(subjects_dir, subject_id)
+        job_commands.append(get_recon_all_command(subjects_dir, subject_id, t1_filepath, threads_per_job,
+                                                  recon_all_path))
+
+    commands_to_run = [command for command in job_commands if command is not None]
+    results = iter(commands.run_commands(commands_to_run,
+                                         max_workers=get_num_concurrent_jobs(num_cores, threads_per_job),
+                                         command_log=command_log) if commands_to_run else [])
+
+    return [next(results) if command is not None else None for command in job_commands]
@@ -1,4 +1,8 @@
-import subprocess
+import os
+import json
+import time
+import concurrent.futures
+from backend.utils import commands
 
 def passed_and_true(arg, kwargs):
     return arg in kwargs and kwargs[arg]
@@ -43,10 +47,10 @@ def dcm2nii(subject_folder, **kwargs):
     convert_every_image=True,
     reorient_and_crop=False
     """
-    dcm2nii_command = get_dcm2nii_call(subject_folder, **kwargs)
-    print(dcm2nii_command)
-    subprocess.run(dcm2nii_command,
-                   shell=True)
+    dcm2nii_command = ["dcm2nii"] + get_dcm2nii_args(**kwargs).split() + [subject_folder]
+    print(" ".join(dcm2nii_command))
+    return commands.run_command(dcm2nii_command,
+                                echo=True)
 
 def format_as_str(str_):
     """
@@ -54,17 +58,155 @@ def format_as_str(str_):
     """
     return "\'" + str(str_) + "\'"
 
-def get_dcm2niix_args(output_directory, **kwargs):  # TODO: switch to nipype
-    args = ""
+def get_dcm2niix_args(output_directory, out_filename="%f", compress=True, bids_sidecar=True):
+    """
+    Return the dcm2niix arguments (argv list, without the source dir).
 
-    args += "-f %f "  # for now just set the output filename to the folder name as default ans take no other options. TODO: move to nipype
-    args += "-o {0}".format(output_directory)
+    out_filename: -f, output filename (default %f is the source folder name)
+    compress: -z y to save .nii.gz
+    bids_sidecar: -b y to save the BIDS .json sidecar
+    """
+    args = ["-f", out_filename,
+            "-z", "y" if compress else "n",
+            "-b", "y" if bids_sidecar else "n",
+            "-o", output_directory]
     return args
 
+# dcm2niix batch conversion
+# ----------------------------------------------------------------------------------------------------------------------
+
+class Dcm2niixResult():
+    """
+    Result of converting one job with run_dcm2niix_batch().
+
+    nifti_files: all .nii / .nii.gz written for the job (dcm2niix may add suffixes e.g. _e2, _ph)
+    sidecars: dict {json_filepath: parsed BIDS sidecar}
+    """
+    def __init__(self, source_dir, output_dir, name, returncode, duration, nifti_files, sidecars, output_tail):
+        self.source_dir = source_dir
+        self.output_dir = output_dir
+        self.name = name
+        self.returncode = returncode
+        self.duration = duration
+        self.nifti_files = nifti_files
+        self.sidecars = sidecars
+        self.output_tail = output_tail
+
+    def succeeded(self):
+        return self.returncode == 0 and any(self.nifti_files)
+
+    def __repr__(self):
+        return "Dcm2niixResult({0}, returncode={1}, {2} nifti)".format(self.name,
+                                                                      self.returncode,
+                                                                      len(self.nifti_files))
+
+def get_num_available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def run_dcm2niix_batch(jobs, num_workers=None, dcm2niix_path="dcm2niix", command_log=None, timeout=None,
+                       try_in_process=False):
+    """
+    Run dcm2niix directly (no nipype node / workflow per run) on a list of jobs
+    with a pool of num_workers (default: all available cores).
+
+    jobs: list of (source_dir, output_dir, name), name is the output filename (-f)
+    dcm2niix_path: dcm2niix binary, can be replaced with a stub for testing
+    command_log: backend.utils.commands.CommandLog for all dcm2niix output
+    try_in_process: first try to convert each job in-process with dicom_to_nifti (for small simple
+                    series where dcm2niix startup dominates), only running dcm2niix for
+                    series it does not support.
+
+    Return list of Dcm2niixResult in the same order as jobs.
+    """
+    if not jobs:
+        return []
+
+    num_workers = num_workers or get_num_available_cores()
+
+    results = [None] * len(jobs)
+    if try_in_process:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(num_workers, len(jobs))) as pool:
+            results = list(pool.map(lambda job: convert_in_process(*job, command_log=command_log), jobs))
 
+    dcm2niix_job_idxs = [idx for idx, result in enumerate(results) if result is None]
+    dcm2niix_results = _run_dcm2niix_jobs([jobs[idx] for idx in dcm2niix_job_idxs],
+                                          num_workers, dcm2niix_path, command_log, timeout)
 
+    for idx, result in zip(dcm2niix_job_idxs, dcm2niix_results):
+        results[idx] = result
 
+    return results
 
+def convert_in_process(source_dir, output_dir, name, command_log=None):
+    """
+    Convert with dicom_to_nifti. Return Dcm2niixResult, or None if the series needs dcm2niix.
+    """
+    from backend.analysis import dicom_to_nifti  # numpy / nibabel are only imported if used
+
+    start_time = time.monotonic()
+    try:
+        nifti_files, sidecars = dicom_to_nifti.convert_series_to_nifti(source_dir, output_dir, name)
+    except dicom_to_nifti.NotSimpleSeries as error:
+        if command_log:
+            command_log.write_line("in-process conversion not possible for {0} ({1}), "
+                                   "using dcm2niix".format(source_dir, error))
+        return None
+
+    duration = time.monotonic() - start_time
+    if command_log:
+        command_log.write_line("converted {0} in-process in {1:.3f} s".format(source_dir, duration))
+
+    return Dcm2niixResult(source_dir, output_dir, name, 0, duration, nifti_files, sidecars, [])
+
+def _run_dcm2niix_jobs(jobs, num_workers, dcm2niix_path, command_log, timeout):
+    if not jobs:
+        return []
+
+    all_argv = []
+    for source_dir, output_dir, name in jobs:
+        os.makedirs(output_dir, exist_ok=True)
+        all_argv.append([dcm2niix_path] + get_dcm2niix_args(output_dir, out_filename=name) + [source_dir])
+
+    command_results = commands.run_commands(all_argv,
+                                            min(num_workers, len(jobs)),
+                                            command_log=command_log,
+                                            timeout=timeout)
+
+    results = []
+    for (source_dir, output_dir, name), command_result in zip(jobs, command_results):
+        nifti_files, sidecars = collect_dcm2niix_outputs(output_dir, name)
+        results.append(Dcm2niixResult(source_dir,
+                                      output_dir,
+                                      name,
+                                      command_result.returncode,
+                                      command_result.duration,
+                                      nifti_files,
+                                      sidecars,
+                                      command_result.output_tail))
+    return results
+
+def collect_dcm2niix_outputs(output_dir, name):
+    """
+    Return (nifti_files, {json_filepath: sidecar}) for all files in output_dir
+    starting with name.
+    """
+    nifti_files = []
+    sidecars = {}
+    with os.scandir(output_dir) as entries:
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if not entry.name.startswith(name):
+                continue
+            if entry.name.endswith((".nii", ".nii.gz")):
+                nifti_files.append(entry.path)
+            elif entry.name.endswith(".json"):
+                try:
+                    with open(entry.path, "r") as file:
+                        sidecars[entry.path] = json.load(file)
+                except ValueError:
+                    sidecars[entry.path] = None
+    return nifti_files, sidecars
 
 # Depreciated
 
@@ -94,7 +236,7 @@ def get_dcm2nii_args(**kwargs):  # TODO: source_in_filename does not take #True
     args += " -s Y" if passed_and_true("spm_2", kwargs) else " -s N"
     args += " -t Y" if passed_and_true("text_report", kwargs) else " -t N"
     args += " -v N" if passed_and_false("convert_every_image", kwargs) else " -v Y"
-    args += " x Y" if passed_and_true("reorient_and_crop", kwargs) else " -x N"
+    args += " -x Y" if passed_and_true("reorient_and_crop", kwargs) else " -x N"
 
     return args
 
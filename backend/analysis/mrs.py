@@ -0,0 +1,151 @@
+import os
+import json
+import struct
+import numpy as np
+from backend.analysis import dicom_io
+
+# MRS spectra consolidation
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# Single voxel spectroscopy is saved by the scanner as one DICOM per transient (e.g. 136 files
+# for slaser). Each run is read here in a single pass and written as one contiguous complex64
+# array (num_transients, num_points) in a .npy file, so fitting can load (or np.load(mmap_mode="r"))
+# a run with one read. A JSON sidecar holds the acquisition parameters.
+#
+# The FIDs are taken from Spectroscopy Data (5600,0020) or, for Siemens non-image storage,
+# the CSA non-image data (7FE1,1010). Both are float32 real / imaginary pairs. FIDs are
+# saved as stored in the DICOM (no conjugation or phasing).
+
+SIDECAR_FIELDS = [["SeriesDescription", dicom_io.SERIES_DESCRIPTION, "str"],
+                  ["ProtocolName", dicom_io.PROTOCOL_NAME, "str"],
+                  ["RepetitionTime", dicom_io.REPETITION_TIME, "seconds"],
+                  ["EchoTime", dicom_io.ECHO_TIME, "seconds"]]
+
+
+class MrsReadError(Exception):
+    pass
+
+
+def consolidate_mrs_run(source_dir, output_dir, name):
+    """
+    Read all spectroscopy DICOM in source_dir (ordered by instance number) and write
+    output_dir/name.npy (complex64, num_transients x num_points) and output_dir/name.json.
+    The array is written to a .partial file and renamed when complete, so an existing .npy
+    is always whole. Return (npy_filepath, sidecar). Raise MrsReadError if the run cannot be read.
+    """
+    filepaths = sorted(entry.path for entry in os.scandir(source_dir) if entry.is_file())
+    if not filepaths:
+        raise MrsReadError("no files in {0}".format(source_dir))
+
+    dicom_files = [read_spectroscopy_dicom(filepath) for filepath in filepaths]
+    dicom_files.sort(key=lambda dicom_file: dicom_file.get_int(dicom_io.INSTANCE_NUMBER, 0))
+
+    num_points = get_num_points(dicom_files[0])
+    fids_per_file = [get_fids(dicom_file, num_points) for dicom_file in dicom_files]
+    num_transients = sum(fids.shape[0] for fids in fids_per_file)
+
+    os.makedirs(output_dir, exist_ok=True)
+    npy_filepath = os.path.join(output_dir, name + ".npy")
+    partial_filepath = npy_filepath + ".partial"
+
+    array = np.lib.format.open_memmap(partial_filepath, mode="w+", dtype=np.complex64,
+                                      shape=(num_transients, num_points))
+    transient_idx = 0
+    for fids in fids_per_file:
+        array[transient_idx:transient_idx + fids.shape[0]] = fids
+        transient_idx += fids.shape[0]
+    array.flush()
+    del array
+    os.replace(partial_filepath, npy_filepath)
+
+    sidecar = get_sidecar(dicom_files[0], num_transients, num_points)
+    with open(os.path.join(output_dir, name + ".json"), "w") as file:
+        json.dump(sidecar, file, indent=4)
+
+    return npy_filepath, sidecar
+
+def read_spectroscopy_dicom(filepath):
+    try:
+        dicom_file = dicom_io.read_dicom(filepath)
+    except (dicom_io.DicomReadError, struct.error, ValueError, IndexError) as error:
+        raise MrsReadError("could not read {0}: {1}".format(filepath, error))
+
+    if get_spectroscopy_data_tag(dicom_file) is None:
+        raise MrsReadError("no spectroscopy data in {0}".format(filepath))
+    return dicom_file
+
+def get_spectroscopy_data_tag(dicom_file):
+    for tag_ in [dicom_io.SPECTROSCOPY_DATA, dicom_io.SIEMENS_CSA_NON_IMAGE_DATA]:
+        if tag_ in dicom_file:
+            return tag_
+    return None
+
+def get_siemens_csa(dicom_file):
+    for tag_ in [dicom_io.SIEMENS_CSA_SPECTROSCOPY_HEADER, dicom_io.SIEMENS_CSA_IMAGE_HEADER]:
+        csa = dicom_io.parse_siemens_csa_header(dicom_file.get_bytes(tag_))
+        if csa:
+            return csa
+    return {}
+
+def get_csa_float(csa, name):
+    values = csa.get(name)
+    return float(values[0]) if values else None
+
+def get_num_points(dicom_file):
+    """
+    Number of complex points per FID, from Data Point Columns or the Siemens CSA header.
+    If neither is set the whole data element is taken as a single FID.
+    """
+    num_points = dicom_file.get_int(dicom_io.DATA_POINT_COLUMNS)
+    if not num_points:
+        num_points = get_csa_float(get_siemens_csa(dicom_file), "DataPointColumns")
+    if not num_points:
+        num_points = len(dicom_file.get_bytes(get_spectroscopy_data_tag(dicom_file))) // 8
+    return int(num_points)
+
+def get_fids(dicom_file, num_points):
+    """
+    Return the FIDs of one file as a (num_fids, num_points) complex64 view on the DICOM buffer.
+    """
+    representation = dicom_file.get_str(dicom_io.DATA_REPRESENTATION)
+    if representation not in [None, "", "COMPLEX"]:
+        raise MrsReadError("unsupported data representation {0} in {1}".format(representation,
+                                                                              dicom_file.filepath))
+
+    data = dicom_file.get_bytes(get_spectroscopy_data_tag(dicom_file))
+    if len(data) % (num_points * 8):
+        raise MrsReadError("spectroscopy data in {0} is not a whole number of {1} point FIDs".format(
+            dicom_file.filepath, num_points))
+
+    return np.frombuffer(data, dtype="<c8").reshape(-1, num_points)
+
+def get_sidecar(dicom_file, num_transients, num_points):
+    sidecar = {}
+    for field, tag_, value_type in SIDECAR_FIELDS:
+        if tag_ not in dicom_file:
+            continue
+        if value_type == "str":
+            sidecar[field] = dicom_file.get_str(tag_)
+        else:
+            sidecar[field] = dicom_file.get_float(tag_) / 1000
+
+    csa = get_siemens_csa(dicom_file)
+
+    frequency = dicom_file.get_float(dicom_io.TRANSMITTER_FREQUENCY) or \
+        dicom_file.get_float(dicom_io.IMAGING_FREQUENCY) or get_csa_float(csa, "ImagingFrequency")
+    if frequency:
+        sidecar["SpectrometerFrequency"] = frequency  # MHz
+
+    spectral_width = dicom_file.get_float(dicom_io.SPECTRAL_WIDTH)
+    dwell_time_ns = get_csa_float(csa, "RealDwellTime")
+    if not spectral_width and dwell_time_ns:
+        spectral_width = 1e9 / dwell_time_ns
+    if spectral_width:
+        sidecar["SpectralWidth"] = spectral_width  # Hz
+        sidecar["DwellTime"] = 1 / spectral_width  # s
+
+    sidecar["NumberOfTransients"] = num_transients
+    sidecar["NumberOfPoints"] = num_points
+    sidecar["ArrayShape"] = ["transients", "points"]
+    sidecar["ConversionSoftware"] = "mri_project_manager mrs consolidation"
+    return sidecar
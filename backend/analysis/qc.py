@@ -0,0 +1,179 @@
+import os
+import json
+import concurrent.futures
+import numpy as np
+import nibabel as nib
+from backend.utils import volumes
+
+# Image quality control metrics
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# Per-run metrics computed on the dcm2niix output, by the qc setting of the scan type
+# (see backend/utils/scan_types.py):
+#
+#   func:          tSNR map (voxelwise mean / std over time, saved as <name>_tsnr.nii.gz) and its
+#                  median / mean in the brain mask, and intensity spikes. A spike is a volume whose
+#                  mean masked intensity differs from the median of its neighbours (SPIKE_WINDOW) by a
+#                  robust z-score (median / MAD over all volumes) over spike_z.
+#   snr:           SNR = 0.655 * mean foreground / std background (0.655 corrects the std of
+#                  Rayleigh distributed magnitude background noise). The first volume is used.
+#
+# The mask is every voxel over the mean of the (temporal mean) image, a rough but fast brain
+# mask. Runs are streamed in time chunks that fit memory_budget_bytes (see backend/utils/volumes.py),
+# func runs are read twice (temporal mean / std, then the masked mean of each volume) and
+# metrics are vectorised over each chunk. Metrics are saved to <name>_qc.json.
+
+SNR_RAYLEIGH_CORRECTION = 0.655
+SPIKE_WINDOW = 5
+
+COHORT_COLUMNS = ["sub_id", "ses_id", "scan_type", "bids_name", "median_tsnr", "mean_tsnr", "num_spikes",
+                  "max_spike_z", "snr", "reasons", "suggested_flag"]
+
+
+def run_qc_jobs(jobs, num_workers=None):
+    """
+    jobs: list of (nifti_filepath, scan_type, output_dir, name, spike_z, memory_budget_bytes, qc_metrics)
+
+    Run run_qc() for every job across a process pool of num_workers (default all cores).
+    Peak memory is about num_workers * memory_budget_bytes.
+    Return list of metrics dicts in the same order as jobs ({"error": message} if the run failed).
+    """
+    if not jobs:
+        return []
+
+    num_workers = min(num_workers or os.cpu_count() or 1, len(jobs))
+    if num_workers == 1:
+        return [_run_qc_job(job) for job in jobs]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as pool:
+        return list(pool.map(_run_qc_job, jobs))
+
+def _run_qc_job(job):
+    try:
+        return run_qc(*job)
+    except (OSError, ValueError, nib.filebasedimages.ImageFileError) as error:
+        return {"error": str(error)}
+
+def run_qc(nifti_filepath, scan_type, output_dir, name, spike_z=5.0,
+           memory_budget_bytes=volumes.DEFAULT_MEMORY_BUDGET_BYTES, qc_metrics="snr"):
+    """
+    Compute the qc_metrics ("func" or "snr") for one run, write output_dir/name_qc.json (and the
+    tSNR map for func) and return the metrics.
+    """
+    volume = volumes.NiftiVolume(nifti_filepath, memory_budget_bytes)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    if qc_metrics == "func":
+        metrics, tsnr_map = get_func_metrics(volume, spike_z)
+        nib.save(nib.Nifti1Image(tsnr_map, volume.affine), os.path.join(output_dir, name + "_tsnr.nii.gz"))
+    else:
+        metrics = get_snr_metrics(volume)
+
+    metrics = dict({"scan_type": scan_type,
+                    "source": os.path.basename(nifti_filepath),
+                    "shape": list(volume.image.shape)},
+                   **metrics)
+
+    with open(os.path.join(output_dir, name + "_qc.json"), "w") as file:
+        json.dump(metrics, file, indent=4)
+
+    return metrics
+
+def get_mask(image):
+    return image > image.mean()
+
+def get_func_metrics(volume, spike_z=5.0):
+    """
+    Return (metrics, tSNR map) for a 4D (x, y, z, t) volumes.NiftiVolume
+    """
+    if volume.num_volumes < 3:
+        raise ValueError("func QC needs a 4D run with at least 3 volumes, shape is {0}".format(volume.image.shape))
+
+    mean_image, std_image = volumes.get_temporal_mean_and_std(volume)
+    tsnr_map = np.divide(mean_image, std_image, out=np.zeros_like(mean_image), where=std_image > 0)
+
+    mask = get_mask(mean_image)
+    global_signal = volumes.get_masked_mean_per_volume(volume, mask)  # (t,)
+
+    spike_volumes, spike_z_scores = get_spikes(global_signal, spike_z)
+
+    metrics = {"num_volumes": int(volume.num_volumes),
+               "mask_voxels": int(mask.sum()),
+               "median_tsnr": float(np.median(tsnr_map[mask])),
+               "mean_tsnr": float(tsnr_map[mask].mean()),
+               "num_spikes": len(spike_volumes),
+               "spike_volumes": spike_volumes,
+               "max_spike_z": float(spike_z_scores.max()) if spike_z_scores.size else 0.0}
+
+    return metrics, tsnr_map.astype(np.float32)
+
+def get_spikes(global_signal, spike_z=5.0):
+    """
+    Return (list of volume indices with a spike, robust z-score of every volume)
+    """
+    half_window = SPIKE_WINDOW // 2
+    padded = np.pad(global_signal, half_window, mode="edge")
+    windows = np.lib.stride_tricks.sliding_window_view(padded, SPIKE_WINDOW)
+    running_median = np.median(np.delete(windows, half_window, axis=1), axis=1)  # neighbours only
+    residuals = global_signal - running_median
+
+    median = np.median(residuals)
+    mad = np.median(np.abs(residuals - median)) * 1.4826
+    if mad == 0:
+        return [], np.zeros_like(residuals)
+
+    z_scores = np.abs(residuals - median) / mad
+    return [int(idx) for idx in np.flatnonzero(z_scores > spike_z)], z_scores
+
+def get_snr_metrics(volume):
+    first_volume = volume.get_volume(0)
+
+    mask = get_mask(first_volume)
+    background = first_volume[~mask]
+    background_std = float(background.std()) if background.size else 0.0
+    foreground_mean = float(first_volume[mask].mean()) if mask.any() else 0.0
+
+    return {"mask_voxels": int(mask.sum()),
+            "foreground_mean": foreground_mean,
+            "background_std": background_std,
+            "snr": SNR_RAYLEIGH_CORRECTION * foreground_mean / background_std if background_std else None}
+
+def get_exclusion_reasons(metrics, thresholds):
+    """
+    Return list of reasons the run fails the QC thresholds (see qc_thresholds in project_configs.py)
+    """
+    if "error" in metrics:
+        return ["QC failed: {0}".format(metrics["error"])]
+
+    reasons = []
+    if "median_tsnr" in metrics:
+        if metrics["median_tsnr"] < thresholds["func_min_median_tsnr"]:
+            reasons.append("median tSNR {0:.1f} < {1}".format(metrics["median_tsnr"],
+                                                                thresholds["func_min_median_tsnr"]))
+        if metrics["num_spikes"] > thresholds["func_max_spikes"]:
+            reasons.append("{0} spikes > {1}".format(metrics["num_spikes"], thresholds["func_max_spikes"]))
+    else:
+        min_snr = thresholds["min_snr"].get(metrics["scan_type"])
+        if min_snr is not None and (metrics["snr"] is None or metrics["snr"] < min_snr):
+            reasons.append("SNR {0} < {1}".format("n/a" if metrics["snr"] is None else
+                                                  "{0:.1f}".format(metrics["snr"]), min_snr))
+    return reasons
+
+def format_cohort_tsv(rows):
+    """
+    rows: list of dicts with the COHORT_COLUMNS keys
+    """
+    lines = ["\t".join(COHORT_COLUMNS)]
+    for row in rows:
+        lines.append("\t".join(_format_cell(row.get(column)) for column in COHORT_COLUMNS))
+    return "\n".join(lines) + "\n"
+
+def _format_cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return "{0:.2f}".format(value)
+    if isinstance(value, list):
+        return "; ".join(str(item) for item in value)
+    return str(value)
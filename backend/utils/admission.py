@@ -0,0 +1,135 @@
+import time
+import threading
+from backend.utils.work_graph import format_bytes
+
+# Disk space and I/O admission control
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# Tasks that write data (downloads, copies to preprocessing, conversions) are only started
+# once every volume they write to has space for them. Each task states the bytes it will
+# write to each volume (see ProjectMaster._get_task_needed_bytes()) and the controller
+# reserves them until the task finishes, so concurrent sessions never fill a volume
+# partway through a copy:
+#
+#   free space:   measured free - bytes reserved by running tasks - safety margin >= bytes needed
+#   I/O budget:   bytes reserved by running tasks + bytes needed <= io_budget_bytes
+#
+# A task over the I/O budget on its own is admitted when nothing else is writing to the
+# volume, so large sessions are queued rather than never run. Free space is re-measured at most
+# every free_space_refresh_seconds (the HPC is measured over SSH) and after a task finishes.
+# It is measured outside the lock, so a slow measurement does not block tasks being admitted
+# or released on other volumes; the reservations are then checked under the lock.
+# Measured free space already includes the partly written data of running tasks, which are
+# also still reserved, so the check errs on the side of queueing.
+
+
+class AdmissionController():
+    """
+    get_free_bytes_func:         function(volume) that returns the free bytes on volume
+    get_needed_bytes_func:       function(task) that returns dict {volume: bytes written by the task}
+    safety_margin_bytes:         bytes always left free on every volume
+    io_budget_bytes:             max bytes written at once to each volume (None for no limit)
+    free_space_refresh_seconds:  max age of a free space measurement
+
+    e.g.
+        controller = AdmissionController(lambda volume: shutil.disk_usage(volume).free,
+                                         lambda task: {"/data": task.estimated_bytes or 0},
+                                         safety_margin_bytes=50e9)
+        if controller.try_admit(task):
+            ...  # run the task
+            controller.release(task)
+    """
+    def __init__(self, get_free_bytes_func, get_needed_bytes_func, safety_margin_bytes=0, io_budget_bytes=None,
+                 free_space_refresh_seconds=60):
+        self.get_free_bytes_func = get_free_bytes_func
+        self.get_needed_bytes_func = get_needed_bytes_func
+        self.safety_margin_bytes = safety_margin_bytes
+        self.io_budget_bytes = io_budget_bytes
+        self.free_space_refresh_seconds = free_space_refresh_seconds
+
+        self._lock = threading.Lock()
+        self._reservations = {}    # {task_id: {volume: bytes}}
+        self._reserved_bytes = {}  # {volume: bytes}
+        self._num_writers = {}     # {volume: number of running tasks writing to it}
+        self._free_bytes = {}      # {volume: (time measured, bytes)}
+        self._num_released = {}    # {volume: tasks released}, a measurement started before a release is not kept
+
+    def try_admit(self, task):
+        """
+        Reserve the bytes the task needs and return True, or return False (nothing reserved)
+        if a volume is short of space or over its I/O budget.
+        """
+        needed_bytes = self.get_needed_bytes_func(task)
+        free_bytes = self._measure_free_bytes(needed_bytes)
+        with self._lock:
+            if self._get_shortfall(needed_bytes, free_bytes):
+                return False
+
+            self._reservations[task.task_id] = needed_bytes
+            for volume, num_bytes in needed_bytes.items():
+                self._reserved_bytes[volume] = self._reserved_bytes.get(volume, 0) + num_bytes
+                self._num_writers[volume] = self._num_writers.get(volume, 0) + 1
+            return True
+
+    def release(self, task):
+        with self._lock:
+            for volume, num_bytes in self._reservations.pop(task.task_id, {}).items():
+                self._reserved_bytes[volume] -= num_bytes
+                self._num_writers[volume] -= 1
+                self._free_bytes.pop(volume, None)  # the task's data is now on disk, measure again
+                self._num_released[volume] = self._num_released.get(volume, 0) + 1
+
+    def get_shortfall(self, needed_bytes):
+        """
+        Return a message describing why needed_bytes ({volume: bytes}) cannot be admitted
+        now, or None if it can.
+        """
+        free_bytes = self._measure_free_bytes(needed_bytes)
+        with self._lock:
+            return self._get_shortfall(needed_bytes, free_bytes)
+
+    def num_running(self):
+        with self._lock:
+            return len(self._reservations)
+
+    def _get_shortfall(self, needed_bytes, free_bytes):
+        """
+        Call with the lock held. free_bytes is {volume: bytes} from _measure_free_bytes().
+        """
+        for volume, num_bytes in sorted(needed_bytes.items()):
+            reserved_bytes = self._reserved_bytes.get(volume, 0)
+            available_bytes = free_bytes[volume] - reserved_bytes - self.safety_margin_bytes
+
+            if num_bytes > available_bytes:
+                return "{0}: needs {1}, {2} available ({3} reserved by running tasks, " \
+                       "{4} safety margin)".format(volume,
+                                                   format_bytes(num_bytes),
+                                                   format_bytes(max(0, available_bytes)),
+                                                   format_bytes(reserved_bytes),
+                                                   format_bytes(self.safety_margin_bytes))
+
+            if self.io_budget_bytes is not None and self._num_writers.get(volume, 0) and \
+                    reserved_bytes + num_bytes > self.io_budget_bytes:
+                return "{0}: {1} already being written, I/O budget is {2}".format(volume,
+                                                                                 format_bytes(reserved_bytes),
+                                                                                 format_bytes(self.io_budget_bytes))
+        return None
+
+    def _measure_free_bytes(self, volumes):
+        """
+        Return {volume: free bytes}, measuring volumes whose last measurement is too old. Call
+        without the lock held, get_free_bytes_func() can take seconds (e.g. df over SSH).
+        """
+        free_bytes = {}
+        for volume in volumes:
+            with self._lock:
+                measured_time, free_bytes[volume] = self._free_bytes.get(volume, (None, None))
+                num_released = self._num_released.get(volume, 0)
+
+            if measured_time is None or time.monotonic() - measured_time > self.free_space_refresh_seconds:
+                free_bytes[volume] = self.get_free_bytes_func(volume)
+                with self._lock:
+                    if self._num_released.get(volume, 0) == num_released:
+                        self._free_bytes[volume] = (time.monotonic(), free_bytes[volume])
+        return free_bytes
+
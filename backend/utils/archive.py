@@ -0,0 +1,123 @@
+import os
+import json
+import tarfile
+import subprocess
+
+# Archiving raw_scans for ABL backups
+# ----------------------------------------------------------------------------------------------------------------------
+
+def get_archive_filepath(zk_id_base_path, zk_id):
+    """
+    The archive sits next to the second level zk_id dir it is made from e.g.
+    raw_scans/zk_id/zk_id.tar.zst
+    """
+    return os.path.join(zk_id_base_path, zk_id + ".tar.zst")
+
+def get_manifest_filepath(zk_id_base_path, zk_id):
+    return os.path.join(zk_id_base_path, zk_id + "_manifest.json")
+
+def make_file_manifest(dir_to_archive):
+    """
+    Walk the directory with os.scandir and return a dict of
+    {relative_path: size_in_bytes} for every file. Relative paths
+    include the archived dir name, as stored in the tar.
+    """
+    parent_path = os.path.dirname(dir_to_archive)
+    manifest = {}
+
+    dirs_to_scan = [dir_to_archive]
+    while dirs_to_scan:
+        with os.scandir(dirs_to_scan.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs_to_scan.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    manifest[os.path.relpath(entry.path, parent_path)] = entry.stat(follow_symlinks=False).st_size
+
+    return manifest
+
+def compress_dir_to_tar_zst(dir_to_archive, archive_filepath, num_threads=0, compression_level=3):
+    """
+    Stream the directory through tar into multithreaded zstd (-T0 uses all cores) without
+    an intermediate .tar on disk. Run straight after download so files are read from the
+    page cache. The archive is written to a .partial file and renamed on success so
+    an interrupted run never leaves a truncated archive that looks complete.
+
+    Returns the return code of the pipeline (0 on success).
+    """
+    parent_path, dir_name = os.path.split(dir_to_archive)
+    partial_filepath = archive_filepath + ".partial"
+
+    tar_process = subprocess.Popen(["tar", "-cf", "-", "-C", parent_path, dir_name],
+                                   stdout=subprocess.PIPE)
+    zstd_process = subprocess.Popen(["zstd", "-q", "-f", "-T{0}".format(num_threads),
+                                     "-{0}".format(compression_level), "-o", partial_filepath],
+                                    stdin=tar_process.stdout)
+    tar_process.stdout.close()  # allow tar to receive SIGPIPE if zstd exits
+
+    zstd_rc = zstd_process.wait()
+    tar_rc = tar_process.wait()
+
+    if tar_rc != 0 or zstd_rc != 0:
+        if os.path.isfile(partial_filepath):
+            os.remove(partial_filepath)
+        return tar_rc or zstd_rc
+
+    os.rename(partial_filepath, archive_filepath)
+    return 0
+
+def get_tar_zst_contents(archive_filepath):
+    """
+    Decompress the archive as a stream and return {relative_path: size_in_bytes}
+    for all files stored in it. Nothing is written to disk. Raises tarfile.ReadError
+    if the archive is corrupt or truncated.
+    """
+    zstd_process = subprocess.Popen(["zstd", "-q", "-d", "-c", archive_filepath],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL)
+    contents = {}
+    try:
+        with tarfile.open(fileobj=zstd_process.stdout, mode="r|") as tar:
+            for member in tar:
+                if member.isfile():
+                    contents[member.name] = member.size
+    finally:
+        zstd_process.stdout.close()  # zstd gets SIGPIPE if tar stopped reading early
+        zstd_rc = zstd_process.wait()
+
+    if zstd_rc != 0:
+        raise tarfile.ReadError("zstd could not decompress {0} (return code {1})".format(archive_filepath, zstd_rc))
+
+    return contents
+
+def verify_archive_against_manifest(archive_filepath, manifest):
+    """
+    Return a list of errors (empty if the archive matches the manifest). Every file
+    in the manifest must be in the archive with the same size and no extra
+    files are allowed.
+    """
+    try:
+        archive_contents = get_tar_zst_contents(archive_filepath)
+    except (tarfile.TarError, EOFError, OSError) as error:
+        return ["could not read archive {0}: {1}".format(archive_filepath, error)]
+
+    errors = []
+    for path, size in sorted(manifest.items()):
+        if path not in archive_contents:
+            errors.append("missing from archive: {0}".format(path))
+        elif archive_contents[path] != size:
+            errors.append("size mismatch for {0}: manifest {1}, archive {2}".format(path,
+                                                                                     size,
+                                                                                     archive_contents[path]))
+    for path in sorted(set(archive_contents) - set(manifest)):
+        errors.append("not in manifest: {0}".format(path))
+
+    return errors
+
+def save_manifest(manifest_filepath, manifest):
+    with open(manifest_filepath, "w") as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+
+def load_manifest(manifest_filepath):
+    with open(manifest_filepath, "r") as file:
+        return json.load(file)
@@ -0,0 +1,222 @@
+import os
+import json
+import hashlib
+import sqlite3
+
+# Layout index and scans tables for preprocessing
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# preprocessing uses BIDS names for subjects, sessions and runs, but its tree
+# (sub/ses/scan_type/nii/<bids_name>/...) is not a valid BIDS dataset, so no
+# dataset_description.json is written and pybids cannot index it. Instead this writes a
+# sub/ses/sub_ses_scans.tsv per session and a custom sqlite index (.layout_index.sqlite) with
+# one row per converted file and its entities (subject, session, task, run, datatype ...) so
+# downstream tools can query the layout without crawling the tree. The index has its own schema
+# (INDEX_SCHEMA), it is not a pybids database. Query it with sqlite.
+#
+# Everything is updated incrementally. Files are only rewritten if their contents change, and
+# each session's index rows are only rewritten if the signature (names, sizes and mtimes) of its
+# converted files has changed.
+
+DATATYPES = {"func": "func",  # default {scan_type: datatype}, see ProjectMaster.get_scan_types()
+             "anat": "anat",
+             "mpm": "anat",
+             "b0": "fmap",
+             "b1": "fmap",
+             "mrs": "mrs"}
+
+CONVERTED_EXTENSIONS = (".nii.gz", ".nii", ".npy")
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (subject TEXT, session TEXT, signature TEXT, PRIMARY KEY (subject, session));
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, subject TEXT, session TEXT, datatype TEXT, scan_type TEXT,
+                                  task TEXT, run INTEGER, scan_name TEXT, bids_name TEXT, extension TEXT, size INTEGER);
+CREATE INDEX IF NOT EXISTS files_session ON files (subject, session);
+"""
+
+
+def write_if_changed(filepath, contents):
+    """
+    Write contents to filepath (through a temporary file) only if it differs from the
+    existing file. Return True if the file was written.
+    """
+    if os.path.isfile(filepath):
+        with open(filepath, "r") as file:
+            if file.read() == contents:
+                return False
+
+    with open(filepath + ".partial", "w") as file:
+        file.write(contents)
+    os.replace(filepath + ".partial", filepath)
+    return True
+
+def remove_dataset_files(preprocessing_path):
+    """
+    Remove the dataset_description.json and participants.tsv written to preprocessing by earlier
+    versions, which declared it a BIDS dataset. Files not written by this module are kept.
+    Return the number of files removed.
+    """
+    num_removed = 0
+    dataset_description_filepath = os.path.join(preprocessing_path, "dataset_description.json")
+    try:
+        with open(dataset_description_filepath, "r") as file:
+            generated_by = json.load(file).get("GeneratedBy")
+    except (OSError, ValueError, AttributeError):
+        return num_removed
+
+    if generated_by != [{"Name": "mri_project_manager"}]:
+        return num_removed
+    os.remove(dataset_description_filepath)
+    num_removed += 1
+
+    participants_filepath = os.path.join(preprocessing_path, "participants.tsv")
+    try:
+        with open(participants_filepath, "r") as file:
+            header = file.readline()
+    except OSError:
+        return num_removed
+
+    if header == "participant_id\tlab_id\n":
+        os.remove(participants_filepath)
+        num_removed += 1
+    return num_removed
+
+def format_scans_tsv(session_files, acq_time):
+    """
+    One line per converted file, filename relative to the session dir. acq_time is the
+    session start (all runs of a session share it as the participant log has no run times).
+    """
+    lines = ["filename\tacq_time"]
+    lines += ["{0}\t{1}".format(session_file["filename"], acq_time) for session_file in session_files]
+    return "\n".join(lines) + "\n"
+
+def get_scans_tsv_filepath(ses_path, sub_id, ses_id):
+    return os.path.join(ses_path, "{0}_{1}_scans.tsv".format(sub_id, ses_id))
+
+def get_session_files(ses_path, datatypes=None):
+    """
+    Return a list of dicts (filename, scan_type, datatype, bids_name, extension, size, mtime_ns) for every
+    converted file in the session i.e. scan_type/nii/<bids_name>/* and scan_type/npy/*, in filename order.
+
+    datatypes: {scan_type: BIDS datatype} of the scan types to include (default DATATYPES)
+    """
+    datatypes = datatypes or DATATYPES
+    session_files = []
+    for scan_type in sorted(datatypes):
+        for folder in ["nii", "npy"]:
+            for entry in _scandir(os.path.join(ses_path, scan_type, folder)):
+
+                if entry.is_dir() and folder == "nii":
+                    bids_name = entry.name
+                    file_entries = _scandir(entry.path)
+                    relative_path = [scan_type, folder, bids_name]
+                else:
+                    bids_name = None
+                    file_entries = [entry]
+                    relative_path = [scan_type, folder]
+
+                for file_entry in file_entries:
+                    extension = _get_extension(file_entry.name)
+                    if not extension or not file_entry.is_file():
+                        continue
+                    stat = file_entry.stat()
+                    session_files.append({"filename": "/".join(relative_path + [file_entry.name]),
+                                          "scan_type": scan_type,
+                                          "datatype": datatypes[scan_type],
+                                          "bids_name": bids_name or file_entry.name[:-len(extension)],
+                                          "extension": extension,
+                                          "size": stat.st_size,
+                                          "mtime_ns": stat.st_mtime_ns})
+
+    return sorted(session_files, key=lambda session_file: session_file["filename"])
+
+def get_session_signature(session_files):
+    signature = hashlib.sha1()
+    for session_file in session_files:
+        signature.update("{0}\t{1}\t{2}\n".format(session_file["filename"],
+                                                  session_file["size"],
+                                                  session_file["mtime_ns"]).encode("utf-8"))
+    return signature.hexdigest()
+
+def parse_bids_name(bids_name):
+    """
+    Entities of a run name from ProjectMaster._get_bids_filename() e.g.
+    sub-001_ses-001_task-gp_run-001_fleet_mb
+    """
+    sub_id, ses_id, task, run_id, scan_name = (bids_name.split("_", 4) + [""] * 5)[:5]
+    return {"subject": sub_id[len("sub-"):],
+            "session": ses_id[len("ses-"):],
+            "task": task[len("task-"):],
+            "run": int(run_id[len("run-"):]) if run_id[len("run-"):].isdigit() else None,
+            "scan_name": scan_name}
+
+def update_layout_index(index_filepath, sessions, preprocessing_path=None):
+    """
+    Update the sqlite layout index with the converted files of each session.
+
+    sessions: list of (sub_id, ses_id, session_files) with session_files from get_session_files()
+    preprocessing_path: if given, the rows of indexed sessions whose sub-XXX/ses-XXX dir no
+                        longer exists are deleted
+
+    Sessions with an unchanged signature are not touched. Return the number of sessions updated
+    or deleted.
+    """
+    connection = sqlite3.connect(index_filepath)
+    try:
+        connection.executescript(INDEX_SCHEMA)
+        stored_signatures = dict(((subject, session), signature) for subject, session, signature in
+                                 connection.execute("SELECT subject, session, signature FROM sessions"))
+
+        num_updated = 0
+        with connection:
+            if preprocessing_path is not None:
+                for subject, session in stored_signatures:
+                    if os.path.isdir(os.path.join(preprocessing_path, "sub-" + subject, "ses-" + session)):
+                        continue
+                    connection.execute("DELETE FROM files WHERE subject = ? AND session = ?", (subject, session))
+                    connection.execute("DELETE FROM sessions WHERE subject = ? AND session = ?", (subject, session))
+                    num_updated += 1
+
+            for sub_id, ses_id, session_files in sessions:
+                subject, session = sub_id[len("sub-"):], ses_id[len("ses-"):]
+                signature = get_session_signature(session_files)
+                if stored_signatures.get((subject, session)) == signature:
+                    continue
+
+                connection.execute("DELETE FROM files WHERE subject = ? AND session = ?", (subject, session))
+                connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                       [_get_index_row(sub_id, ses_id, session_file)
+                                        for session_file in session_files])
+                connection.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (subject, session, signature))
+                num_updated += 1
+    finally:
+        connection.close()
+
+    return num_updated
+
+def _get_index_row(sub_id, ses_id, session_file):
+    entities = parse_bids_name(session_file["bids_name"])
+    return ("/".join([sub_id, ses_id, session_file["filename"]]),
+            sub_id[len("sub-"):],
+            ses_id[len("ses-"):],
+            session_file["datatype"],
+            session_file["scan_type"],
+            entities["task"],
+            entities["run"],
+            entities["scan_name"],
+            session_file["bids_name"],
+            session_file["extension"],
+            session_file["size"])
+
+def _get_extension(filename):
+    for extension in CONVERTED_EXTENSIONS:
+        if filename.endswith(extension):
+            return extension
+    return None
+
+def _scandir(path):
+    try:
+        with os.scandir(path) as entries:
+            return sorted(entries, key=lambda entry: entry.name)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
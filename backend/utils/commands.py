@@ -0,0 +1,160 @@
+import collections
+import concurrent.futures
+import os
+import shlex
+import signal
+import subprocess
+import threading
+import time
+
+# Running Commands
+# ----------------------------------------------------------------------------------------------------------------------
+
+KILL_DRAIN_SECONDS = 5  # after a timeout, wait at most this long for the rest of the output
+
+class CommandResult():
+    """
+    Result of run_command().
+
+    argv:           the command that was run
+    returncode:     process return code (None if the process could not be started)
+    duration:       wall time in seconds
+    timed_out:      True if the process was killed after the timeout
+    output_tail:    the last lines of stdout / stderr (stderr lines are prefixed "[stderr]")
+    """
+    def __init__(self, argv, returncode, duration, timed_out, output_tail):
+        self.argv = argv
+        self.returncode = returncode
+        self.duration = duration
+        self.timed_out = timed_out
+        self.output_tail = output_tail
+
+    def succeeded(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def __repr__(self):
+        return "CommandResult({0}, returncode={1}, duration={2:.2f}s)".format(shlex.join(self.argv),
+                                                                             self.returncode,
+                                                                             self.duration)
+
+
+class CommandLog():
+    """
+    A single open, buffered log file that many commands (running in parallel
+    threads) write to. Lines are written whole under a lock so output of
+    different commands is not interleaved mid-line.
+
+    Use as a context manager:
+        with CommandLog(log_filepath) as command_log:
+            run_command(argv, command_log=command_log)
+    """
+    def __init__(self, log_filepath, mode="a"):
+        self._file = open(log_filepath, mode, buffering=1024 * 1024)
+        self._lock = threading.Lock()
+
+    def write_line(self, line):
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def run_command(argv, command_log=None, timeout=None, echo=False, cwd=None, env=None, tail_length=50):
+    """
+    Run a command without a shell and drain stdout and stderr on background threads
+    so neither pipe can fill and block the process.
+
+    argv:           list of arguments e.g. ["cp", "a", "b"]. A str is split with shlex.
+    command_log:    CommandLog to write all output to (or None)
+    timeout:        seconds before the process is killed (or None)
+    echo:           also print output lines
+
+    The command runs in its own process group, so on timeout its child processes (e.g. the
+    pigz of dcm2niix or the binaries recon-all starts), which hold the pipes open, are killed too.
+    """
+    if type(argv) == str:
+        argv = shlex.split(argv)
+
+    output_tail = collections.deque(maxlen=tail_length)
+    start_time = time.monotonic()
+
+    try:
+        process = subprocess.Popen(argv,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   cwd=cwd,
+                                   env=env,
+                                   start_new_session=True)
+    except OSError as error:
+        output_tail.append("[stderr] " + str(error))
+        if command_log:
+            command_log.write_line("$ " + shlex.join(argv) + "\n[stderr] " + str(error))
+        return CommandResult(argv, None, time.monotonic() - start_time, False, list(output_tail))
+
+    log_prefix = "[{0}] ".format(process.pid)  # lines of commands running in parallel can interleave
+    if command_log:
+        command_log.write_line(log_prefix + "$ " + shlex.join(argv))
+
+    drain_threads = [threading.Thread(target=_drain_pipe,
+                                      args=(pipe, prefix, log_prefix, command_log, output_tail, echo),
+                                      daemon=True)
+                     for pipe, prefix in [[process.stdout, ""], [process.stderr, "[stderr] "]]]
+    for thread in drain_threads:
+        thread.start()
+
+    timed_out = False
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill_process_group(process)
+        timed_out = True
+    except BaseException:  # e.g. KeyboardInterrupt, the process group does not get the terminal's SIGINT
+        _kill_process_group(process)
+        raise
+
+    for thread in drain_threads:
+        thread.join(timeout=KILL_DRAIN_SECONDS if timed_out else None)  # daemon threads, left if a process
+                                                                         # outside the group holds a pipe
+
+    duration = time.monotonic() - start_time
+
+    if command_log:
+        command_log.write_line(log_prefix + "# return code {0}{1} after {2:.2f} s".format(process.returncode,
+                                                                                         " (timed out)" if timed_out else "",
+                                                                                         duration))
+
+    return CommandResult(argv, process.returncode, duration, timed_out, list(output_tail))
+
+def run_commands(list_of_argv, max_workers, command_log=None, timeout=None, echo=False):
+    """
+    Run many commands at once on a thread pool (each command is its own process).
+    Return list of CommandResult in the same order as list_of_argv.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(run_command, argv, command_log, timeout, echo) for argv in list_of_argv]
+        return [future.result() for future in futures]
+
+def _kill_process_group(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass  # the group has already exited
+    process.wait()
+
+def _drain_pipe(pipe, prefix, log_prefix, command_log, output_tail, echo):
+    with pipe:
+        for line in iter(pipe.readline, b""):
+            line = prefix + line.decode("utf-8", "replace").rstrip()
+            output_tail.append(line)
+            if command_log:
+                command_log.write_line(log_prefix + line)
+            if echo:
+                print(line)
@@ -0,0 +1,75 @@
+import functools
+
+# Run exclusion flags in the participant log
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# Each entry in the "flags" list of a scan excludes runs from staging:
+#
+#   ignore_<scan_type>_<runs>               e.g. ignore_func_2     all scans of the type
+#   ignore_<scan_type>-<scan_name>_<runs>   e.g. ignore_func-fleet_mb_1-3
+#
+# runs is a run number, a range or a comma separated list of both e.g. "2", "002", "1-3", "1,4-5".
+# Runs are numbered from 1 in raw_scans order for each scan name, before re-indexing.
+#
+# The flags of a scan are parsed once into an exclusion table
+#   {scan_type: {scan_name or None: frozenset(run numbers)}}
+# where None holds the runs excluded for every scan name of the type.
+
+class FlagError(ValueError):
+    pass
+
+
+def get_exclusion_table(flags, scan_types):
+    """
+    Return the exclusion table for a list of flags. Tables are cached by flag list
+    so must not be changed. Raise FlagError if a flag cannot be parsed.
+    """
+    return _get_exclusion_table(tuple(flags), tuple(scan_types))
+
+@functools.lru_cache(maxsize=None)
+def _get_exclusion_table(flags, scan_types):
+    table = {}
+    for flag in flags:
+        scan_type, scan_name, runs = parse_flag(flag, scan_types)
+        scan_type_table = table.setdefault(scan_type, {})
+        scan_type_table[scan_name] = scan_type_table.get(scan_name, frozenset()) | runs
+    return table
+
+def parse_flag(flag, scan_types):
+    """
+    Return (scan_type, scan_name or None, frozenset of run numbers) for a single flag.
+    The run list follows the last "_" so scan names may contain "_".
+    """
+    if not isinstance(flag, str) or not flag.startswith("ignore_"):
+        raise FlagError("flag '{0}' does not start with 'ignore_'".format(flag))
+
+    target, __, runs_str = flag[len("ignore_"):].rpartition("_")
+    scan_type, __, scan_name = target.partition("-")
+
+    if scan_type not in scan_types:
+        raise FlagError("flag '{0}' scan type '{1}' is not one of {2}".format(flag, scan_type, list(scan_types)))
+
+    return scan_type, scan_name or None, parse_runs(runs_str, flag)
+
+def parse_runs(runs_str, flag=""):
+    """
+    Parse "2", "002", "1-3" or "1,4-5" to a frozenset of run numbers
+    """
+    runs = set()
+    for part in runs_str.split(","):
+        first, separator, last = part.strip().partition("-")
+        if not first.isdigit() or (separator and not last.isdigit()):
+            raise FlagError("flag '{0}' runs '{1}' are not run numbers or ranges e.g. 2, 1-3, 1,4".format(flag,
+                                                                                                           runs_str))
+        first, last = int(first), int(last or first)
+        if first < 1 or last < first:
+            raise FlagError("flag '{0}' run range '{1}' is not valid (runs start at 1)".format(flag, part))
+        runs.update(range(first, last + 1))
+
+    return frozenset(runs)
+
+def run_is_excluded(exclusion_table, scan_type, scan_name, run_number):
+    scan_type_table = exclusion_table.get(scan_type)
+    if not scan_type_table:
+        return False
+    return run_number in scan_type_table.get(None, ()) or run_number in scan_type_table.get(scan_name, ())
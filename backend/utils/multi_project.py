@@ -0,0 +1,153 @@
+import os
+import re
+import sys
+import datetime
+import importlib.util
+from backend.utils import admission
+from backend.utils import scheduler
+from backend.utils import work_graph
+
+# Running several projects in one process
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# Each study has its own config file (a copy of project_configs.py with a Project class). To run
+# several studies within one resource budget (see run_projects.py) their work graphs are combined
+# into one graph run by a single PipelineScheduler, so all projects share:
+#
+#   worker pools:    the scheduler pools, sized by the first project (or -jobs). When a worker
+#                    is free the project with the fewest tasks running on that pool goes next.
+#   SSH pool:        projects with the same HPC account share one pool of SSH connections.
+#   disk space:      one AdmissionController (see admission.py). Volumes are mount points,
+#                    so projects on the same ZFS dataset share its free space and I/O budget.
+#
+# Combined task ids are "<project name>/<task_id>", the project name is the config file name.
+
+def load_projects(config_filepaths):
+    """
+    Import each config file and return dict {project name: Project()} in the given order
+    """
+    projects = {}
+    for config_filepath in config_filepaths:
+        name = os.path.splitext(os.path.basename(config_filepath))[0]
+        assert name not in projects, "Two project configs are named {0}, rename one".format(name)
+        projects[name] = load_project(config_filepath)
+    return projects
+
+def load_project(config_filepath):
+    module_name = "project_config_" + re.sub(r"\W", "_", os.path.splitext(os.path.basename(config_filepath))[0])
+
+    spec = importlib.util.spec_from_file_location(module_name, os.path.abspath(config_filepath))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module  # so ProjectMaster can find its config file (see watch_project())
+    spec.loader.exec_module(module)
+
+    assert hasattr(module, "Project"), "{0} does not define a Project class, " \
+                                       "see project_configs.py".format(config_filepath)
+    return module.Project()
+
+def share_ssh_pools(projects):
+    """
+    Give projects with the same HPC account one SSH connection pool
+    """
+    ssh_pools = {}
+    for project in projects.values():
+        if project.account in ssh_pools:
+            project.ssh_pool = ssh_pools[project.account]
+        else:
+            ssh_pools[project.account] = project.get_ssh_pool()
+
+def combine_work_graphs(graphs):
+    """
+    graphs: dict {project name: WorkGraph from plan_work()}
+
+    Return a single WorkGraph with a task "<name>/<task_id>" for every task. Its kwargs hold the
+    project name and the original task (see run_combined_task()).
+    """
+    combined_graph = work_graph.WorkGraph()
+    for name, graph in graphs.items():
+        for task in graph.topological_order():
+            combined_graph.add_task(work_graph.Task(get_combined_task_id(name, task.task_id),
+                                                    task.kind,
+                                                    get_combined_task_id(name, task.session_key),
+                                                    {"project_name": name, "task": task},
+                                                    dependencies=[get_combined_task_id(name, dependency)
+                                                                  for dependency in task.dependencies],
+                                                    estimated_bytes=task.estimated_bytes,
+                                                    estimated_seconds=task.estimated_seconds))
+    return combined_graph
+
+def get_combined_task_id(name, task_id):
+    return "{0}/{1}".format(name, task_id)
+
+def run_combined_task(projects, task):
+    return projects[task.kwargs["project_name"]].run_task(task.kwargs["task"])
+
+def make_admission_controller(projects):
+    """
+    One AdmissionController for all projects, using the limits of the first project.
+    None if the first project has admission_control off.
+    """
+    first_project = list(projects.values())[0]
+    if not first_project.admission_control:
+        return None
+
+    volume_projects = {}  # {volume: a project that writes to it, to measure its free space}
+
+    def get_needed_bytes(task):
+        project = projects[task.kwargs["project_name"]]
+        needed_bytes = project._get_task_needed_bytes(task.kwargs["task"])
+        for volume in needed_bytes:
+            volume_projects.setdefault(volume, project)
+        return needed_bytes
+
+    return admission.AdmissionController(lambda volume: volume_projects[volume]._get_volume_free_bytes(volume),
+                                         get_needed_bytes,
+                                         safety_margin_bytes=first_project.admission_safety_margin_bytes,
+                                         io_budget_bytes=first_project.admission_io_budget_bytes)
+
+def plan_projects(projects, download=True, stage=True, convert=True, recon=False):
+    """
+    Plan the selected stages for every project (see ProjectMaster.plan_work()) without
+    touching any data. Return the combined WorkGraph.
+    """
+    return combine_work_graphs({name: project.plan_work(download=download, stage=stage, convert=convert, recon=recon)
+                                for name, project in projects.items()})
+
+def run_projects(projects, combined_graph, max_jobs=None):
+    """
+    Run a graph from plan_projects() with one scheduler for all projects. max_jobs sets every
+    worker pool size (and each project's conversion workers, as -jobs in run_project.py).
+    Return dict {combined task_id: "done" / "failed" / "skipped"}
+    """
+    for project in projects.values():
+        if max_jobs:
+            project._set_max_jobs(max_jobs)
+        if not project.is_initialised():
+            project.init_project_directory_tree()
+        project.init_logging(datetime.date.today().strftime("%Y%m%d"), "run_projects",
+                             logging_path=project.logs_path, log_filename="run_projects.log")
+
+    share_ssh_pools(projects)
+
+    first_project = list(projects.values())[0]
+    pipeline_scheduler = scheduler.PipelineScheduler(lambda task: run_combined_task(projects, task),
+                                                     first_project.get_scheduler_pool_sizes(),
+                                                     first_project.scheduler_task_kind_pools,
+                                                     log_func=lambda title, message: _log(projects, title, message),
+                                                     admission_controller=make_admission_controller(projects),
+                                                     admission_retry_seconds=first_project.admission_retry_seconds,
+                                                     admission_max_wait_seconds=first_project.admission_max_wait_seconds,
+                                                     get_task_group_func=lambda task: task.kwargs["project_name"])
+    try:
+        return pipeline_scheduler.run(combined_graph)
+    finally:
+        for project in projects.values():
+            project.close_ssh_pool()  # shared pools are closed more than once, which does nothing
+
+def _log(projects, title, message):
+    """
+    Scheduler messages start with the combined task id, log them to its project
+    """
+    name = message.split("/", 1)[0]
+    if name in projects:
+        projects[name].log(title, message)
@@ -0,0 +1,160 @@
+import os
+import json
+from backend.analysis import freesurfer
+
+# Project status from a single scan of the project tree
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# raw_scans and preprocessing are each walked once with os.scandir (no glob, no repeated
+# stat of the same path) and the result is joined against the participant log in
+# ProjectMaster.get_project_status(). Formatters here turn the per-session rows into a
+# printable matrix, TSV or JSON.
+
+def scan_raw_scans(raw_scans_path):
+    """
+    Return {zk_id: {"downloaded": bool, "archived": bool, "pruned": bool}} for every
+    folder in raw_scans. See archive.py for the archive layout.
+    """
+    result = {}
+    for zk_entry in _scandir_dirs(raw_scans_path):
+        names = set(entry.name for entry in _scandir(zk_entry.path))
+        archived = zk_entry.name + ".tar.zst" in names
+        result[zk_entry.name] = {"downloaded": True,
+                                 "archived": archived,
+                                 "pruned": archived and zk_entry.name not in names}
+    return result
+
+def scan_preprocessing(preprocessing_path):
+    """
+    Return {sub_id: {ses_id: {scan_type: runs}}} where runs is {bids_name: run} and run is
+    {"num_files": int, "converted": bool, "recon_stages": list or None}.
+
+    converted: .nii / .nii.gz in nii/<bids_name>, or the consolidated mrs/npy/<bids_name>.npy
+    recon_stages: finished recon-all stages for anat runs (see freesurfer.get_finished_stages())
+    """
+    result = {}
+    for sub_entry in _scandir_dirs(preprocessing_path, "sub-"):
+        for ses_entry in _scandir_dirs(sub_entry.path, "ses-"):
+            result.setdefault(sub_entry.name, {})[ses_entry.name] = sessions_runs = {}
+
+            for scan_type_entry in _scandir_dirs(ses_entry.path):
+                runs = {}
+                for run_entry in _scandir_dirs(os.path.join(scan_type_entry.path, "raw")):
+                    runs[run_entry.name] = {"num_files": sum(1 for entry in _scandir(run_entry.path) if entry.is_file()),
+                                            "converted": False,
+                                            "recon_stages": None}
+
+                for run_entry in _scandir_dirs(os.path.join(scan_type_entry.path, "nii")):
+                    if run_entry.name not in runs:
+                        continue
+                    nii_entries = _scandir(run_entry.path)
+                    runs[run_entry.name]["converted"] = any(entry.name.endswith((".nii", ".nii.gz"))
+                                                            for entry in nii_entries)
+                    if any(entry.name == sub_entry.name and entry.is_dir() for entry in nii_entries) and \
+                            freesurfer.is_finished(run_entry.path, sub_entry.name):  # subjects_dir was in nii/
+                        runs[run_entry.name]["recon_stages"] = list(freesurfer.AUTORECON_STAGES)
+
+                for entry in _scandir(os.path.join(scan_type_entry.path, "npy")):
+                    if entry.name.endswith(".npy") and entry.name[:-4] in runs:
+                        runs[entry.name[:-4]]["converted"] = True
+
+                freesurfer_path = os.path.join(scan_type_entry.path, "freesurfer")
+                for subject_entry in _scandir_dirs(freesurfer_path):
+                    if subject_entry.name in runs:
+                        runs[subject_entry.name]["recon_stages"] = freesurfer.get_finished_stages(freesurfer_path,
+                                                                                                  subject_entry.name)
+                if runs:
+                    sessions_runs[scan_type_entry.name] = runs
+    return result
+
+def _scandir(path):
+    try:
+        with os.scandir(path) as entries:
+            return list(entries)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+def _scandir_dirs(path, prefix=""):
+    """
+    Sub directories in name order. Hidden dirs (e.g. runs being staged) are skipped.
+    """
+    return sorted((entry for entry in _scandir(path)
+                   if entry.is_dir() and entry.name.startswith(prefix) and not entry.name.startswith(".")),
+                  key=lambda entry: entry.name)
+
+# Formatting -----------------------------------------------------------------------------------------------------------
+
+def get_scan_type_summary(runs, num_expected_files):
+    """
+    Summarise the runs of one scan type in a session
+    """
+    return {"runs": len(runs),
+            "runs_with_expected_files": sum(1 for run in runs.values()
+                                            if not num_expected_files or run["num_files"] == num_expected_files),
+            "converted": sum(1 for run in runs.values() if run["converted"]),
+            "recon_finished": sum(1 for run in runs.values()
+                                  if run["recon_stages"] == freesurfer.AUTORECON_STAGES),
+            "recon_started": sum(1 for run in runs.values() if run["recon_stages"] is not None)}
+
+def format_status_table(rows, scan_types):
+    """
+    Print one line per session. Scan type cells are "<runs staged>/<runs converted>", with "!"
+    if any run does not have num_expected_*_files and "-" if not staged. recon is
+    "<finished>/<anat runs>" with "+" if recon-all was started but not finished for a run.
+    """
+    header = ["sub_id", "ses_id", "zk_id", "date", "raw"] + scan_types + ["recon"]
+    lines = [header]
+
+    for row in rows:
+        raw_cell = "-"
+        if row["downloaded"]:
+            raw_cell = "pruned" if row["pruned"] else "archived" if row["archived"] else "yes"
+
+        line = [row["sub_id"], row["ses_id"], row["zk_id"], row["date"], raw_cell]
+        for scan_type in scan_types:
+            summary = row["scan_types"].get(scan_type)
+            if not summary or not summary["runs"]:
+                line.append("-")
+                continue
+            line.append("{0}/{1}{2}".format(summary["runs"],
+                                             summary["converted"],
+                                             "!" if summary["runs_with_expected_files"] != summary["runs"] else ""))
+
+        anat_summary = row["scan_types"].get("anat")
+        if not anat_summary or not anat_summary["runs"]:
+            line.append("-")
+        else:
+            line.append("{0}/{1}{2}".format(anat_summary["recon_finished"],
+                                             anat_summary["runs"],
+                                             "+" if anat_summary["recon_started"] > anat_summary["recon_finished"] else ""))
+        lines.append(line)
+
+    widths = [max(len(str(line[idx])) for line in lines) for idx in range(len(header))]
+    table = ["  ".join(str(cell).ljust(width) for cell, width in zip(line, widths)).rstrip() for line in lines]
+
+    table.append("")
+    table.append("scan types: runs staged / runs converted (! some runs do not have the expected number of files)")
+    table.append("recon: runs finished / anat runs (+ recon-all started but not finished)")
+    return "\n".join(table)
+
+def format_status_tsv(rows, scan_types):
+    """
+    One line per session, with a column for each summary value of each scan type e.g. anat_runs
+    (recon columns for anat only)
+    """
+    columns = []
+    for scan_type in scan_types:
+        for key in ["runs", "runs_with_expected_files", "converted"] + \
+                   (["recon_finished", "recon_started"] if scan_type == "anat" else []):
+            columns.append([scan_type, key])
+
+    session_keys = ["sub_id", "ses_id", "zk_id", "date", "downloaded", "archived", "pruned"]
+    lines = ["\t".join(session_keys + ["{0}_{1}".format(scan_type, key) for scan_type, key in columns])]
+    for row in rows:
+        line = [row[key] for key in session_keys]
+        line += [row["scan_types"].get(scan_type, {}).get(key, 0) for scan_type, key in columns]
+        lines.append("\t".join(str(cell) for cell in line))
+    return "\n".join(lines) + "\n"
+
+def format_status_json(rows):
+    return json.dumps(rows, indent=4)
@@ -0,0 +1,108 @@
+import re
+import fnmatch
+import collections
+
+# Scan type registry
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# Every scan type of a project (mrs, func, anat ... or a new modality) is described once by a
+# ScanType, built from the project config on first use (see ProjectMaster.get_scan_types()):
+#
+#   <type>_scan_details          {scan_name: {"search_str": ..., "task_name": ...}}, None if not collected
+#   num_expected_<type>_files    files expected in each run, None to not check
+#   scan_type_settings           optional {type: {setting: value}} overriding SCAN_TYPE_SETTINGS
+#
+# Settings:
+#
+#   datatype:    BIDS datatype (folder) of the converted runs
+#   converter:   "dcm2niix", "mrs" (spectra consolidated to npy/, see run_mrs_consolidation()) or None
+#   qc:          "func" (tSNR and spikes) or "snr" metrics (see backend/analysis/qc.py) or None
+#   recon:       run recon-all on the converted runs
+#
+# Types are discovered from the *_scan_details attributes, so adding a modality only needs
+# e.g. dwi_scan_details (and num_expected_dwi_files) in project_configs.py. Types not in
+# SCAN_TYPE_SETTINGS are converted with dcm2niix into a datatype of the same name.
+
+SCAN_TYPE_SETTINGS = collections.OrderedDict([
+    ["mrs", {"datatype": "mrs", "converter": "mrs", "qc": None, "recon": False}],
+    ["func", {"datatype": "func", "converter": "dcm2niix", "qc": "func", "recon": False}],
+    ["anat", {"datatype": "anat", "converter": "dcm2niix", "qc": "snr", "recon": True}],
+    ["mpm", {"datatype": "anat", "converter": None, "qc": None, "recon": False}],
+    ["b0", {"datatype": "fmap", "converter": "dcm2niix", "qc": "snr", "recon": False}],
+    ["b1", {"datatype": "fmap", "converter": "dcm2niix", "qc": "snr", "recon": False}],
+])
+
+DEFAULT_SETTINGS = {"converter": "dcm2niix", "qc": None, "recon": False}
+
+
+class ScanType():
+    """
+    name:                scan type e.g. "func", the preprocessing folder name
+    scan_details:        the <type>_scan_details of the project (None if not collected)
+    num_expected_files:  files expected in each run (None to not check)
+    datatype, converter, qc, recon:  see the settings above
+
+    search_patterns:     {scan_name: compiled regex of its search_str}, matched against the
+                         names in raw_scans/zk_id/zk_id (see get_matching_names())
+    task_names:          {scan_name: task_name}
+    """
+    def __init__(self, name, scan_details, num_expected_files, datatype, converter, qc, recon):
+        self.name = name
+        self.scan_details = scan_details
+        self.num_expected_files = num_expected_files
+        self.datatype = datatype
+        self.converter = converter
+        self.qc = qc
+        self.recon = recon
+
+        self.scan_names = list(scan_details.keys()) if scan_details else []
+        self.task_names = {scan_name: scan_details[scan_name]["task_name"] for scan_name in self.scan_names}
+        self.search_patterns = {scan_name: _compile_search_str(scan_details[scan_name]["search_str"])
+                                for scan_name in self.scan_names}
+
+    def is_collected(self):
+        return bool(self.scan_details)
+
+    def get_matching_names(self, scan_name, names):
+        """
+        Names (sorted) in names that match the search_str of scan_name, as glob.glob would
+        """
+        pattern, match_hidden = self.search_patterns[scan_name]
+        return [name for name in names if (match_hidden or not name.startswith(".")) and pattern.match(name)]
+
+    def __repr__(self):
+        return "ScanType({0})".format(self.name)
+
+
+def build_registry(project):
+    """
+    Return OrderedDict {name: ScanType} for the built-in types (in SCAN_TYPE_SETTINGS order, the order
+    runs are staged in) then any other <type>_scan_details attribute of the project in name order.
+    """
+    discovered_names = sorted(attribute[:-len("_scan_details")] for attribute in vars(project)
+                              if attribute.endswith("_scan_details") and attribute != "_scan_details")
+    names = list(SCAN_TYPE_SETTINGS.keys()) + [name for name in discovered_names if name not in SCAN_TYPE_SETTINGS]
+
+    overrides = getattr(project, "scan_type_settings", None) or {}
+    for name in overrides:
+        assert name in names, "scan_type_settings: {0} has no {0}_scan_details".format(name)
+
+    registry = collections.OrderedDict()
+    for name in names:
+        settings = dict(DEFAULT_SETTINGS, datatype=name)
+        settings.update(SCAN_TYPE_SETTINGS.get(name, {}))
+        settings.update(overrides.get(name, {}))
+
+        registry[name] = ScanType(name,
+                                  getattr(project, name + "_scan_details", None),
+                                  getattr(project, "num_expected_{0}_files".format(name), None),
+                                  **settings)
+    return registry
+
+def _compile_search_str(search_str):
+    """
+    Return (compiled regex, match hidden names) for a glob.glob pattern of a single path component
+    """
+    assert "/" not in search_str, "search_str {0} must match names in raw_scans/zk_id/zk_id, " \
+                                  "not paths".format(search_str)
+    return re.compile(fnmatch.translate(search_str)), search_str.startswith(".")
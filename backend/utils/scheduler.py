@@ -0,0 +1,208 @@
+import time
+import collections
+import concurrent.futures
+import traceback
+
+# Pipeline Scheduler - run a WorkGraph with per-stage worker pools
+# ----------------------------------------------------------------------------------------------------------------------
+
+class PipelineScheduler():
+    """
+    Run all tasks of a WorkGraph (see work_graph.py) as soon as their dependencies are done.
+    Each task kind is mapped to a named worker pool (e.g. "network", "disk", "cpu") so that
+    a download for one session, a copy for another and a dcm2niix conversion for a third
+    all run at the same time.
+
+    run_task_func:      function(task) that returns True if the task succeeded
+    pool_sizes:         dict {pool_name: num_workers}
+    task_kind_pools:    dict {task.kind: pool_name}. Kinds not in the dict use the first pool.
+    log_func:           function(title, message) called on task failure
+
+    admission_controller:         optional admission.AdmissionController. Ready tasks are queued
+                                  until it admits them (enough disk space and I/O budget) and
+                                  their reservation is released when they finish.
+    admission_retry_seconds:      interval to retry queued tasks while no running task finishes
+    admission_max_wait_seconds:   queued tasks not admitted within this time fail (None to wait
+                                  indefinitely)
+    get_task_group_func:          optional function(task) that returns the group of the task (e.g. the
+                                  project, see multi_project.py). When a worker is free the ready task of
+                                  the group with the fewest tasks running on that pool goes first, so one
+                                  group with a large backlog cannot hold up the others.
+
+    Ready tasks are kept by the scheduler and only handed to a pool when it has a free worker,
+    in the order they became ready (within the fairness order above).
+
+    If a task fails (returns False or raises) all of its dependents are skipped. Tasks
+    only depend on tasks of the same session, so a failure never stops other sessions.
+    """
+    def __init__(self, run_task_func, pool_sizes, task_kind_pools, log_func=None, admission_controller=None,
+                 admission_retry_seconds=30, admission_max_wait_seconds=None, get_task_group_func=None):
+        self.run_task_func = run_task_func
+        self.pool_sizes = pool_sizes
+        self.task_kind_pools = task_kind_pools
+        self.log_func = log_func
+        self.admission_controller = admission_controller
+        self.admission_retry_seconds = admission_retry_seconds
+        self.admission_max_wait_seconds = admission_max_wait_seconds
+        self.get_task_group_func = get_task_group_func
+
+    def run(self, graph):
+        """
+        Return dict {task_id: "done" / "failed" / "skipped"}
+        """
+        status = {}
+        num_waiting_on = {task.task_id: len(task.dependencies) for task in graph.get_all_tasks()}
+
+        pools = {name: concurrent.futures.ThreadPoolExecutor(max_workers=size,
+                                                             thread_name_prefix=name)
+                 for name, size in self.pool_sizes.items()}
+        running = {}
+        ready = {name: collections.OrderedDict() for name in self.pool_sizes}  # {pool_name: {group: [tasks]}}
+        ready_since = {}     # {task_id: time it became ready}
+        num_running = {}     # {(pool_name, group): number of running tasks}
+        num_started = {}     # {(pool_name, group): number of tasks started}, breaks ties between groups
+        reported_ids = set()
+
+        def submit(task):
+            ready[self._get_pool_name(task)].setdefault(self._get_group(task), []).append(task)
+            ready_since[task.task_id] = time.monotonic()
+
+        def start(task):
+            key = (self._get_pool_name(task), self._get_group(task))
+            num_running[key] = num_running.get(key, 0) + 1
+            num_started[key] = num_started.get(key, 0) + 1
+            future = pools[key[0]].submit(self._run_task_safely, task)
+            running[future] = task
+
+        def fail(task):
+            status[task.task_id] = "failed"
+            for dependent_id in graph.get_all_dependents(task.task_id):
+                status[dependent_id] = "skipped"
+
+        def dispatch():
+            """
+            Start ready tasks while their pools have free workers, taking the next task from the
+            group with the fewest running (then started) tasks on the pool. Return True if a task is
+            waiting for admission (so must be retried even if no running task finishes).
+            """
+            waiting_for_admission = False
+            for pool_name, groups in ready.items():
+                num_busy = sum(count for (name, __), count in num_running.items() if name == pool_name)
+                blocked_groups = set()
+
+                while num_busy < self.pool_sizes[pool_name]:
+                    groups_to_start = [group for group, tasks in groups.items()
+                                       if tasks and group not in blocked_groups]
+                    if not groups_to_start:
+                        break
+
+                    group = min(groups_to_start, key=lambda group: (num_running.get((pool_name, group), 0),
+                                                                     num_started.get((pool_name, group), 0)))
+                    task = pop_admitted(groups[group])
+                    if task is None:
+                        blocked_groups.add(group)
+                        waiting_for_admission = waiting_for_admission or bool(groups[group])
+                        continue
+
+                    start(task)
+                    num_busy += 1
+
+            return waiting_for_admission
+
+        def pop_admitted(tasks):
+            """
+            Remove and return the first task in tasks that is admitted (see admission_controller),
+            None if none are.
+            """
+            for task in list(tasks):
+                if self.admission_controller is None or self.admission_controller.try_admit(task):
+                    tasks.remove(task)
+                    return task
+                if not_admitted(task):
+                    tasks.remove(task)
+            return None
+
+        def not_admitted(task):
+            """
+            Log a task that is not admitted, fail it if it has waited too long. Return True if it failed.
+            """
+            waited_seconds = time.monotonic() - ready_since[task.task_id]
+            timed_out = self.admission_max_wait_seconds is not None and \
+                waited_seconds > self.admission_max_wait_seconds
+
+            if task.task_id not in reported_ids or timed_out:
+                reported_ids.add(task.task_id)
+                shortfall = self.admission_controller.get_shortfall(
+                    self.admission_controller.get_needed_bytes_func(task))
+                self._log("TASK NOT ADMITTED" if timed_out else "TASK QUEUED",
+                          "{0} {1} {2}".format(task.task_id,
+                                               "failed after waiting {0:.0f} s for".format(waited_seconds)
+                                               if timed_out else "waiting for",
+                                               shortfall))
+            if timed_out:
+                fail(task)
+            return timed_out
+
+        def num_ready():
+            return sum(len(tasks) for groups in ready.values() for tasks in groups.values())
+
+        try:
+            for task in graph.get_all_tasks():
+                if num_waiting_on[task.task_id] == 0:
+                    submit(task)
+
+            while running or num_ready():
+                waiting_for_admission = dispatch()
+
+                if not running:
+                    if num_ready():
+                        time.sleep(self.admission_retry_seconds)  # waiting on space freed outside the scheduler
+                    continue
+
+                finished, __ = concurrent.futures.wait(running,
+                                                       timeout=self.admission_retry_seconds
+                                                       if waiting_for_admission else None,
+                                                       return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    num_running[(self._get_pool_name(task), self._get_group(task))] -= 1
+                    if self.admission_controller is not None:
+                        self.admission_controller.release(task)
+
+                    if future.result():
+                        status[task.task_id] = "done"
+
+                        for dependent_id in graph.get_dependents(task.task_id):
+                            num_waiting_on[dependent_id] -= 1
+                            if num_waiting_on[dependent_id] == 0 and dependent_id not in status:
+                                submit(graph.get_task(dependent_id))
+                    else:
+                        fail(task)
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=True)
+
+        return status
+
+    def _get_group(self, task):
+        if self.get_task_group_func is None:
+            return None
+        return self.get_task_group_func(task)
+
+    def _get_pool_name(self, task):
+        if task.kind in self.task_kind_pools:
+            return self.task_kind_pools[task.kind]
+        return list(self.pool_sizes.keys())[0]
+
+    def _run_task_safely(self, task):
+        try:
+            return bool(self.run_task_func(task))
+        except Exception:
+            self._log("TASK FAILED",
+                      "{0} failed with error:\n{1}".format(task.task_id,
+                                                          traceback.format_exc()))
+            return False
+
+    def _log(self, title, message):
+        if self.log_func:
+            self.log_func(title, message)
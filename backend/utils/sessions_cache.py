@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import datetime
+
+# Persistent cache of the sub / ses structure of preprocessing
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# The sub / ses order tests (ProjectMaster.run_scan_sub_order_tests()) run at the end of every
+# run_project.py call and need every sub-XXX/ses-XXX dir and the scan datetime in each
+# ses-XXX_info.txt. The cache (docs/preprocessing_sessions_cache.json) holds them with the mtimes
+# they were read at:
+#
+#   {"version": 1,
+#    "mtime_ns": mtime of preprocessing (changes when a sub dir is added / removed),
+#    "subjects": {sub: {"mtime_ns": mtime of the sub dir (changes when a ses dir is added / removed),
+#                       "sessions": {ses: {"info_mtime_ns": ..., "info_size": ..., "datetime": iso or None}}}}}
+#
+# On update only dirs whose mtime changed are listed again and only info files whose mtime or
+# size changed are read again, so with nothing changed an update is one stat per subject and
+# per session. The cache is kept outside preprocessing so writing it does not change the mtime
+# of preprocessing. A dir or info file changed within MTIME_GRANULARITY_SECONDS of now could
+# change again without its mtime changing, so its mtime is not cached and it is read again on
+# the next update (as ProjectMaster._get_raw_series_names()).
+
+CACHE_VERSION = 1
+MTIME_GRANULARITY_SECONDS = 2
+
+
+def load_cache(cache_filepath):
+    """
+    Return the saved cache, or an empty cache if there is none or it cannot be read
+    """
+    try:
+        with open(cache_filepath, "r") as file:
+            cache = json.load(file)
+        if cache.get("version") == CACHE_VERSION:
+            return cache
+    except (OSError, ValueError):
+        pass
+    return {"version": CACHE_VERSION, "mtime_ns": None, "subjects": {}}
+
+def save_cache(cache_filepath, cache):
+    with open(cache_filepath + ".partial", "w") as file:
+        json.dump(cache, file)
+    os.replace(cache_filepath + ".partial", cache_filepath)
+
+def update_cache(cache, preprocessing_path, read_datetime_func):
+    """
+    Bring the cache up to date with preprocessing_path. read_datetime_func(info_filepath) returns
+    the scan datetime of a ses-XXX_info.txt. Return True if anything changed.
+    """
+    mtime_ns = _get_mtime_ns(preprocessing_path)
+    if mtime_ns is None:
+        changed = bool(cache["subjects"])
+        cache["mtime_ns"], cache["subjects"] = None, {}
+        return changed
+
+    changed = False
+    if mtime_ns != cache["mtime_ns"]:
+        sub_ids = [name for name in os.listdir(preprocessing_path) if name.startswith("sub")]  # as glob "sub*"
+        cache["subjects"] = {sub_id: cache["subjects"].get(sub_id, {"mtime_ns": None, "sessions": {}})
+                             for sub_id in sub_ids}
+        cache["mtime_ns"] = _get_settled_mtime_ns(mtime_ns)
+        changed = True
+
+    for sub_id, subject in cache["subjects"].items():
+        changed |= _update_subject(subject, os.path.join(preprocessing_path, sub_id), read_datetime_func)
+
+    return changed
+
+def _update_subject(subject, sub_path, read_datetime_func):
+    changed = False
+
+    mtime_ns = _get_mtime_ns(sub_path)
+    if mtime_ns != subject["mtime_ns"]:
+        ses_ids = [name for name in os.listdir(sub_path) if name.startswith("ses-")] \
+            if os.path.isdir(sub_path) else []
+        subject["sessions"] = {ses_id: subject["sessions"].get(ses_id, {"info_mtime_ns": None,
+                                                                        "info_size": None,
+                                                                        "datetime": None})
+                               for ses_id in ses_ids}
+        subject["mtime_ns"] = _get_settled_mtime_ns(mtime_ns)
+        changed = True
+
+    for ses_id, session in subject["sessions"].items():
+        info_filepath = os.path.join(sub_path, ses_id, ses_id + "_info.txt")
+        try:
+            stat = os.stat(info_filepath)
+            info_mtime_ns, info_size = stat.st_mtime_ns, stat.st_size
+        except (FileNotFoundError, NotADirectoryError):
+            info_mtime_ns, info_size = None, None
+
+        if [info_mtime_ns, info_size] == [session["info_mtime_ns"], session["info_size"]]:
+            continue
+
+        session["datetime"] = read_datetime_func(info_filepath).isoformat() if info_mtime_ns is not None else None
+        session["info_mtime_ns"], session["info_size"] = _get_settled_mtime_ns(info_mtime_ns), info_size
+        changed = True
+
+    return changed
+
+def get_subs_and_ses(cache):
+    """
+    Return dict {sub_id: [ses_id, ...]} (sessions in order)
+    """
+    return {sub_id: sorted(subject["sessions"]) for sub_id, subject in cache["subjects"].items()}
+
+def get_session_datetime(cache, sub_id, ses_id):
+    """
+    The scan datetime of the session, None if it has no ses-XXX_info.txt
+    """
+    session = cache["subjects"].get(sub_id, {}).get("sessions", {}).get(ses_id)
+    if not session or session["datetime"] is None:
+        return None
+    return datetime.datetime.fromisoformat(session["datetime"])
+
+def _get_settled_mtime_ns(mtime_ns):
+    """
+    mtime_ns, or None (never equal to a stat, so read again) if it is within the mtime granularity of now
+    """
+    if mtime_ns is None or time.time() - mtime_ns / 1e9 <= MTIME_GRANULARITY_SECONDS:
+        return None
+    return mtime_ns
+
+def _get_mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        return None
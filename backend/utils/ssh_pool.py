@@ -0,0 +1,87 @@
+import threading
+import contextlib
+
+# SSH connection pool
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# Every HPC command (dcmconv.pl, rsync, df) used to open and close its own SSH connection.
+# The pool keeps up to max_connections open connections and lends them out, so concurrent
+# downloads (and several projects with the same account, see backend/utils/multi_project.py)
+# reuse connections and never open more than max_connections at once.
+
+class SSHConnectionPool():
+    """
+    connect_func:     function() that returns a connected paramiko.SSHClient
+    max_connections:  max connections open at once, borrowers wait for a free connection
+
+    e.g.
+        with pool.connection() as client:
+            stdin, stdout, stderr = client.exec_command(command)
+    """
+    def __init__(self, connect_func, max_connections=4):
+        self.connect_func = connect_func
+        self.max_connections = max_connections
+
+        self._condition = threading.Condition()
+        self._idle_clients = []
+        self._num_open = 0
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Lend an open connection (opening one if fewer than max_connections are open). The
+        connection is returned to the pool afterwards, or closed if the block raised.
+        """
+        client = self._acquire()
+        try:
+            yield client
+        except BaseException:
+            self._release(client, discard=True)
+            raise
+        self._release(client)
+
+    def close_all(self):
+        with self._condition:
+            for client in self._idle_clients:
+                client.close()
+            self._num_open -= len(self._idle_clients)
+            self._idle_clients = []
+            self._condition.notify_all()
+
+    def _acquire(self):
+        with self._condition:
+            while True:
+                while self._idle_clients:
+                    client = self._idle_clients.pop()
+                    if _is_active(client):
+                        return client
+                    client.close()
+                    self._num_open -= 1
+
+                if self._num_open < self.max_connections:
+                    self._num_open += 1
+                    break
+
+                self._condition.wait()
+
+        try:
+            return self.connect_func()  # connect outside the lock, it can take seconds
+        except BaseException:
+            with self._condition:
+                self._num_open -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, client, discard=False):
+        with self._condition:
+            if discard or not _is_active(client):
+                client.close()
+                self._num_open -= 1
+            else:
+                self._idle_clients.append(client)
+            self._condition.notify()
+
+
+def _is_active(client):
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
@@ -0,0 +1,252 @@
+import os
+import re
+import json
+import time
+import socket
+import collections
+from backend.utils import work_graph
+
+# File-based distributed task queue
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# A coordinator (ProjectMaster.run_work_graph_distributed()) splits a WorkGraph into one item per
+# session and puts them in a queue dir on the project filesystem shared by all hosts. Workers
+# (run_project.py worker, on any number of hosts) claim items, run the session tasks and put back
+# the status of each task. Every state change is a rename, which is atomic on a single filesystem,
+# so no broker is needed:
+#
+#   pending/<name>.json                  waiting to be claimed. <name> is "<run_id>-<index>"
+#   leased/<name>.json@<worker_id>       claimed by worker_id (the rename that claims it only succeeds
+#                                        for one worker). The worker touches it every heartbeat.
+#   results/<name>.json@<worker_id>      {task_id: "done" / "failed" / "skipped"}, written before
+#   done/<name>.json@<worker_id>         the lease is moved here
+#
+# A lease is expired when its file has not been touched for lease_seconds (the worker died or its
+# host went down). The coordinator moves expired leases out of leased/ (so the worker can no longer
+# complete them) and puts the item back in pending/. Hosts must have roughly the same clock and
+# lease_seconds must be much longer than the heartbeat interval.
+
+PENDING = "pending"
+LEASED = "leased"
+RESULTS = "results"
+DONE = "done"
+TMP = "tmp"
+
+
+class Lease():
+    """
+    An item claimed by a worker. payload is the item as put by the coordinator.
+    """
+    def __init__(self, name, worker_id, payload):
+        self.name = name
+        self.worker_id = worker_id
+        self.payload = payload
+
+    def get_filename(self):
+        return "{0}.json@{1}".format(self.name, self.worker_id)
+
+    def __repr__(self):
+        return "Lease({0}@{1})".format(self.name, self.worker_id)
+
+
+class FileTaskQueue():
+    """
+    queue_path:     dir on the shared filesystem (created if it does not exist)
+    lease_seconds:  a lease not touched for this long is expired (see requeue_expired())
+    """
+    def __init__(self, queue_path, lease_seconds=300):
+        self.queue_path = queue_path
+        self.lease_seconds = lease_seconds
+
+        for subdir in [PENDING, LEASED, RESULTS, DONE, TMP]:
+            os.makedirs(os.path.join(queue_path, subdir), exist_ok=True)
+
+    # Coordinator
+
+    def put(self, name, payload):
+        """
+        Add an item. payload is a JSON serialisable dict, with optional "not_before" (time.time())
+        before which it is not claimed.
+        """
+        assert "@" not in name and "." not in name, "Queue item names cannot contain @ or ."
+        self._write_json(os.path.join(self.queue_path, PENDING, name + ".json"), payload)
+
+    def pop_results(self, run_id):
+        """
+        Remove and return list of (name, worker_id, payload, result) of completed items of run_id
+        """
+        completed = []
+        for filename in self._list(DONE, run_id):
+            name, worker_id = _split_filename(filename)
+            done_filepath = os.path.join(self.queue_path, DONE, filename)
+            results_filepath = os.path.join(self.queue_path, RESULTS, filename)
+
+            completed.append([name, worker_id, _read_json(done_filepath), _read_json(results_filepath)])
+            os.remove(results_filepath)
+            os.remove(done_filepath)
+        return completed
+
+    def requeue_expired(self, run_id):
+        """
+        Revoke all expired leases of run_id. Return list of (name, worker_id, payload), the caller
+        decides whether to put them again.
+        """
+        expired = []
+        now = time.time()
+        for filename in self._list(LEASED, run_id):
+            leased_filepath = os.path.join(self.queue_path, LEASED, filename)
+            try:
+                stat = os.stat(leased_filepath)
+            except FileNotFoundError:
+                continue  # completed meanwhile
+            if now - max(stat.st_mtime, stat.st_ctime) < self.lease_seconds:
+                continue
+
+            revoked_filepath = os.path.join(self.queue_path, TMP, filename)
+            try:
+                os.rename(leased_filepath, revoked_filepath)  # the worker can no longer complete it
+            except FileNotFoundError:
+                continue
+
+            name, worker_id = _split_filename(filename)
+            expired.append([name, worker_id, _read_json(revoked_filepath)])
+            os.remove(revoked_filepath)
+        return expired
+
+    def remove_run(self, run_id):
+        """
+        Remove all pending, completed and revoked items of run_id (e.g. when the coordinator stops).
+        Leases still held by workers are left to finish.
+        """
+        for subdir in [PENDING, DONE, RESULTS, TMP]:
+            for filename in self._list(subdir, run_id):
+                try:
+                    os.remove(os.path.join(self.queue_path, subdir, filename))
+                except FileNotFoundError:
+                    pass
+
+    # Worker
+
+    def claim(self, worker_id, run_id=None):
+        """
+        Claim the first pending item (in name order) that is due, only of run_id if given.
+        Return a Lease, or None if there is none.
+        """
+        worker_id = get_safe_worker_id(worker_id)
+        now = time.time()
+
+        for filename in self._list(PENDING, run_id):
+            pending_filepath = os.path.join(self.queue_path, PENDING, filename)
+            try:
+                payload = _read_json(pending_filepath)
+            except (FileNotFoundError, ValueError):
+                continue  # claimed by another worker meanwhile
+            if payload.get("not_before", 0) > now:
+                continue
+
+            lease = Lease(filename[:-len(".json")], worker_id, payload)
+            leased_filepath = os.path.join(self.queue_path, LEASED, lease.get_filename())
+            try:
+                os.rename(pending_filepath, leased_filepath)
+            except FileNotFoundError:
+                continue
+            os.utime(leased_filepath)  # start the lease now
+            return lease
+
+        return None
+
+    def heartbeat(self, lease):
+        """
+        Renew the lease. Return False if it was revoked (see requeue_expired()).
+        """
+        try:
+            os.utime(os.path.join(self.queue_path, LEASED, lease.get_filename()))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, lease, result):
+        """
+        Put back the result of a lease. Return False (and drop the result) if the lease was revoked.
+        """
+        results_filepath = os.path.join(self.queue_path, RESULTS, lease.get_filename())
+        self._write_json(results_filepath, result)
+        try:
+            os.rename(os.path.join(self.queue_path, LEASED, lease.get_filename()),
+                      os.path.join(self.queue_path, DONE, lease.get_filename()))
+            return True
+        except FileNotFoundError:
+            os.remove(results_filepath)
+            return False
+
+    def _list(self, subdir, run_id=None):
+        return sorted(filename for filename in os.listdir(os.path.join(self.queue_path, subdir))
+                      if (run_id is None or filename.startswith(run_id + "-")) and not filename.endswith(".partial"))
+
+    def _write_json(self, filepath, data):
+        tmp_filepath = os.path.join(self.queue_path, TMP, os.path.basename(filepath) + ".partial")
+        with open(tmp_filepath, "w") as file:
+            json.dump(data, file)
+        os.replace(tmp_filepath, filepath)
+
+
+def make_run_id():
+    """
+    Unique id for a coordinator run, items are named "<run_id>-<index>"
+    """
+    return "{0}_{1}_{2}".format(time.strftime("%Y%m%d%H%M%S"), get_safe_worker_id(socket.gethostname()), os.getpid())
+
+def get_worker_id():
+    return get_safe_worker_id("{0}_{1}".format(socket.gethostname(), os.getpid()))
+
+def get_safe_worker_id(worker_id):
+    return re.sub(r"[^\w]", "_", worker_id)
+
+def _split_filename(filename):
+    name, worker_id = filename.split("@", 1)
+    return name[:-len(".json")], worker_id
+
+def _read_json(filepath):
+    with open(filepath, "r") as file:
+        return json.load(file)
+
+# Work graph <-> queue items
+
+def split_graph_by_session(graph):
+    """
+    Return OrderedDict {session_key: [task, ...]} in graph order. Tasks only depend on tasks of
+    their own session (see work_graph.Task) so each session runs on its own.
+    """
+    sessions = collections.OrderedDict()
+    for task in graph.topological_order():
+        for dependency in task.dependencies:
+            assert graph.get_task(dependency).session_key == task.session_key, \
+                "{0} depends on {1} of another session".format(task.task_id, dependency)
+        sessions.setdefault(task.session_key, []).append(task)
+    return sessions
+
+def task_to_dict(task):
+    return {"task_id": task.task_id,
+            "kind": task.kind,
+            "session_key": task.session_key,
+            "kwargs": task.kwargs,
+            "dependencies": task.dependencies,
+            "estimated_bytes": task.estimated_bytes,
+            "estimated_seconds": task.estimated_seconds}
+
+def tasks_to_graph(task_dicts):
+    """
+    WorkGraph of the task dicts. Dependencies on tasks that are not included (done in an
+    earlier attempt) are dropped.
+    """
+    graph = work_graph.WorkGraph()
+    for task_dict in task_dicts:
+        graph.add_task(work_graph.Task(task_dict["task_id"],
+                                       task_dict["kind"],
+                                       task_dict["session_key"],
+                                       task_dict["kwargs"],
+                                       dependencies=[dependency for dependency in task_dict["dependencies"]
+                                                     if dependency in graph],
+                                       estimated_bytes=task_dict["estimated_bytes"],
+                                       estimated_seconds=task_dict["estimated_seconds"]))
+    return graph
@@ -1,11 +1,31 @@
 import os
+import shlex
 import subprocess
 
+DEFAULT_SLURM_RESOURCES = {"cpus": 1,
+                           "mem": "4G",
+                           "time": "23:59:00"}
+
 def run_command_with_slurm(job_name, output_filepath, errors_filepath, ntasks, commands_to_run):
     slurm_job_str = generate_slurm_job_command(job_name, output_filepath, errors_filepath, ntasks, commands_to_run)
     slurm_bash_filepath = save_slurm_bash_script(output_filepath, job_name, slurm_job_str)
-    subprocess.call("sbatch " + slurm_bash_filepath,
-                    shell=True)
+    return submit_slurm_job(slurm_bash_filepath)
+
+def submit_slurm_job(slurm_bash_filepath, dependency_job_ids=None):
+    """
+    Submit with sbatch (no shell) and return the job id. If dependency_job_ids
+    are given the job only starts once all of them finish successfully (afterok).
+    """
+    command = ["sbatch", "--parsable"]
+    if dependency_job_ids:
+        command.append("--dependency=afterok:" + ":".join(str(job_id) for job_id in dependency_job_ids))
+    command.append(slurm_bash_filepath)
+
+    output = subprocess.run(command,
+                            stdout=subprocess.PIPE,
+                            check=True).stdout.decode("utf-8").strip()
+
+    return output.split(";")[0]  # --parsable output is jobid[;cluster]
 
 
 def save_slurm_bash_script(filepath, filename, contents):
@@ -60,3 +80,105 @@ def generate_slurm_job_command(job_name, output_filepath, errors_filepath, ntask
                                 commands_to_run=commands_to_run,
                          )
     return slurm_job_str
+
+# SLURM Job Arrays
+# ----------------------------------------------------------------------------------------------------------------------
+
+def run_commands_as_slurm_arrays(job_name, output_filepath, errors_filepath, tasks, max_concurrent=None,
+                                 dependency_job_ids=None):
+    """
+    Submit many commands as SLURM job arrays rather than one script per job.
+
+    tasks: list of (command, resources) where command is an argv list (or str) and
+           resources is a dict of resource hints {"cpus": 4, "mem": "8G", "time": "1-00:00:00"}.
+           Missing hints are taken from DEFAULT_SLURM_RESOURCES.
+
+    A job array can only request one set of resources, so tasks are grouped by their
+    resources and one array is submitted per group (e.g. one for all anat recon-all).
+    max_concurrent limits the number of array tasks running at once (--array=0-N%M).
+
+    Return list of submitted job ids, these can be passed as dependency_job_ids to chain
+    jobs (e.g. recon-all after dcm2niix).
+    """
+    tasks_by_resources = {}
+    for command, resources in tasks:
+        resources = dict(DEFAULT_SLURM_RESOURCES, **(resources or {}))
+        key = tuple(sorted(resources.items()))
+        tasks_by_resources.setdefault(key, []).append(command)
+
+    job_ids = []
+    for group_idx, (resources_key, commands) in enumerate(tasks_by_resources.items()):
+
+        group_job_name = job_name if len(tasks_by_resources) == 1 else "{0}_{1}".format(job_name, group_idx)
+
+        manifest_filepath = save_task_manifest(output_filepath, group_job_name, commands)
+
+        slurm_job_str = generate_slurm_array_job_command(group_job_name,
+                                                         output_filepath,
+                                                         errors_filepath,
+                                                         manifest_filepath,
+                                                         len(commands),
+                                                         dict(resources_key),
+                                                         max_concurrent)
+
+        slurm_bash_filepath = save_slurm_bash_script(output_filepath, group_job_name, slurm_job_str)
+        job_ids.append(submit_slurm_job(slurm_bash_filepath, dependency_job_ids))
+
+    return job_ids
+
+def save_task_manifest(filepath, job_name, commands):
+    """
+    Write one shell-quoted command per line. Array task N runs line N + 1.
+    """
+    manifest_filepath = os.path.join(filepath, job_name + "_tasks.txt")
+    with open(manifest_filepath, "w") as file:
+        for command in commands:
+            file.write((shlex.join(command) if type(command) != str else command) + "\n")
+
+    return manifest_filepath
+
+def generate_slurm_array_job_command(job_name, output_filepath, errors_filepath, manifest_filepath,
+                                     num_tasks, resources, max_concurrent=None):
+    """
+    --array 0-N%M, one array task per line in the task manifest, M is the max tasks running at once
+    --output %A means slurm job ID and %a means array index
+    --cpus-per-task, --mem, --time are set per array from the resource hints
+    """
+    array_str = "0-{0}".format(num_tasks - 1)
+    if max_concurrent:
+        array_str += "%{0}".format(max_concurrent)
+
+    slurm_job_str = ("#!/bin/bash\n"
+                     "\n"
+                     "#SBATCH --job-name={job_name}\n"
+                     "#SBATCH --output={output_filepath}/{job_name}_%A_%a.out\n"
+                     "#SBATCH --error={errors_filepath}/{job_name}_%A_%a.err\n"
+                     "#SBATCH --array={array_str}\n"
+                     "#SBATCH --ntasks=1\n"
+                     "#SBATCH --nodes=1\n"
+                     "#SBATCH --cpus-per-task={cpus}\n"
+                     "#SBATCH --mem={mem}\n"
+                     "#SBATCH --time={time}\n"
+                     "\n"
+                     "#! Always keep the following echo commands to monitor CPU, memory usage\n"
+                     "echo \"SLURM_ARRAY_JOB_ID: $SLURM_ARRAY_JOB_ID\"\n"
+                     "echo \"SLURM_ARRAY_TASK_ID: $SLURM_ARRAY_TASK_ID\"\n"
+                     "echo \"SLURM_MEM_PER_NODE: $SLURM_MEM_PER_NODE\"\n"
+                     "echo \"SLURM_CPUS_PER_TASK: $SLURM_CPUS_PER_TASK\"\n"
+                     "\n"
+                     "TASK_COMMAND=$(sed -n \"$((SLURM_ARRAY_TASK_ID + 1))p\" {manifest_filepath})\n"
+                     "echo \"$TASK_COMMAND\"\n"
+                     "eval \"$TASK_COMMAND\"\n"
+                     "\n"
+                     "echo \"finished\"\n"
+                     "\n"
+                     "").format(job_name=job_name,
+                                output_filepath=output_filepath,
+                                errors_filepath=errors_filepath,
+                                array_str=array_str,
+                                cpus=resources["cpus"],
+                                mem=resources["mem"],
+                                time=resources["time"],
+                                manifest_filepath=shlex.quote(manifest_filepath),
+                         )
+    return slurm_job_str
@@ -0,0 +1,138 @@
+import numpy as np
+import nibabel as nib
+
+# Chunked, memory-bounded access to NIfTI volumes
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# A 7T multiband func run is several GB, so per-run computations (see backend/analysis/qc.py)
+# never load a whole run. NiftiVolume opens the file lazily (nibabel array proxy, memory mapped
+# for uncompressed .nii) and yields chunks of whole volumes (time chunks) or slabs of slices
+# sized to fit memory_budget_bytes, including the working copy in the requested dtype. The
+# memory used by a job is then bounded by its budget (plus a few whole-volume result arrays)
+# however large the run, so many jobs can run at once.
+#
+# Time chunks are contiguous on disk (time is the slowest axis in NIfTI) so they are the
+# fast choice, and .nii.gz is read as a single decompression stream. Slabs are for computations
+# that need the whole time course of each voxel at once, they are slow for .nii.gz as every
+# slab decompresses the whole file.
+
+DEFAULT_MEMORY_BUDGET_BYTES = 256 * 1024 ** 2
+
+
+class NiftiVolume():
+    """
+    Lazy view on a 3D or 4D NIfTI file. 3D files are treated as a single volume.
+
+    e.g.
+        volume = NiftiVolume(filepath, memory_budget_bytes=512 * 1024 ** 2)
+        for start, stop, chunk in volume.iter_time_chunks():
+            ...  # chunk is (x, y, z, stop - start)
+    """
+    def __init__(self, filepath, memory_budget_bytes=DEFAULT_MEMORY_BUDGET_BYTES):
+        self.filepath = filepath
+        self.memory_budget_bytes = memory_budget_bytes
+        self.image = nib.load(filepath, mmap=True)
+        self.affine = self.image.affine
+
+        shape = self.image.shape
+        self.spatial_shape = tuple(shape[:3])
+        self.num_volumes = shape[3] if len(shape) > 3 else 1
+        self.shape = self.spatial_shape + (self.num_volumes,)
+
+        self._stored_itemsize = np.dtype(self.image.get_data_dtype()).itemsize
+
+    def get_chunk_length(self, item_size_along_axis, dtype=np.float64):
+        """
+        Number of items (volumes or slices) of item_size_along_axis voxels that fit the budget,
+        counting the stored data, its copy in dtype and one temporary of the same size (e.g. chunk[mask]).
+        """
+        bytes_per_item = item_size_along_axis * (self._stored_itemsize + 2 * np.dtype(dtype).itemsize)
+        return max(1, int(self.memory_budget_bytes // bytes_per_item))
+
+    def iter_time_chunks(self, dtype=np.float64):
+        """
+        Yield (start, stop, chunk) with chunk a (x, y, z, stop - start) array of volumes start:stop
+        """
+        chunk_length = self.get_chunk_length(int(np.prod(self.spatial_shape)), dtype)
+
+        if not self.filepath.endswith(".gz") or self.num_volumes == 1:
+            for start in range(0, self.num_volumes, chunk_length):
+                stop = min(start + chunk_length, self.num_volumes)
+                yield start, stop, self.get_volumes(start, stop, dtype)
+            return
+
+        # slicing a .nii.gz proxy decompresses from the start of the file for every chunk,
+        # so read the chunks in order from a single decompression stream
+        with nib.openers.ImageOpener(self.filepath, "rb") as file:
+            file.seek(self.image.dataobj.offset)
+            for start in range(0, self.num_volumes, chunk_length):
+                stop = min(start + chunk_length, self.num_volumes)
+                yield start, stop, self._read_next_volumes(file, stop - start, dtype)
+
+    def iter_slab_chunks(self, dtype=np.float64):
+        """
+        Yield (start, stop, chunk) with chunk a (x, y, stop - start, t) array of slices start:stop
+        """
+        chunk_length = self.get_chunk_length(self.spatial_shape[0] * self.spatial_shape[1] * self.num_volumes,
+                                             dtype)
+        for start in range(0, self.spatial_shape[2], chunk_length):
+            stop = min(start + chunk_length, self.spatial_shape[2])
+            chunk = self.image.dataobj[:, :, start:stop]
+            yield start, stop, np.asarray(chunk, dtype=dtype).reshape(self.spatial_shape[:2] + (stop - start,
+                                                                                                 self.num_volumes))
+
+    def _read_next_volumes(self, file, num_volumes, dtype):
+        stored_dtype = self.image.get_data_dtype()
+        num_bytes = int(np.prod(self.spatial_shape)) * num_volumes * stored_dtype.itemsize
+        stored = np.frombuffer(file.read(num_bytes), dtype=stored_dtype)
+
+        volumes = stored.reshape(self.spatial_shape + (num_volumes,), order="F").astype(dtype)
+        slope, inter = self.image.dataobj.slope, self.image.dataobj.inter
+        if slope != 1 or inter != 0:
+            volumes *= slope
+            volumes += inter
+        return volumes
+
+    def get_volumes(self, start, stop, dtype=np.float64):
+        if len(self.image.shape) == 3:
+            return np.asarray(self.image.dataobj, dtype=dtype)[..., np.newaxis]
+        return np.asarray(self.image.dataobj[..., start:stop], dtype=dtype)
+
+    def get_volume(self, idx, dtype=np.float64):
+        return self.get_volumes(idx, idx + 1, dtype)[..., 0]
+
+
+def get_temporal_mean_and_std(volume):
+    """
+    Voxelwise mean and std over time in one pass over time chunks (chunked Welford / Chan
+    combination of mean and sum of squared deviations, stable for long runs).
+    """
+    count = 0
+    mean = np.zeros(volume.spatial_shape, dtype=np.float64)
+    m2 = np.zeros(volume.spatial_shape, dtype=np.float64)
+
+    for start, stop, chunk in volume.iter_time_chunks():
+        chunk_count = stop - start
+        chunk_mean = chunk.mean(axis=3)
+        if not chunk.flags.writeable:
+            chunk = chunk.copy()
+        np.subtract(chunk, chunk_mean[..., np.newaxis], out=chunk)  # in place to stay within the budget
+        np.square(chunk, out=chunk)
+        chunk_m2 = chunk.sum(axis=3)
+
+        delta = chunk_mean - mean
+        total = count + chunk_count
+        mean += delta * (chunk_count / total)
+        m2 += chunk_m2 + delta ** 2 * (count * chunk_count / total)
+        count = total
+
+    return mean, np.sqrt(m2 / count)
+
+def get_masked_mean_per_volume(volume, mask):
+    """
+    Mean over the voxels in mask for every volume, shape (t,)
+    """
+    means = np.empty(volume.num_volumes, dtype=np.float64)
+    for start, stop, chunk in volume.iter_time_chunks():
+        means[start:stop] = chunk[mask].mean(axis=0)
+    return means
@@ -0,0 +1,141 @@
+import os
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+
+# Directory Watcher - inotify with polling fallback
+# ----------------------------------------------------------------------------------------------------------------------
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class DirectoryWatcher():
+    """
+    Watch the direct contents of a list of directories (not recursive) and
+    report the names of entries that are created, moved in, changed or deleted.
+
+    inotify is used where available (local filesystems on linux, including ZFS). On
+    other systems, or network filesystems where inotify events are not delivered,
+    use_inotify=False falls back to polling os.scandir() every poll_interval seconds.
+    """
+    def __init__(self, paths, use_inotify=True, poll_interval=10):
+        self.paths = [path for path in paths if os.path.isdir(path)]
+        self.poll_interval = poll_interval
+
+        self._inotify_fd = None
+        self._wd_to_path = {}
+        self._snapshots = {}
+
+        if use_inotify:
+            self._init_inotify()
+
+        if self._inotify_fd is None:
+            self._snapshots = {path: self._snapshot(path) for path in self.paths}
+
+    def uses_inotify(self):
+        return self._inotify_fd is not None
+
+    def wait_for_changes(self, timeout):
+        """
+        Block until at least one change is seen or timeout (s) has passed.
+        Return a set of (dir_path, entry_name) for all changes.
+        """
+        if self.uses_inotify():
+            return self._read_inotify_events(timeout)
+
+        end_time = time.monotonic() + timeout
+        while True:
+            changes = self._poll_changes()
+            remaining = end_time - time.monotonic()
+            if changes or remaining <= 0:
+                return changes
+            time.sleep(min(self.poll_interval, remaining))
+
+    def close(self):
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+
+# Inotify --------------------------------------------------------------------------------------------------------------
+
+    def _init_inotify(self):
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            return
+
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            return
+
+        fd = libc.inotify_init1(os.O_NONBLOCK)
+        if fd < 0:
+            return
+
+        for path in self.paths:
+            wd = libc.inotify_add_watch(fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                os.close(fd)
+                self._wd_to_path = {}
+                return
+            self._wd_to_path[wd] = path
+
+        self._inotify_fd = fd
+
+    def _read_inotify_events(self, timeout):
+        changes = set()
+
+        readable, __, __ = select.select([self._inotify_fd], [], [], timeout)
+        if not readable:
+            return changes
+
+        try:
+            buffer = os.read(self._inotify_fd, 64 * 1024)
+        except BlockingIOError:
+            return changes
+
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buffer):
+            wd, mask, __, name_len = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = buffer[offset:offset + name_len].rstrip(b"\0").decode("utf-8", "replace")
+            offset += name_len
+
+            if wd in self._wd_to_path and name:
+                changes.add((self._wd_to_path[wd], name))
+
+        return changes
+
+# Polling --------------------------------------------------------------------------------------------------------------
+
+    def _snapshot(self, path):
+        snapshot = {}
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    snapshot[entry.name] = entry.stat(follow_symlinks=False).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+        return snapshot
+
+    def _poll_changes(self):
+        changes = set()
+        for path in self.paths:
+            new_snapshot = self._snapshot(path)
+            old_snapshot = self._snapshots[path]
+
+            for name in set(new_snapshot) | set(old_snapshot):
+                if new_snapshot.get(name) != old_snapshot.get(name):
+                    changes.add((path, name))
+
+            self._snapshots[path] = new_snapshot
+        return changes
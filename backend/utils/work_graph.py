@@ -0,0 +1,139 @@
+import collections
+
+# Work Graph - DAG of pending project tasks
+# ----------------------------------------------------------------------------------------------------------------------
+
+class Task():
+    """
+    A single unit of pending work e.g. download a session, copy a run to preprocessing
+    or convert a run with dcm2niix.
+
+    task_id:            unique str id e.g. "stage_run:zk22w7_044:func:fleet_mb:run-001"
+    kind:               the stage of the task, used to dispatch it (see ProjectMaster.run_task())
+    session_key:        zk_id of the session the task belongs to. Failures are isolated per session.
+    kwargs:             dict of all arguments needed to execute the task
+    dependencies:       list of task_id that must finish before this task is run
+    estimated_bytes:    estimated bytes read / written by the task (None if unknown)
+    estimated_seconds:  estimated runtime (None if unknown)
+    """
+    def __init__(self, task_id, kind, session_key, kwargs, dependencies=None,
+                 estimated_bytes=None, estimated_seconds=None):
+        self.task_id = task_id
+        self.kind = kind
+        self.session_key = session_key
+        self.kwargs = kwargs
+        self.dependencies = list(dependencies) if dependencies else []
+        self.estimated_bytes = estimated_bytes
+        self.estimated_seconds = estimated_seconds
+
+    def __repr__(self):
+        return "Task({0})".format(self.task_id)
+
+
+class WorkGraph():
+    """
+    Directed acyclic graph of Task. Tasks are added in any order as long as
+    dependencies are added before their dependents (this guarantees there are no cycles).
+    """
+    def __init__(self):
+        self._tasks = collections.OrderedDict()
+        self._dependents = collections.defaultdict(list)
+
+    def add_task(self, task):
+        assert task.task_id not in self._tasks, "Duplicate task id in work graph: " + task.task_id
+        for dependency in task.dependencies:
+            assert dependency in self._tasks, "Dependency {0} must be added before {1}".format(dependency,
+                                                                                           task.task_id)
+            self._dependents[dependency].append(task.task_id)
+
+        self._tasks[task.task_id] = task
+        return task
+
+    def get_task(self, task_id):
+        return self._tasks[task_id]
+
+    def get_all_tasks(self):
+        return list(self._tasks.values())
+
+    def get_dependents(self, task_id):
+        return list(self._dependents[task_id])
+
+    def get_all_dependents(self, task_id):
+        """
+        Return all tasks downstream of task_id (used to skip work after a failure)
+        """
+        result = []
+        to_visit = self.get_dependents(task_id)
+        while to_visit:
+            dependent = to_visit.pop()
+            if dependent not in result:
+                result.append(dependent)
+                to_visit.extend(self.get_dependents(dependent))
+        return result
+
+    def topological_order(self):
+        """
+        Tasks can only depend on previously added tasks, so insertion order is already
+        a valid topological order.
+        """
+        return self.get_all_tasks()
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __contains__(self, task_id):
+        return task_id in self._tasks
+
+    def total_estimated_bytes(self, kind=None):
+        return sum(task.estimated_bytes or 0 for task in self._tasks.values() if kind in [None, task.kind])
+
+    def total_estimated_seconds(self, kind=None):
+        return sum(task.estimated_seconds or 0 for task in self._tasks.values() if kind in [None, task.kind])
+
+    def format_dry_run(self):
+        """
+        Return a printable summary of all tasks in execution order with
+        per-kind totals.
+        """
+        lines = []
+        for task in self.topological_order():
+            lines.append("{0:<75} {1:>10} {2:>10}   after: {3}".format(task.task_id,
+                                                                      format_bytes(task.estimated_bytes),
+                                                                      format_seconds(task.estimated_seconds),
+                                                                      ", ".join(task.dependencies) or "-"))
+        lines.append("")
+
+        kinds = []
+        for task in self._tasks.values():
+            if task.kind not in kinds:
+                kinds.append(task.kind)
+
+        for kind in kinds:
+            num_tasks = len([task for task in self._tasks.values() if task.kind == kind])
+            lines.append("{0:<20} {1:>5} tasks {2:>10} {3:>10}".format(kind,
+                                                                     num_tasks,
+                                                                     format_bytes(self.total_estimated_bytes(kind)),
+                                                                     format_seconds(self.total_estimated_seconds(kind))))
+
+        lines.append("{0:<20} {1:>5} tasks {2:>10} {3:>10}".format("total",
+                                                                 len(self),
+                                                                 format_bytes(self.total_estimated_bytes()),
+                                                                 format_seconds(self.total_estimated_seconds())))
+        return "\n".join(lines)
+
+
+def format_bytes(num_bytes):
+    if num_bytes is None:
+        return "?"
+    for unit in ["B", "KB", "MB", "GB"]:
+        if num_bytes < 1024:
+            return "{0:.1f} {1}".format(num_bytes, unit)
+        num_bytes /= 1024
+    return "{0:.1f} TB".format(num_bytes)
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "?"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{0}:{1:02}:{2:02}".format(hours, minutes, seconds)
@@ -0,0 +1,75 @@
+"""
+Import-time benchmark for run_project.py
+
+Times a cold start of a no-op run (import project_configs, create the Project and
+parse the arguments) in a fresh interpreter and fails if it goes over the budget or
+if a heavy backend (nipype, paramiko, numpy, nibabel) is imported. These must only be
+imported inside the methods that use them.
+
+Run from the project directory:
+    python3 benchmark_startup.py
+    python3 benchmark_startup.py -budget 0.5 -repeats 10
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HEAVY_MODULES = ["nipype", "paramiko", "numpy", "nibabel"]
+
+NO_OP_RUN = """
+import json, sys, time
+start_time = time.perf_counter()
+from project_configs import Project
+project = Project()
+project.process_args()
+duration = time.perf_counter() - start_time
+print(json.dumps({"duration": duration,
+                  "heavy_modules": [name for name in %r if name in sys.modules]}))
+""" % HEAVY_MODULES
+
+
+def time_cold_start():
+    """
+    Return (seconds, list of heavy modules imported) for a no-op run in a new interpreter
+    """
+    output = subprocess.run([sys.executable, "-c", NO_OP_RUN],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.PIPE,
+                            check=True).stdout
+    result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+    return result["duration"], result["heavy_modules"]
+
+def main():
+    parser = argparse.ArgumentParser(description="Time cold start of a no-op run_project.py run")
+    parser.add_argument("-budget", "--budget", type=float, default=0.5,
+                        help="Maximum seconds for the fastest cold start")
+    parser.add_argument("-repeats", "--repeats", type=int, default=5,
+                        help="Number of cold starts, the fastest is compared to the budget")
+    args = parser.parse_args()
+
+    durations = []
+    heavy_modules = set()
+    for __ in range(args.repeats):
+        duration, imported = time_cold_start()
+        durations.append(duration)
+        heavy_modules.update(imported)
+
+    fastest = min(durations)
+    print("cold start: fastest {0:.3f} s, slowest {1:.3f} s over {2} runs (budget {3:.3f} s)".format(fastest,
+                                                                                               max(durations),
+                                                                                               args.repeats,
+                                                                                               args.budget))
+    failed = False
+    if heavy_modules:
+        print("FAILED: heavy modules imported at startup: {0}".format(", ".join(sorted(heavy_modules))))
+        failed = True
+    if fastest > args.budget:
+        print("FAILED: cold start is over budget")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
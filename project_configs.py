@@ -15,6 +15,17 @@ class Project(ProjectMaster):
         scanner_format:           Format of scanner output files e.g. ".dcm" for dicom
         server_to_download_to:    name of the server to download scans to from HPC e.g. "abg-hivemind.psychol.private.cam.ac.uk"
 
+        archive_raw_scans_after_download:   If True, the second level zk_id dir is compressed to zk_id.tar.zst
+                                            after download and checked against a file manifest (for ABL backups).
+
+        prune_raw_scans_after_staging:      If True, the uncompressed second level zk_id dir is deleted after the
+                                            scan is copied to preprocessing, only if a verified archive exists.
+
+        deidentify_raw_scans_after_download: If True, patient identifiers in raw_scans are rewritten in place
+                                             after download, before archival (PatientName / PatientID set to sub_id).
+
+        deidentify_staged_dicoms:           If True, runs are de-identified as they are copied to preprocessing.
+
         _scan_details:            A dict containing details on the relevant scans to copy from raw_scans to
                                   preprocessing. They key is used as he last entry of the BIDS folder name,
                                   and the task field is used as the task field on the BIDS folder name. The
@@ -23,7 +34,8 @@ class Project(ProjectMaster):
                                   regexp, see the documentation).
 
                                   An entry exists for mrs_, anat_, func_ mpms_ - if not collecting scans of this type,
-                                  use None.
+                                  use None. A new modality only needs its own entry e.g. dwi_scan_details (and
+                                  num_expected_dwi_files), see backend/utils/scan_types.py for its settings.
 
         num_expected_files:       The number of expected files in the raw_scans folder, which would match volumes
                                   for func and spectra for mrs. These are used for tests during copy to preprocessing
@@ -37,7 +49,7 @@ class Project(ProjectMaster):
 
     """
     def __init__(self):
-        super(ProjectMaster, self)
+        super(Project, self).__init__()
 
 #       Project Settings -----------------------------------------------------------------------------------------------
 
@@ -47,6 +59,13 @@ class Project(ProjectMaster):
         self.scanner_format = ".dcm"
         self.server_to_download_to = "abg-hivemind.psychol.private.cam.ac.uk"
 
+        self.archive_raw_scans_after_download = False
+        self.prune_raw_scans_after_staging = False
+        self.deidentify_raw_scans_after_download = False
+        self.deidentify_staged_dicoms = False
+        self.admission_safety_margin_bytes = 50e9   # always left free on the ZFS pool and /rds-d5, tasks are
+                                                    # queued until they fit (see make_admission_controller())
+
         self.mrs_scan_details = {"slaser":
                                   {"search_str": "*_sLaser_W*Pad_LongTE",
                                    "task_name": "ori"},
@@ -98,8 +117,8 @@ class Project(ProjectMaster):
                                            "ses_id": "ses-001",     # We used second slot for testing the shimming.
                                            "zk_id": "zk22w7_044",
                                            "time_start": "09:30",
-                                           "flags": [],
-                                       },
+                                           "flags": [],             # e.g. ["ignore_func_2", "ignore_func-fleet_mb_1-3,5"]
+                                       },                               # see backend/utils/flags.py
                                 },
                      },
             }
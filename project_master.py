@@ -1,18 +1,36 @@
 import re
 import copy
-import subprocess
+import time
+import collections
 import os
+import json
 import glob
 import shutil
 from functools import wraps
 import logging
 import datetime
-import paramiko
+import threading
+import importlib
+import inspect
+import sys
 import argparse
 from backend.analysis import mri_preprocessing_wrappers
+from backend.analysis import freesurfer
+from backend.analysis import deidentify
 from backend.utils import utils
-import nipype.pipeline.engine as pe
-from nipype.interfaces.dcm2nii import Dcm2niix
+from backend.utils import archive
+from backend.utils import commands
+from backend.utils import work_graph
+from backend.utils import scheduler
+from backend.utils import admission
+from backend.utils import task_queue
+from backend.utils import ssh_pool
+from backend.utils import scan_types as scan_type_registry
+from backend.utils import sessions_cache
+from backend.utils import watcher
+from backend.utils import project_status
+from backend.utils import flags
+from backend.utils import bids_metadata
 
 class ProjectMaster():
     """
@@ -38,10 +56,21 @@ class ProjectMaster():
         """
     def __init__(self):
 
+        self._logging_state = threading.local()
+        self._log_handlers = collections.OrderedDict()  # {log_filepath: handler} with an open file, oldest first
+        self._log_handlers_lock = threading.Lock()
+        self._staging_index_lock = threading.Lock()
+        self._ssh_pool_lock = threading.Lock()
+        self.ssh_pool = None  # created on first use, see get_ssh_pool(). Shared by projects in run_projects.py
+        self._scan_types = None  # built on first use, see get_scan_types()
+        self._raw_series_names = {}
+        self._sessions_cache = None  # loaded on first use, see _get_sessions_cache()
+
         self.raw_scans_path = ""
         self.docs_path = ""
         self.logs_path = ""
         self.download_logs_path = ""
+        self.max_open_log_files = 32  # least recently used log files are closed, see init_logging()
         self.slurm_logs_path = ""
         self.data_path = ""
         self.raw_scans_path = ""
@@ -51,6 +80,89 @@ class ProjectMaster():
         self.project_code = ""
         self.account = ""
         self.server_to_download_to = ""
+        self.max_ssh_connections = 4  # SSH connections to the HPC open at once, reused between commands
+        self.ssh_keepalive_seconds = 30  # keepalive of pooled SSH connections, so idle ones are not dropped
+
+        self.archive_raw_scans_after_download = False
+        self.prune_raw_scans_after_staging = False
+
+        self.deidentify_raw_scans_after_download = False  # rewrite patient identifiers in raw_scans before archival
+        self.deidentify_staged_dicoms = False             # de-identify while copying runs to preprocessing
+        self.num_deidentify_workers = None                # None for all available cores
+
+#       Planning Estimates ---------------------------------------------------------------------------------------------
+
+        self.estimated_bytes_per_session = None  # None to estimate from downloaded sessions
+        self.planning_bytes_per_second = {"download": 20e6,
+                                          "extract": 500e6,
+                                          "stage": 200e6,
+                                          "convert": 50e6,
+                                          "recon": 0.05e6}
+
+#       Scheduler ------------------------------------------------------------------------------------------------------
+
+        self.slurm_resource_hints = {"anat": {"cpus": 4, "mem": "8G", "time": "1-23:59:00"},   # per scan type, see
+                                     "func": {"cpus": 1, "mem": "8G", "time": "02:00:00"},     # utils.DEFAULT_SLURM_RESOURCES
+                                     "b0": {"cpus": 1, "mem": "2G", "time": "00:30:00"},       # for missing hints
+                                     "b1": {"cpus": 1, "mem": "2G", "time": "00:30:00"}}
+        self.slurm_max_concurrent_tasks = 20
+
+        self.dcm2niix_path = "dcm2niix"
+        self.num_conversion_workers = None  # None for all available cores
+        self.in_process_conversion_scan_types = ["b0", "b1"]
+
+        self.recon_all_path = "recon-all"
+        self.recon_all_threads_per_job = 4    # -openmp threads for each recon-all job (SLURM uses the anat cpus hint)
+        self.num_recon_all_cores = None       # None for all available cores
+
+        self.qc_thresholds = {"func_min_median_tsnr": 10,   # runs failing these are suggested as ignore_ flags,
+                              "func_max_spikes": 5,         # see run_qc()
+                              "spike_z": 5.0,
+                              "min_snr": {"anat": 5, "b0": 3, "b1": 3}}
+        self.num_qc_workers = None  # None for all available cores
+        self.qc_memory_budget_bytes = 256 * 1024 ** 2  # per QC job, runs are streamed in chunks of this size
+
+        self.watch_poll_interval = 60     # s, also the interval to retry failed sessions in watch mode
+        self.watch_settle_seconds = 30    # s with no new changes before new data is processed
+
+        self.scheduler_pool_sizes = {"network": 2,
+                                     "disk": 2,
+                                     "cpu": os.cpu_count() or 1,
+                                     "recon": None}  # None for num_recon_all_cores // recon_all_threads_per_job,
+                                                     # see get_scheduler_pool_sizes()
+        self.scheduler_task_kind_pools = {"download": "network",
+                                          "extract": "disk",
+                                          "stage_session": "disk",
+                                          "stage_run": "disk",
+                                          "convert_session": "cpu",
+                                          "convert_run": "cpu",
+                                          "recon_session": "recon",
+                                          "recon_run": "recon"}
+
+        self.admission_control = True                 # queue tasks until there is disk space for them,
+        self.admission_safety_margin_bytes = 50e9     # see backend/utils/admission.py
+        self.admission_io_budget_bytes = 200e9        # max bytes written at once to each volume (None for no limit)
+        self.admission_write_factors = {"download": {"hpc": 1.0, "raw_scans": 1.0},  # bytes written to each volume
+                                        "extract": {"raw_scans": 0.5},               # per estimated task byte
+                                        "stage_session": {"preprocessing": 1.0},     # (extract only writes the
+                                        "stage_run": {"preprocessing": 1.0},         # tar.zst archive)
+                                        "convert_session": {"preprocessing": 1.0},
+                                        "convert_run": {"preprocessing": 1.0},
+                                        "recon_session": {"preprocessing": 3.0},
+                                        "recon_run": {"preprocessing": 3.0}}
+        self.admission_retry_seconds = 30              # s between retries of queued tasks
+        self.admission_max_wait_seconds = 4 * 3600     # queued tasks fail after this (None to wait indefinitely)
+        self.hpc_free_bytes_command = "df -B1 --output=avail /rds-d5/user/{account}/hpc-work | tail -n 1"
+
+        self.distributed_queue_path = None        # shared by all hosts, None for docs/task_queue. See run_work_graph_distributed()
+        self.distributed_lease_seconds = 600      # sessions of a worker not heard from for this long are re-queued
+        self.distributed_heartbeat_seconds = 30
+        self.distributed_poll_seconds = 5
+        self.distributed_max_attempts = 3         # a session with failed tasks is re-queued until this many attempts
+        self.distributed_retry_seconds = 300      # wait before a failed session is retried
+        self.distributed_requeue_grace_seconds = 1800  # a session whose lease expired is queued again only after
+                                                       # distributed_lease_seconds + this, see run_work_graph_distributed()
+        self.distributed_worker_sessions = 2      # sessions each worker runs at once
 
         self.mrs_scan_details = None
         self.func_scan_details = None
@@ -58,6 +170,7 @@ class ProjectMaster():
         self.mpm_scan_details = None
         self.b0_scan_details = None
         self.b1_scan_details = None
+        self.scan_type_settings = None  # e.g. {"dwi": {"qc": "snr"}}, see backend/utils/scan_types.py
 
 #       Scan Parameters ------------------------------------------------------------------------------------------------
 
@@ -99,14 +212,37 @@ class ProjectMaster():
         if self.scan_already_downloaded(scan_info["zk_id"]):
             return False
 
+        if not self._has_space_to_write("download",
+                                        self.estimated_bytes_per_session or self._get_mean_manifest_session_bytes(),
+                                        "download {0}".format(scan_info["zk_id"])):
+            return False
+
+        self._pull_scans_to_raw_scans(wbic_id, scan_info)
+
+        return self._extract_and_test_download(wbic_id, scan_info)
+
+    def _pull_scans_to_raw_scans(self, wbic_id, scan_info):
+        """
+        Network-bound part of download_scans_from_hpc(), data is left in the session's download
+        dir (see _get_download_path()).
+        """
         self.log(None, "Pulling scans from HPC...")
 
         self._pull_scans_from_wbic_to_hpc(wbic_id,
-                                          scan_info["date"])
+                                          scan_info["date"],
+                                          scan_info["zk_id"])
 
         self._pull_scans_from_hpc_to_hivemind(wbic_id,
-                                              scan_info["date"])
+                                              scan_info["date"],
+                                              scan_info["zk_id"])
+        return True
 
+    def _extract_and_test_download(self, wbic_id, scan_info):
+        """
+        Disk-bound part of download_scans_from_hpc(), move the session's download dir to the
+        zk_id folder, test the download, de-identify and archive if set. Return False (and do not
+        archive) if the download failed or any file could not be de-identified.
+        """
         self._extract_wbic_data_to_zk_folder(wbic_id,
                                                scan_info["zk_id"])
 
@@ -115,13 +251,25 @@ class ProjectMaster():
         if download_failed:
             return False
 
+        if self.deidentify_raw_scans_after_download:
+            if not self.deidentify_raw_scans(scan_info["zk_id"],
+                                             self.get_participant_log()[wbic_id]["sub_id"]):
+                self.log("De-identify raw scans",
+                         "ERROR: not every file of {0} was de-identified so it was not archived, see "
+                         "deidentify_audit.tsv and run_project.py deidentify".format(scan_info["zk_id"]))
+                return False
+
+        if self.archive_raw_scans_after_download:
+            self.archive_raw_scans(scan_info["zk_id"])
+
         return True
 
     def move_raw_to_preprocessing(self, wbic_id, sub_info, scan_info):
         """
         Move the relevant raw scans (as specified in self.XXX_scan_details) for a scan
-        from the raw_scans dir to the preprocessing/sub/ses dir. If a ses dir already exists
-        in preprocessing/sub, it will be skipped.
+        from the raw_scans dir to the preprocessing/sub/ses dir. Only runs not yet staged
+        (or staged from a different raw series) are copied and the delta is logged, see
+        _get_staging_delta(), so adding a scan or flag only copies the runs it changes.
 
         Make a session directory in the preprocessing/sub dir for the
         session if it does not exist. Then, the raw_scans dir is searched with
@@ -131,21 +279,167 @@ class ProjectMaster():
         Any runs specified in the "flags" entry of the "scan" dict in
         the participant log will be ignored (see self.participant_log in
         project_configs.py).
+
+        If preprocessing does not have space for the runs to copy (and admission_safety_margin_bytes)
+        nothing is copied and False is returned, see make_admission_controller().
         """
-        ses_exists = self._check_ses_exists_mkdir_if_not(sub_info["sub_id"], scan_info, log=True)
+        if not self._has_space_to_write("stage_session",
+                                        self._get_bytes_to_stage(sub_info["sub_id"], scan_info),
+                                        "copy {0} to preprocessing".format(scan_info["zk_id"])):
+            return False
 
-        for scan_type in ["mrs", "func", "anat", "mpm", "b0", "b1"]:  # TODO: MOVE TO CONFIGS
+        ses_exists = self._check_ses_exists_mkdir_if_not(sub_info["sub_id"], scan_info, log=True)
 
-            if self.check_if_scan_type_is_in_ses_folder(sub_info["sub_id"], scan_info["ses_id"], scan_type):
-                continue
+        all_runs_copied = True
+        for scan_type in self.get_scan_types():
 
-            self._copy_data_to_preprocessing(scan_type,
-                                             scan_info,
-                                             sub_info)
+            all_runs_copied &= self._copy_data_to_preprocessing(scan_type,
+                                                                scan_info,
+                                                                sub_info)
 
         self._dump_info_file_in_session_dir(wbic_id,
                                             scan_info,
                                             sub_info)
+
+        if self.prune_raw_scans_after_staging:
+            if all_runs_copied:
+                self.prune_archived_raw_scans(scan_info["zk_id"])
+            else:
+                self.log("Prune raw scans",
+                         "{0} was not pruned as some runs were not copied to preprocessing".format(scan_info["zk_id"]))
+
+        return True
+
+    def archive_raw_scans(self, zk_id, num_threads=0):
+        """
+        Compress the second level zk_id dir (raw_scans/zk_id/zk_id) to raw_scans/zk_id/zk_id.tar.zst
+        for ABL backups. Called straight after download (see archive_raw_scans_after_download in
+        project_configs.py) so the files are still in the page cache.
+
+        A manifest of all files and their sizes is taken before compression and the archive
+        is checked against it by streaming decompression. The manifest is only saved
+        (raw_scans/zk_id/zk_id_manifest.json) if the check passes, so an existing manifest
+        means the archive is verified. Return True if the archive is verified.
+        """
+        zk_id_base_path = os.path.join(self.raw_scans_path, zk_id)
+        dir_to_archive = os.path.join(zk_id_base_path, zk_id)
+        archive_filepath = archive.get_archive_filepath(zk_id_base_path, zk_id)
+        manifest_filepath = archive.get_manifest_filepath(zk_id_base_path, zk_id)
+
+        if os.path.isfile(archive_filepath) and os.path.isfile(manifest_filepath):
+            return True
+
+        if not os.path.isdir(dir_to_archive):
+            self.log("Archive raw scans",
+                     "no raw scans found at {0}, nothing archived".format(dir_to_archive))
+            return False
+
+        manifest = archive.make_file_manifest(dir_to_archive)
+
+        return_code = archive.compress_dir_to_tar_zst(dir_to_archive,
+                                                      archive_filepath,
+                                                      num_threads)
+        if return_code != 0:
+            self.log("Archive raw scans",
+                     "ERROR: compression failed with return code {0} for {1}".format(return_code,
+                                                                                    dir_to_archive))
+            return False
+
+        errors = archive.verify_archive_against_manifest(archive_filepath, manifest)
+
+        if any(errors):
+            self.log("Archive raw scans",
+                     "ERROR: archive {0} does not match raw scans:\n{1}".format(archive_filepath,
+                                                                                "\n".join(errors)))
+            os.remove(archive_filepath)
+            return False
+
+        archive.save_manifest(manifest_filepath, manifest)
+
+        self.log("Archive raw scans",
+                 "archived {0} files ({1} bytes) from {2} \nto: {3}".format(len(manifest),
+                                                                          sum(manifest.values()),
+                                                                          dir_to_archive,
+                                                                          archive_filepath))
+        return True
+
+    def deidentify_raw_scans(self, zk_id, sub_id):
+        """
+        Rewrite patient identifiers in every file of raw_scans/zk_id/zk_id in place (PatientName
+        and PatientID are set to sub_id, see backend/analysis/deidentify.py). Run before
+        archival (see deidentify_raw_scans_after_download in project_configs.py) as an existing
+        archive is not changed. Return True if every file was read.
+        """
+        dir_to_deidentify = os.path.join(self.raw_scans_path, zk_id, zk_id)
+        if not os.path.isdir(dir_to_deidentify):
+            self.log("De-identify raw scans",
+                     "no raw scans found at {0}, nothing de-identified".format(dir_to_deidentify))
+            return False
+
+        filepaths = []
+        for dirpath, __, filenames in os.walk(dir_to_deidentify):
+            filepaths += [os.path.join(dirpath, filename) for filename in sorted(filenames)]
+
+        results = self._deidentify_files([[filepath, filepath] for filepath in filepaths], sub_id)
+        return all(result.succeeded() for result in results)
+
+    def _rebuild_raw_scans_archive(self, zk_id):
+        """
+        Archive the (de-identified) raw scans again, replacing the archive and its manifest
+        """
+        manifest_filepath = archive.get_manifest_filepath(os.path.join(self.raw_scans_path, zk_id), zk_id)
+        if os.path.isfile(manifest_filepath):
+            os.remove(manifest_filepath)  # so archive_raw_scans() does not skip the existing archive
+
+        rebuilt = self.archive_raw_scans(zk_id)
+        self.log("De-identify raw scans",
+                 "archive of {0} rebuilt from the de-identified raw scans".format(zk_id) if rebuilt else
+                 "ERROR: archive of {0} could not be rebuilt and still holds patient identifiers".format(zk_id))
+        return rebuilt
+
+    def deidentify_staged_runs(self, sub_id, ses_id):
+        """
+        Rewrite patient identifiers in place in every run staged to preprocessing/sub/ses.
+        The saved de-identified sizes of each run (see _run_is_copied()) are updated.
+        Return True if every file was read.
+        """
+        filepaths = []
+        runs = [run for scan_type in self.get_scan_types() for run in self._get_staged_runs(sub_id, ses_id, scan_type)]
+        for run in runs:
+            filepaths += [os.path.join(run["destination_path"], filename)
+                          for filename in sorted(self._get_file_sizes(run["destination_path"]))]
+
+        results = self._deidentify_files([[filepath, filepath] for filepath in filepaths], sub_id)
+
+        failed_run_paths = set(os.path.dirname(result.destination) for result in results if not result.succeeded())
+        for run in runs:
+            if self.deidentify_staged_dicoms and run["destination_path"] not in failed_run_paths:
+                self._save_deidentified_sizes(run["destination_path"], self._get_file_sizes(run["destination_path"]))
+
+        return all(result.succeeded() for result in results)
+
+    def prune_archived_raw_scans(self, zk_id):
+        """
+        Delete the uncompressed second level zk_id dir once it is archived and verified
+        (see archive_raw_scans()). The first level raw_scans/zk_id dir is kept so the scan
+        is still considered downloaded. Only call once the scan is staged to preprocessing
+        (see prune_raw_scans_after_staging in project_configs.py). Data can be restored with
+        tar --zstd -xf zk_id.tar.zst inside raw_scans/zk_id.
+        """
+        zk_id_base_path = os.path.join(self.raw_scans_path, zk_id)
+        dir_to_prune = os.path.join(zk_id_base_path, zk_id)
+
+        if not os.path.isdir(dir_to_prune):
+            return False
+
+        if not os.path.isfile(archive.get_manifest_filepath(zk_id_base_path, zk_id)):
+            self.log("Prune raw scans",
+                     "{0} was not pruned as it has no verified archive".format(dir_to_prune))
+            return False
+
+        shutil.rmtree(dir_to_prune)
+        self.log("Prune raw scans",
+                 "removed uncompressed raw scans {0}".format(dir_to_prune))
         return True
 
     def run_scan_sub_order_tests(self, assert_=False):
@@ -203,6 +497,12 @@ class ProjectMaster():
         Initialise the logger for the current scan. All logging
         (self.log()) will then be saved to the log in /docs/logs
         with filename formatted "date_zk_id.log".
+
+        The logger is set per-thread, so tasks for different scans
+        can run at the same time (see run_work_graph_with_scheduler()).
+        At most self.max_open_log_files log files are kept open, so watch
+        mode and distributed workers do not run out of file descriptors.
+        A closed log file is opened again when next written to.
         """
         if not logging_path:
             logging_path = self.download_logs_path
@@ -210,16 +510,40 @@ class ProjectMaster():
         if not log_filename:
             log_filename = "_".join([date_, zk_id]) + ".log"
 
-        for handler in logging.root.handlers[:]:
-            logging.root.removeHandler(handler)
+        log_filepath = os.path.join(logging_path, log_filename)
 
-        log_filename = "_".join([date_, zk_id]) + ".log"
-        logging.basicConfig(filename=os.path.join(self.download_logs_path, log_filename),
-                            format="%(message)s",
-                            level=logging.DEBUG)
+        logger = logging.getLogger("project_master:" + log_filepath)  # one logger per log file so
+        if not logger.handlers:                                        # sessions run in parallel threads
+            handler = logging.FileHandler(log_filepath)                # do not write to each others logs
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            logger.setLevel(logging.DEBUG)
+            logger.propagate = False
+
+        with self._log_handlers_lock:
+            self._log_handlers.pop(log_filepath, None)
+            self._log_handlers[log_filepath] = logger.handlers[0]
+            while len(self._log_handlers) > self.max_open_log_files:
+                __, handler = self._log_handlers.popitem(last=False)
+                self._close_log_file(handler)
+
+        self._logging_state.logger = logger
 
         self.log(None, "Logger Initialised...")
 
+    def _close_log_file(self, handler):
+        """
+        Close the file of a FileHandler but keep the handler, it opens the file again (in append
+        mode) on its next record. Records are written under the handler lock so none is lost.
+        """
+        handler.acquire()
+        try:
+            if handler.stream is not None:
+                handler.stream.close()
+                handler.stream = None
+        finally:
+            handler.release()
+
     def log(self, title, message):
         """
         Log the message, if title is not None inserted it with banner
@@ -234,7 +558,8 @@ class ProjectMaster():
             message = title + " -------------------------------------------------------------------------------------" \
                               "\n\n" + message
 
-        logging.debug(message)
+        logger = getattr(self._logging_state, "logger", logging.root)
+        logger.debug(message)
 
     def scan_already_downloaded(self, zk_id):
         """
@@ -250,21 +575,231 @@ class ProjectMaster():
         """
         Return dict in format {sub-001: [ses-001, ses-002...],
                                sub-002, [ses-...]}
+
+        Read from the sessions cache, which only lists dirs whose mtime changed (see _get_sessions_cache())
+        """
+        return sessions_cache.get_subs_and_ses(self._get_sessions_cache())
+
+    def get_project_status(self, sub_ids=None, ses_ids=None, run_ids=None, scan_names=None, scan_types=None):
+        """
+        Return a list of one dict per session in the participant log (restricted as in plan_work(), None for all)
+        with its raw_scans status (downloaded, archived, pruned), per scan type summary (runs staged,
+        runs with num_expected_*_files, runs converted, recon-all finished / started) and per run details.
+
+        raw_scans and preprocessing are each scanned once (see backend/utils/project_status.py) so
+        this is fast enough to run on every call of the status command. Format with
+        project_status.format_status_table(), format_status_tsv() or format_status_json().
+        """
+        raw_scans = project_status.scan_raw_scans(self.raw_scans_path)
+        preprocessing = project_status.scan_preprocessing(self.preprocessing_path)
+
+        rows = []
+        for __, sub_info, scan_info in self._get_selected_scans(self.get_participant_log(), sub_ids, None, ses_ids):
+            raw_status = raw_scans.get(scan_info["zk_id"], {"downloaded": False, "archived": False, "pruned": False})
+            session_runs = preprocessing.get(sub_info["sub_id"], {}).get(scan_info["ses_id"], {})
+
+            row = dict({"sub_id": sub_info["sub_id"],
+                        "ses_id": scan_info["ses_id"],
+                        "zk_id": scan_info["zk_id"],
+                        "date": scan_info["date"]},
+                       **raw_status)
+            row["scan_types"] = {}
+            row["runs"] = {}
+
+            for scan_type, scan_type_info in self.get_scan_types(collected_only=True).items():
+
+                if scan_types is not None and scan_type not in scan_types:
+                    continue
+
+                runs = {bids_name: run for bids_name, run in session_runs.get(scan_type, {}).items()
+                        if (run_ids is None or bids_name.split("_")[3] in run_ids) and
+                        (scan_names is None or bids_name.split("_", 4)[-1] in scan_names)}
+
+                row["scan_types"][scan_type] = project_status.get_scan_type_summary(runs,
+                                                                                   scan_type_info.num_expected_files)
+                row["runs"][scan_type] = runs
+
+            rows.append(row)
+
+        return rows
+
+# BIDS Metadata
+# ----------------------------------------------------------------------------------------------------------------------
+
+    def write_bids_metadata(self, sub_ids=None, ses_ids=None):
+        """
+        Write a sub-XXX_ses-XXX_scans.tsv for every selected session (None for all) and update the
+        custom layout index preprocessing/.layout_index.sqlite with the converted files of these
+        sessions (see backend/utils/bids_metadata.py). preprocessing is not a valid BIDS dataset so
+        no dataset_description.json is written (one written by an earlier version is removed).
+        Sessions no longer in preprocessing are removed from the index. Run after conversion, only
+        changed files and sessions are written so this is cheap to run after every batch of sessions.
+
+        Return dict with the number of files written and sessions re-indexed.
+        """
+        participant_log = self.get_participant_log()
+        summary = {"files_written": 0, "sessions_indexed": 0}
+
+        if bids_metadata.remove_dataset_files(self.preprocessing_path):
+            self.log(None, "Removed dataset_description.json / participants.tsv from {0}, it is not a BIDS "
+                           "dataset".format(self.preprocessing_path))
+
+        datatypes = {scan_type: scan_type_info.datatype for scan_type, scan_type_info in self.get_scan_types().items()}
+
+        sessions = []
+        for __, sub_info, scan_info in self._get_selected_scans(participant_log, sub_ids, None, ses_ids):
+            ses_path = os.path.join(self.preprocessing_path, sub_info["sub_id"], scan_info["ses_id"])
+            if not os.path.isdir(ses_path):
+                continue
+
+            session_files = bids_metadata.get_session_files(ses_path, datatypes)
+            acq_time = datetime.datetime.strptime(scan_info["date"] + " " + scan_info["time_start"],
+                                                  "%Y%m%d %H:%M").isoformat()
+
+            summary["files_written"] += bids_metadata.write_if_changed(
+                bids_metadata.get_scans_tsv_filepath(ses_path, sub_info["sub_id"], scan_info["ses_id"]),
+                bids_metadata.format_scans_tsv(session_files, acq_time))
+
+            sessions.append([sub_info["sub_id"], scan_info["ses_id"], session_files])
+
+        summary["sessions_indexed"] = bids_metadata.update_layout_index(os.path.join(self.preprocessing_path,
+                                                                                     ".layout_index.sqlite"),
+                                                                        sessions,
+                                                                        preprocessing_path=self.preprocessing_path)
+        return summary
+
+# Image QC
+# ----------------------------------------------------------------------------------------------------------------------
+
+    def run_qc(self, sub_ids=None, ses_ids=None, run_ids=None, scan_names=None, scan_types=None, overwrite=False):
+        """
+        Compute QC metrics (func tSNR and spikes, anat / b0 / b1 SNR, see backend/analysis/qc.py) for every
+        selected converted run without metrics (or all if overwrite), across num_qc_workers processes
+        each streaming its run within qc_memory_budget_bytes.
+        Metrics are saved to preprocessing/sub/ses/scan_type/qc/<bids_name>_qc.json.
+
+        The cohort table of all runs with metrics is then written to docs/qc_metrics.tsv
+        (see write_qc_cohort_table()). Return (number of runs checked, list of (bids_name, error) for runs
+        that could not be checked, cohort rows).
+        """
+        from backend.analysis import qc  # numpy / nibabel are only imported if used
+
+        jobs = []
+        for sub_id, ses_id, scan_type, bids_name in self._get_qc_targets(sub_ids, ses_ids, run_ids, scan_names,
+                                                                         scan_types):
+            qc_path = self._get_qc_path(sub_id, ses_id, scan_type)
+            if not overwrite and os.path.isfile(os.path.join(qc_path, bids_name + "_qc.json")):
+                continue
+            jobs.append([self._get_run_nifti_filepath(sub_id, ses_id, scan_type, bids_name),
+                         scan_type,
+                         qc_path,
+                         bids_name,
+                         self.qc_thresholds["spike_z"],
+                         self.qc_memory_budget_bytes,
+                         self.get_scan_types()[scan_type].qc])
+
+        results = qc.run_qc_jobs(jobs, self.num_qc_workers)
+
+        rows = self.write_qc_cohort_table()
+        failed = [[job[3], result["error"]] for job, result in zip(jobs, results) if "error" in result]
+        return len(jobs), failed, rows
+
+    def write_qc_cohort_table(self):
+        """
+        Collect the QC metrics of every run in the participant log into docs/qc_metrics.tsv, one line
+        per run with the reasons it fails self.qc_thresholds and the suggested ignore_ flag for
+        the participant log. Return the rows.
+        """
+        from backend.analysis import qc
+
+        rows = []
+        for wbic_id, sub_info, scan_info in self._get_selected_scans(self.get_participant_log()):
+            sub_id, ses_id = sub_info["sub_id"], scan_info["ses_id"]
+
+            for scan_type in self.get_scan_types(qc=True):
+                qc_path = self._get_qc_path(sub_id, ses_id, scan_type)
+                if not os.path.isdir(qc_path):
+                    continue
+
+                for filename in sorted(os.listdir(qc_path)):
+                    if not filename.endswith("_qc.json"):
+                        continue
+                    with open(os.path.join(qc_path, filename), "r") as file:
+                        metrics = json.load(file)
+
+                    bids_name = filename[:-len("_qc.json")]
+                    reasons = qc.get_exclusion_reasons(metrics, self.qc_thresholds)
+                    rows.append(dict(metrics,
+                                     sub_id=sub_id,
+                                     ses_id=ses_id,
+                                     bids_name=bids_name,
+                                     wbic_id=wbic_id,
+                                     reasons=reasons,
+                                     suggested_flag=self._get_suggested_flag(scan_info, sub_id, scan_type, bids_name)
+                                     if reasons else None))
+
+        with open(os.path.join(self.docs_path, "qc_metrics.tsv"), "w") as file:
+            file.write(qc.format_cohort_tsv(rows))
+
+        return rows
+
+    def _get_qc_targets(self, sub_ids=None, ses_ids=None, run_ids=None, scan_names=None, scan_types=None):
+        """
+        Return list of (sub_id, ses_id, scan_type, bids_name) of the selected converted runs
+        """
+        targets = []
+        for __, sub_info, scan_info in self._get_selected_scans(self.get_participant_log(), sub_ids, None, ses_ids):
+            for scan_type in self.get_scan_types(qc=True):
+
+                if scan_types is not None and scan_type not in scan_types:
+                    continue
+
+                for run in self._get_staged_runs(sub_info["sub_id"], scan_info["ses_id"], scan_type):
+                    if (run_ids is not None and run["run_id"] not in run_ids) or \
+                            (scan_names is not None and run["scan_name"] not in scan_names):
+                        continue
+                    if self._run_has_nii(sub_info["sub_id"], scan_info["ses_id"], scan_type, run["bids_name"]):
+                        targets.append([sub_info["sub_id"], scan_info["ses_id"], scan_type, run["bids_name"]])
+        return targets
+
+    def _get_qc_path(self, sub_id, ses_id, scan_type):
+        return os.path.join(self.preprocessing_path, sub_id, ses_id, scan_type, "qc")
+
+    def _get_run_nifti_filepath(self, sub_id, ses_id, scan_type, bids_name):
+        """
+        The dcm2niix output named bids_name.nii(.gz), or the first .nii(.gz) of the run
+        if dcm2niix added a suffix (e.g. _e2)
         """
-        result = {}
+        nii_path = os.path.join(self.preprocessing_path, sub_id, ses_id, scan_type, "nii", bids_name)
+        filenames = sorted(filename for filename in os.listdir(nii_path) if filename.endswith((".nii", ".nii.gz")))
+        for filename in [bids_name + ".nii.gz", bids_name + ".nii"]:
+            if filename in filenames:
+                return os.path.join(nii_path, filename)
+        return os.path.join(nii_path, filenames[0])
 
-        all_subs_paths = glob.glob(
-            os.path.join(self.preprocessing_path, "sub*"))
+    def _get_suggested_flag(self, scan_info, sub_id, scan_type, bids_name):
+        """
+        Flags number runs in raw_scans order before re-indexing, so the raw run number is found
+        from the staging index (see _get_staging_index()). If it is not known (raw scans pruned or
+        run staged before the index) the run number is used if no run of the scan is flagged.
+        Return None if the raw run number cannot be found.
+        """
+        scan_name = bids_name.split("_", 4)[-1]
+        run_number = int(bids_name.split("_")[3][len("run-"):])
 
-        for sub_path in all_subs_paths:
-            all_session_paths = glob.glob(
-                os.path.join(sub_path, "ses-*"))
-            sessions = [os.path.basename(ses_path) for ses_path in all_session_paths]
-            sub = os.path.basename(sub_path)
+        raw_series = self._get_staging_index(sub_id, scan_info["ses_id"], scan_type).get(bids_name)
+        raw_run_names = self.get_scan_types()[scan_type].get_matching_names(
+            scan_name, self._get_raw_series_names(scan_info["zk_id"]))
 
-            result.update({sub: sessions})
+        if raw_series in raw_run_names:
+            run_number = raw_run_names.index(raw_series) + 1
+        else:
+            exclusion_table = self._get_flag_exclusion_table(scan_info)
+            if scan_type in exclusion_table and (None in exclusion_table[scan_type] or
+                                                 scan_name in exclusion_table[scan_type]):
+                return None
 
-        return result
+        return "ignore_{0}-{1}_{2}".format(scan_type, scan_name, run_number)
 
 # ----------------------------------------------------------------------------------------------------------------------
 # Private Methods
@@ -273,18 +808,22 @@ class ProjectMaster():
 # Pulling Data from HPC
 # ----------------------------------------------------------------------------------------------------------------------
 
-    def _pull_scans_from_wbic_to_hpc(self, wbic_id, date_):
+    def _pull_scans_from_wbic_to_hpc(self, wbic_id, date_, zk_id):
         """
         SSH connect to to the HPC and use dcmconv.pl to download scans from WBIC to
-        a HPC folder /rds-d5/user/USERNAME/hpc-work/wbic-data.
+        a HPC folder /rds-d5/user/USERNAME/hpc-work/wbic-data/zk_id. Each session has
+        its own folder so sessions of the same participant can be downloaded at once.
         """
         command = "module load wbic && " \
-                  "cd /rds-d5/user/{0}/hpc-work/wbic-data && " \
+                  "rm -rf /rds-d5/user/{0}/hpc-work/wbic-data/{4} && " \
+                  "mkdir -p /rds-d5/user/{0}/hpc-work/wbic-data/{4} && " \
+                  "cd /rds-d5/user/{0}/hpc-work/wbic-data/{4} && " \
                   "/usr/local/software/wbic/bin/dcmconv.pl "  \
                   "-remoteae {1} -id {2} -date {3} -makedir -outtype dicom10 -direct -info -all".format(self.account,
                                                                                                         self.project_code,
                                                                                                         wbic_id,
-                                                                                                        date_)
+                                                                                                        date_,
+                                                                                                        zk_id)
         stdout = self._run_ssh_to_hpc(command)
 
         self.log("pulled scans from wbic to hpc ",
@@ -295,16 +834,17 @@ class ProjectMaster():
                                                                       self.account,
                                                                       stdout))
 
-    def _pull_scans_from_hpc_to_hivemind(self, wbic_id, date_):
+    def _pull_scans_from_hpc_to_hivemind(self, wbic_id, date_, zk_id):
         """
-        SSH connect to HPC and download scans to hivemind. See
-        _pull_scans_from_wbic_to_hpc()
+        SSH connect to HPC and download scans to the session's download dir on hivemind
+        (see _get_download_path()). See _pull_scans_from_wbic_to_hpc()
         """
-        command = "rsync -rsh /rds-d5/user/{0}/hpc-work/wbic-data/{1} {0}@{2}:{3} && " \
+        command = "rsync -rsh /rds-d5/user/{0}/hpc-work/wbic-data/{1}/{4} {0}@{2}:{3}/ && " \
                   "rm -rf /rds-d5/user/{0}/hpc-work/wbic-data/{1}".format(self.account,
-                                                                          wbic_id,
+                                                                          zk_id,
                                                                           self.server_to_download_to,
-                                                                          self.raw_scans_path)
+                                                                          self._get_download_path(zk_id),
+                                                                          wbic_id)
 
         stdout = self._run_ssh_to_hpc(command)
 
@@ -318,42 +858,72 @@ class ProjectMaster():
 
     def _run_ssh_to_hpc(self, command):
         """
-        Run the command on an SSH connection to the HPC. Try 5 times to connect
-        and if not sucessful, assert. If successful, return the stdout from the
-        ssh connection.
+        Run the command on an SSH connection to the HPC (from the connection pool, see
+        get_ssh_pool()). Try 5 times and if not sucessful, assert. If successful, return
+        the stdout from the ssh connection. A pooled connection dropped by the server raises
+        paramiko.SSHException, the pool then discards it and the next attempt opens a new one.
         """
+        import paramiko  # heavy backends are imported only when used, see benchmark_startup.py
+
         max_attempts = 5
         for attempt in range(max_attempts):
 
-            client = self._setup_ssh_to_hpc()
-
-            stdin, stdout, stderr = client.exec_command(command)
-            stdout_byte = stdout.read()
-            exit_code = stdout.channel.recv_exit_status()  # must come after stdout.read() for large output
+            try:
+                with self.get_ssh_pool().connection() as client:
+                    stdin, stdout, stderr = client.exec_command(command)
+                    stdout_byte = stdout.read()
+                    exit_code = stdout.channel.recv_exit_status()  # must come after stdout.read() for large output
+                    stderr_byte = stderr.read()
+            except (paramiko.SSHException, EOFError, OSError) as error:
+                self.log(None, "SSH connection error (attempt {0} of {1}): {2}".format(attempt + 1,
+                                                                                        max_attempts,
+                                                                                        error))
+                exit_code, stderr_byte = None, str(error).encode("utf-8")
 
-            client.close()
             if exit_code == 0:
                 return stdout_byte.decode("utf-8")
             else:
-                if attempt == 4:
+                if attempt == max_attempts - 1:
                     error = "subprocess failed in {0} attempts " \
                                   "for command: {1} with error {2}".format(max_attempts,
                                                                            command,
-                                                                           stderr.read().decode("utf-8"))
+                                                                           stderr_byte.decode("utf-8"))
                     self.log("SSH ERROR", error)
                     assert False, error
 
+    def get_ssh_pool(self):
+        """
+        Pool of SSH connections to the HPC (backend/utils/ssh_pool.py) so connections are
+        reused across commands and concurrent downloads.
+        """
+        with self._ssh_pool_lock:
+            if self.ssh_pool is None:
+                self.ssh_pool = ssh_pool.SSHConnectionPool(self._setup_ssh_to_hpc, self.max_ssh_connections)
+            return self.ssh_pool
+
+    def close_ssh_pool(self):
+        """
+        Close the idle connections of the SSH pool, if one was created. Call once no more HPC
+        commands will run (run_project.py / run_projects.py do so before exiting).
+        """
+        with self._ssh_pool_lock:
+            if self.ssh_pool is not None:
+                self.ssh_pool.close_all()
+
     def _setup_ssh_to_hpc(self):
         """
         Use paramiko to generate an ssh connection from hivemind to HPC.
         The SSH keys must already be setup and reside in /home/account/.ssh.
         """
+        import paramiko  # heavy backends are imported only when used, see benchmark_startup.py
+
         key = paramiko.RSAKey.from_private_key_file("".join(["/home/",
                                                              self.account,
                                                              "/.ssh/id_rsa"]))
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         client.connect(hostname="login.hpc.cam.ac.uk", username=self.account, pkey=key)
+        client.get_transport().set_keepalive(self.ssh_keepalive_seconds)  # connections wait idle in the pool
 
         return client
 
@@ -363,12 +933,14 @@ class ProjectMaster():
         zk_id for backups. This is /raw_scans/zk_id/zk_id/scan_dirs.
 
         For full backup, the common protocol sheet must be included in the
-        first level zk_id dir and the second level zk_id dir zipped.
+        first level zk_id dir and the second level zk_id dir zipped (see
+        archive_raw_scans()).
         """
 
         zk_id_path = os.path.join(self.raw_scans_path, zk_id, zk_id)
 
-        wbic_scan_files_path = glob.glob(os.path.join(self.raw_scans_path, wbic_id, "*"))[0]
+        download_path = self._get_download_path(zk_id)
+        wbic_scan_files_path = glob.glob(os.path.join(download_path, wbic_id, "*"))[0]
 
         self.log("Extract wbic data to zk folder",
                  "zk_id_path: " + zk_id_path + "\n "
@@ -379,7 +951,14 @@ class ProjectMaster():
                    zk_id_path,
                    move_contents_only=True)
 
-        shutil.rmtree(os.path.join(self.raw_scans_path, wbic_id))
+        shutil.rmtree(download_path)
+
+    def _get_download_path(self, zk_id):
+        """
+        Hidden dir in raw_scans the session is downloaded to before it is moved to raw_scans/zk_id.
+        It is per session (not per wbic_id) as sessions of one participant can be downloaded at once.
+        """
+        return os.path.join(self.raw_scans_path, "." + zk_id + ".download")
 
 # Copying data from raw scans to preprocessing
 # ----------------------------------------------------------------------------------------------------------------------
@@ -408,191 +987,1434 @@ class ProjectMaster():
                                                                                              scan_info["zk_id"]))
         return ses_exists
 
-    def check_if_scan_type_is_in_ses_folder(self, sub_id, ses_id, scan_type):
-        """
-        Check if the scan is already copied into the ses path e.g. preprocessing/sub-001/ses-001/func
-        Used to skip already-downloaded scans
-        """
-        scan_type_path = os.path.join(self.preprocessing_path,
-                                     sub_id,
-                                     ses_id,
-                                     scan_type)
-        return os.path.isdir(scan_type_path)
+    def check_if_scan_type_is_in_ses_folder(self, sub_id, ses_id, scan_type):
+        """
+        Check if the scan is already copied into the ses path e.g. preprocessing/sub-001/ses-001/func
+        Used to skip already-downloaded scans
+        """
+        scan_type_path = os.path.join(self.preprocessing_path,
+                                     sub_id,
+                                     ses_id,
+                                     scan_type)
+        return os.path.isdir(scan_type_path)
+
+    def _copy_data_to_preprocessing(self, scan_type, scan_info, sub_info):
+        """
+        Function to coordinate data copying from raw_scans to BIDS in preprocessing.
+        see self.move_raw_to_preprocessing()
+
+        scan_type: a scan type of the project e.g. "mrs", "func", "anat", see get_scan_types()
+
+        Return True if every run of the scan type is in preprocessing (see
+        _copy_data_from_raw_scans_to_preprocessing()), so the raw scans can be pruned.
+
+        TODO: bit repetitive as if raw scans dir is not present it will log the same response
+        many times, but do not want to take this a level up to download_and_copy as bnecomes too verbose.
+        """
+        scan_details = self.get_scan_types()[scan_type].scan_details
+        num_expected_files = self.get_scan_types()[scan_type].num_expected_files
+
+        if scan_details:
+
+            raw_scan_folder = os.path.join(self.raw_scans_path, scan_info["zk_id"])
+
+            if os.path.isdir(raw_scan_folder):
+
+                self.log("Copying raw {0} data to preprocessing folder".format(scan_type),
+                         "Copying: {0}, {1}, {2}, {3}\n".format(scan_type,
+                                                                scan_info["zk_id"],
+                                                                sub_info["sub_id"],
+                                                                scan_info["ses_id"]))
+
+                all_runs_copied = self._copy_data_from_raw_scans_to_preprocessing(scan_info,
+                                                                                  sub_info["sub_id"],
+                                                                                  scan_details,
+                                                                                  scan_type,
+                                                                                  num_expected_files)
+            else:
+                self.log("Copying raw {0} data to preprocessing folder".format(scan_type),
+                         "no raw scans found for {0}, no data copied".format(scan_info["zk_id"]))
+                all_runs_copied = False
+
+            if os.path.isdir(raw_scan_folder) and \
+                    not os.path.isdir(os.path.join(raw_scan_folder, scan_info["zk_id"])):
+                self.log(None, "WARNING: raw scans for {0} have been pruned after archival, "
+                               "extract {0}.tar.zst to copy this data".format(scan_info["zk_id"]))
+
+            return all_runs_copied
+
+        return True
+
+
+    def check_for_duplicate_str_in_list(self, list_):
+        """
+        Set() function will remove any duplicates
+        """
+        return len(list_) == len(set(list_))
+
+
+    def _copy_data_from_raw_scans_to_preprocessing(self,  # TODO: will pprobably end up needing to write a function to unpack scan details
+                                                   scan_info,
+                                                   sub_id,
+                                                   scan_details,
+                                                   data_name,
+                                                   num_expected_files):
+        """
+        see  see self.move_raw_to_preprocessing()
+
+        Only the runs in the staging delta are copied, see _get_staging_delta(). Return True if
+        every run was copied and every up to date run still matches its raw series (_run_is_copied()).
+        """
+        delta = self._get_staging_delta(scan_info, sub_id, scan_details, data_name)
+        self._log_staging_delta(delta, data_name)
+
+        all_runs_copied = True
+        for run in delta["copy"] + delta["replace"] + delta["check"]:
+
+            all_runs_copied &= self._copy_run_to_preprocessing(run["raw_path"],
+                                                               run["destination_path"],
+                                                               num_expected_files,
+                                                               replace_existing=run in delta["replace"])
+
+        for run in delta["up_to_date"]:
+            if run["raw_path"] is not None and not self._run_is_copied(run["raw_path"], run["destination_path"]):
+                self.log(None, "WARNING: {0} does not match {1}".format(run["destination_path"], run["raw_path"]))
+                all_runs_copied = False
+
+        return all_runs_copied
+
+    def _get_staging_delta(self, scan_info, sub_id, scan_details, data_name, log=True):
+        """
+        Compare the runs to copy (from raw_scans and the flags, see _get_runs_to_copy()) with
+        the runs already staged and the staging index (see _get_staging_index()). Return dict
+        of lists of runs:
+
+            copy:          not yet staged
+            replace:       staged from a different raw series (e.g. a flag was added so runs
+                           were re-indexed), copied again
+            check:         staged before the staging index was written, checked against the raw
+                           series and copied again only if they do not match
+            up_to_date:    staged from the same raw series, not touched
+            not_selected:  staged but no longer a run to copy (e.g. now flagged). These are
+                           left in place and logged, remove them by hand.
+
+        If the raw series are not available (e.g. pruned after archival) all staged runs are up_to_date.
+        """
+        staged_runs = self._get_staged_runs(sub_id, scan_info["ses_id"], data_name)
+        delta = {"copy": [], "replace": [], "check": [], "up_to_date": [], "not_selected": []}
+
+        if not os.path.isdir(os.path.join(self.raw_scans_path, scan_info["zk_id"], scan_info["zk_id"])):
+            delta["up_to_date"] = staged_runs
+            return delta
+
+        staging_index = self._get_staging_index(sub_id, scan_info["ses_id"], data_name)
+        staged_bids_names = [run["bids_name"] for run in staged_runs]
+        runs_to_copy = self._get_runs_to_copy(scan_info, sub_id, scan_details, data_name, log)
+
+        for run in runs_to_copy:
+            if run["bids_name"] not in staged_bids_names:
+                delta["copy"].append(run)
+            elif run["bids_name"] not in staging_index:
+                delta["check"].append(run)
+            elif staging_index[run["bids_name"]] != os.path.basename(run["raw_path"]):
+                delta["replace"].append(run)
+            else:
+                delta["up_to_date"].append(run)
+
+        bids_names_to_copy = [run["bids_name"] for run in runs_to_copy]
+        delta["not_selected"] = [run for run in staged_runs if run["bids_name"] not in bids_names_to_copy]
+
+        return delta
+
+    def _get_bytes_to_stage(self, sub_id, scan_info):
+        """
+        Total size of the raw series that move_raw_to_preprocessing() would copy (runs to copy,
+        replace or check in the staging delta of each scan type)
+        """
+        num_bytes = 0
+        for scan_type, scan_type_info in self.get_scan_types(collected_only=True).items():
+            delta = self._get_staging_delta(scan_info, sub_id, scan_type_info.scan_details, scan_type, log=False)
+            for run in delta["copy"] + delta["replace"] + delta["check"]:
+                num_bytes += self._get_dir_size_bytes(run["raw_path"])
+        return num_bytes
+
+    def _log_staging_delta(self, delta, data_name):
+        if not any(delta.values()):
+            return
+
+        self.log(None, "{0} staging delta: {1} to copy, {2} to replace, {3} to check, "
+                       "{4} up to date, {5} not selected".format(data_name,
+                                                                 len(delta["copy"]),
+                                                                 len(delta["replace"]),
+                                                                 len(delta["check"]),
+                                                                 len(delta["up_to_date"]),
+                                                                 len(delta["not_selected"])))
+        for key in ["copy", "replace", "check"]:
+            for run in delta[key]:
+                self.log(None, "{0}: {1} from {2}".format(key, run["bids_name"], run["raw_path"]))
+
+        for run in delta["replace"]:
+            self.log(None, "WARNING: {0} was staged from a different raw series, any converted or recon-all "
+                           "output for this run is out of date and must be run again".format(run["bids_name"]))
+
+        for run in delta["not_selected"]:
+            self.log(None, "WARNING: {0} is staged but is no longer selected (check the flags and "
+                           "scan details), it was not removed".format(run["destination_path"]))
+
+    def _get_staging_index_filepath(self, sub_id, ses_id, scan_type):
+        return os.path.join(self.preprocessing_path, sub_id, ses_id, scan_type, "raw", ".staging_index.json")
+
+    def _get_staging_index(self, sub_id, ses_id, scan_type):
+        """
+        Return {bids_name: raw series folder name} for the runs staged in
+        preprocessing/sub/ses/scan_type/raw. Written by _record_staged_run().
+        """
+        filepath = self._get_staging_index_filepath(sub_id, ses_id, scan_type)
+        if not os.path.isfile(filepath):
+            return {}
+        with open(filepath, "r") as file:
+            return json.load(file)
+
+    def _record_staged_run(self, raw_data_to_copy, destination_path):
+        """
+        Add the raw series of a staged run to the staging index. The index is written to a
+        temporary file and renamed, and locked as runs of a session may be staged in parallel.
+        """
+        ses_path, scan_type = os.path.split(os.path.dirname(os.path.dirname(destination_path)))
+        sub_path, ses_id = os.path.split(ses_path)
+        sub_id = os.path.basename(sub_path)
+
+        with self._staging_index_lock:
+            staging_index = self._get_staging_index(sub_id, ses_id, scan_type)
+            staging_index[os.path.basename(destination_path)] = os.path.basename(os.path.normpath(raw_data_to_copy))
+
+            filepath = self._get_staging_index_filepath(sub_id, ses_id, scan_type)
+            with open(filepath + ".partial", "w") as file:
+                json.dump(staging_index, file, indent=4, sort_keys=True)
+            os.replace(filepath + ".partial", filepath)
+
+    def _get_runs_to_copy(self, scan_info, sub_id, scan_details, data_name, log=True):
+        """
+        Search raw_scans for all runs of every scan in scan_details and return a list of
+        dicts (scan_name, run_id, bids_name, raw_path, destination_path), one per run to
+        copy to preprocessing. Runs flagged in the participant log are not included, and
+        run numbers are re-indexed so saved runs are contiguous.
+
+        No data is touched so this is also used to plan work (see plan_work())
+        """
+        preprocessing_raw_data_path = os.path.join(self.preprocessing_path,
+                                                   sub_id,
+                                                   scan_info["ses_id"],
+                                                   data_name, "raw")
+        exclusion_table = self._get_flag_exclusion_table(scan_info)
+
+        scan_type = self.get_scan_types()[data_name]
+        raw_series_path = os.path.join(self.raw_scans_path,
+                                       scan_info["zk_id"], scan_info["zk_id"])  # zk_id twice for backups organisation
+        raw_series_names = self._get_raw_series_names(scan_info["zk_id"])
+
+        runs = []
+        for scan_name in scan_details.keys():
+
+            task_name = scan_details[scan_name]["task_name"]
+
+            ordered_scan_run_paths = [os.path.join(raw_series_path, name) for name in
+                                      scan_type.get_matching_names(scan_name, raw_series_names)]
+
+            if log and any(ordered_scan_run_paths) and \
+                    self.check_for_duplicate_str_in_list(ordered_scan_run_paths):
+                self.log(None, "WARNING! Duplicate run detected in raw scans for " + scan_name)
+
+            saved_run_idx = 0
+            for true_run_idx, raw_data_to_copy in enumerate(ordered_scan_run_paths):
+
+                if self._skip_run_based_on_flags(scan_info, exclusion_table, true_run_idx, data_name, scan_name,
+                                                 log):
+                    continue
+
+                bids_file_name = self._get_bids_filename(sub_id, scan_info["ses_id"], task_name,
+                                                         saved_run_idx, scan_name)
+                runs.append({"scan_name": scan_name,
+                             "run_id": "run-{:03}".format(saved_run_idx + 1),
+                             "bids_name": bids_file_name,
+                             "raw_path": raw_data_to_copy,
+                             "destination_path": os.path.join(preprocessing_raw_data_path,
+                                                              bids_file_name)})
+                saved_run_idx += 1
+
+        return runs
+
+    def _copy_run_to_preprocessing(self, raw_data_to_copy, destination_path, num_expected_files,
+                                   replace_existing=False):
+        """
+        Copy the run to a hidden temporary sibling of destination_path, check every file was
+        copied and only then rename it to destination_path, so a crash never leaves a part-copied
+        run in preprocessing (the temporary dir is removed on the next run).
+
+        If destination_path already holds every file of the run (same names and sizes) nothing
+        is copied, so staging can be re-run safely. A run that does not match, or any existing
+        run if replace_existing, is copied again and replaced. The raw series of the staged run
+        is saved in the staging index. Return True if the run is staged.
+        """
+        staging_path, stale_path = self._get_staging_paths(destination_path)
+        for leftover_path in [staging_path, stale_path]:
+            if os.path.isdir(leftover_path):
+                self.log(None, "Removing {0} left by an interrupted copy".format(leftover_path))
+                shutil.rmtree(leftover_path)
+
+        if os.path.isdir(destination_path):
+            if not os.path.isdir(raw_data_to_copy):  # raw may be pruned
+                self.log(None, "{0} is already staged, skipping".format(destination_path))
+                return True
+            if not replace_existing and self._run_is_copied(raw_data_to_copy, destination_path):
+                self.log(None, "{0} is already staged, skipping".format(destination_path))
+                self._record_staged_run(raw_data_to_copy, destination_path)
+                return True
+            if replace_existing:
+                self.log(None, "Replacing {0} with {1}".format(destination_path, raw_data_to_copy))
+            else:
+                self.log(None, "WARNING: {0} does not match {1}, copying again".format(destination_path,
+                                                                                      raw_data_to_copy))
+
+        copied = self._copy_dir_contents(raw_data_to_copy,
+                                         staging_path,
+                                         pseudonym=self._get_sub_id_from_run_path(destination_path)
+                                         if self.deidentify_staged_dicoms else None)
+
+        deidentified_sizes = self._get_file_sizes(staging_path) if copied and self.deidentify_staged_dicoms else None
+        if not copied or not self._run_is_copied(raw_data_to_copy, staging_path, deidentified_sizes):
+            self.log(None, "ERROR: copy {0}of {1} is incomplete, run not staged".format(
+                "and de-identification " if self.deidentify_staged_dicoms else "", raw_data_to_copy))
+            shutil.rmtree(staging_path, ignore_errors=True)
+            return False
+
+        if os.path.isdir(destination_path):
+            os.rename(destination_path, stale_path)
+            os.rename(staging_path, destination_path)
+            shutil.rmtree(stale_path)
+            self._remove_run_outputs(destination_path)
+        else:
+            os.rename(staging_path, destination_path)
+
+        if deidentified_sizes is not None:
+            self._save_deidentified_sizes(destination_path, deidentified_sizes)
+        self._record_staged_run(raw_data_to_copy, destination_path)
+
+        self._test_and_log_expected_file_number(destination_path,
+                                               num_expected_files)
+        return True
+
+    def _remove_run_outputs(self, destination_path):
+        """
+        Remove the converted and QC outputs of a staged run that was replaced, so they are made
+        again from the new raw series. dcm2niix would otherwise add a suffix next to the old output
+        (e.g. <bids_name>a.nii.gz) and the old files would still be used.
+        """
+        scan_type_path, bids_name = os.path.split(os.path.dirname(destination_path))[0], os.path.basename(destination_path)
+        output_paths = [os.path.join(scan_type_path, "nii", bids_name),
+                        os.path.join(scan_type_path, "npy", bids_name + ".npy"),   # mrs, see _consolidate_mrs_runs()
+                        os.path.join(scan_type_path, "npy", bids_name + ".json"),
+                        os.path.join(scan_type_path, "qc", bids_name + "_qc.json"),  # see run_qc()
+                        os.path.join(scan_type_path, "qc", bids_name + "_tsnr.nii.gz")]
+
+        for output_path in output_paths:
+            if os.path.isdir(output_path):
+                shutil.rmtree(output_path)
+            elif os.path.isfile(output_path):
+                os.remove(output_path)
+            else:
+                continue
+            self.log(None, "Removed {0} of the replaced run".format(output_path))
+
+    def _get_staging_paths(self, destination_path):
+        """
+        Hidden siblings used while staging a run, ignored when listing runs
+        """
+        parent_path, run_name = os.path.split(destination_path)
+        return os.path.join(parent_path, "." + run_name + ".staging"), os.path.join(parent_path, "." + run_name + ".stale")
+
+    def _run_is_copied(self, raw_data_path, destination_path, deidentified_sizes=None):
+        """
+        Every raw file is in destination_path with the same size. De-identified copies are smaller
+        than the raw files, so their sizes are compared to deidentified_sizes instead, by default the
+        sizes saved when the run was staged (see _save_deidentified_sizes()). A de-identified run with
+        no saved sizes is not considered copied.
+        """
+        raw_file_sizes = self._get_file_sizes(raw_data_path)
+        destination_file_sizes = self._get_file_sizes(destination_path)
+        if not self.deidentify_staged_dicoms:
+            return raw_file_sizes == destination_file_sizes
+
+        if deidentified_sizes is None:
+            deidentified_sizes = self._load_deidentified_sizes(destination_path)
+        return raw_file_sizes.keys() == destination_file_sizes.keys() and destination_file_sizes == deidentified_sizes
+
+    def _get_deidentified_sizes_filepath(self, destination_path):
+        parent_path, run_name = os.path.split(destination_path)
+        return os.path.join(parent_path, "." + run_name + ".deidentified.json")  # hidden, see _get_staging_paths()
+
+    def _save_deidentified_sizes(self, destination_path, deidentified_sizes):
+        """
+        Save the file sizes of a run that was de-identified while staging, so a later truncated
+        or changed file is found by _run_is_copied()
+        """
+        filepath = self._get_deidentified_sizes_filepath(destination_path)
+        with open(filepath + ".partial", "w") as file:
+            json.dump(deidentified_sizes, file, indent=4, sort_keys=True)
+        os.replace(filepath + ".partial", filepath)
+
+    def _load_deidentified_sizes(self, destination_path):
+        filepath = self._get_deidentified_sizes_filepath(destination_path)
+        if not os.path.isfile(filepath):
+            return None
+        with open(filepath, "r") as file:
+            return json.load(file)
+
+    def _get_sub_id_from_run_path(self, run_path):
+        """
+        preprocessing/sub/ses/scan_type/raw/bids_name
+        """
+        return os.path.basename(run_path).split("_")[0]
+
+    def _get_file_sizes(self, path):
+        with os.scandir(path) as entries:
+            return {entry.name: entry.stat().st_size for entry in entries if entry.is_file()}
+
+    def _get_flag_exclusion_table(self, scan_info):
+        """
+        Runs to skip copying are set in the "flags" entry of the "scan" dict field
+        in self.participant log, parsed once per scan (see backend/utils/flags.py)
+        """
+        return flags.get_exclusion_table(scan_info.get("flags", []),
+                                         list(self.get_scan_types()))
+
+    def _skip_run_based_on_flags(self, scan_info, exclusion_table, run_idx, data_name, scan_name, log=True):
+        """
+        Check a run against the exclusion table from _get_flag_exclusion_table()
+        """
+        if flags.run_is_excluded(exclusion_table, data_name, scan_name, run_idx + 1):
+
+            if log:
+                self.log(None,
+                         "Did not copy run {0} of {1} for scan {2} "
+                         "based on the flags {3}".format(run_idx + 1,
+                                                         scan_name,
+                                                         scan_info["zk_id"],
+                                                         scan_info["flags"]))
+            return True
+        return False
+
+    def _dump_info_file_in_session_dir(self, wbic_id, scan_info, sub_info):
+        """
+        Write a file to a ses-XXX dir containing all information about the
+        sub / session. This file is used for tests on the scan datetime.
+        """
+        ses_path = os.path.join(self.preprocessing_path,
+                                sub_info["sub_id"],
+                                scan_info["ses_id"])
+
+        if os.path.isdir(ses_path):
+
+            info = "project_code: {0}\n" \
+                   "wbic_id: {1}\n" \
+                   "sub_id: {2}\n" \
+                   "ses_id {3}\n" \
+                   "zk_id: {4}\n" \
+                   "scan_date: {5}\n" \
+                   "scan_start_time: {6}\n" \
+                   "\nDo not edit this file".format(self.project_code,
+                                                    wbic_id,
+                                                    sub_info["sub_id"],
+                                                    scan_info["ses_id"],
+                                                    scan_info["zk_id"],
+                                                    scan_info["date"],
+                                                    scan_info["time_start"])
+
+            filename = scan_info["ses_id"] + "_info.txt"
+
+            with open(os.path.join(
+                                   ses_path, filename), "w") as file:
+                file.write(info)
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Planning Work
+# ----------------------------------------------------------------------------------------------------------------------
+
+    def plan_work(self, download=True, stage=True, convert=True, recon=False, sub_ids=None, zk_ids=None,
+                  ses_ids=None, run_ids=None, scan_names=None, scan_types=None):
+        """
+        Build a WorkGraph (backend/utils/work_graph.py) of all pending work for the project
+        without touching any data. The participant log is joined against a single
+        scan of raw_scans and preprocessing.
+
+        Tasks (see run_task()):
+            download:         scan not yet in raw_scans, download from HPC.
+            extract:          move downloaded data to the zk_id folder and test the download.
+            stage_run:        scan downloaded, copy a single run to preprocessing.
+            stage_session:    scan not yet downloaded so runs are unknown, copy the session
+                              after download.
+            convert_run:      run staged (or planned) in preprocessing/raw but no .nii in nii/, run dcm2niix.
+                              For mrs runs, consolidate the spectra to npy/ (see run_mrs_consolidation()).
+            convert_session:  dcm2niix (and mrs consolidation) on all runs of a session that is not yet staged.
+            recon_run:        anat run converted (or planned) but recon-all not finished.
+            recon_session:    recon-all on all anat runs of a session that is not yet staged.
+
+        sub_ids / zk_ids / ses_ids restrict planning to these subjects / scans / sessions and
+        run_ids / scan_names / scan_types to these runs of downloaded sessions (None for all).
+        Sessions that are not yet downloaded are always downloaded and staged whole.
+
+        Estimates bytes and time for each task from raw data sizes and the throughputs in
+        self.planning_bytes_per_second. Print with graph.format_dry_run() or run with execute_work_graph()
+        or run_work_graph_with_scheduler().
+        """
+        graph = work_graph.WorkGraph()
+        participant_log = self.get_participant_log()
+
+        downloaded_zk_ids = set(os.listdir(self.raw_scans_path)) if os.path.isdir(self.raw_scans_path) else set()
+
+        pending_downloads = []
+        for wbic_id, sub_info, scan_info in self._get_selected_scans(participant_log, sub_ids, zk_ids, ses_ids):
+
+            common_kwargs = {"wbic_id": wbic_id,
+                             "sub_info": sub_info,
+                             "scan_info": scan_info}
+
+            if scan_info["zk_id"] in downloaded_zk_ids:
+                self._plan_downloaded_session(graph, common_kwargs, stage, convert, recon,
+                                              run_ids, scan_names, scan_types)
+            else:
+                pending_downloads.append(common_kwargs)
+
+        # estimate download size from the archive manifests of downloaded sessions, or the sessions on disk
+        staged_bytes = [task.estimated_bytes for task in graph.get_all_tasks() if task.kind == "stage_run"]
+        num_sessions = len(set(task.session_key for task in graph.get_all_tasks() if task.kind == "stage_run"))
+        session_bytes = self.estimated_bytes_per_session or self._get_mean_manifest_session_bytes() or \
+            (sum(staged_bytes) / num_sessions if num_sessions else None)
+
+        for common_kwargs in pending_downloads:
+            self._plan_session_to_download(graph, common_kwargs, session_bytes, download, stage, convert, recon)
+
+        return graph
+
+    def _get_selected_scans(self, participant_log, sub_ids=None, zk_ids=None, ses_ids=None):
+        """
+        Return list of (wbic_id, sub_info, scan_info) for every scan in the participant log, in
+        wbic_id order, restricted to sub_ids / zk_ids / ses_ids (None for all).
+        """
+        selected_scans = []
+        for wbic_id in sorted(participant_log.keys()):
+            sub_info = participant_log[wbic_id]
+
+            if sub_ids is not None and sub_info["sub_id"] not in sub_ids:
+                continue
+
+            for scan_info in sub_info["scans"].values():
+
+                if zk_ids is not None and scan_info["zk_id"] not in zk_ids:
+                    continue
+
+                if ses_ids is not None and scan_info["ses_id"] not in ses_ids:
+                    continue
+
+                selected_scans.append([wbic_id, sub_info, scan_info])
+
+        return selected_scans
+
+    def _plan_downloaded_session(self, graph, common_kwargs, stage, convert, recon, run_ids=None, scan_names=None,
+                                 scan_types=None):
+        """
+        Add stage_run, convert_run and recon_run tasks for a session that is in raw_scans. See plan_work()
+        """
+        sub_id = common_kwargs["sub_info"]["sub_id"]
+        scan_info = common_kwargs["scan_info"]
+        zk_id = scan_info["zk_id"]
+
+        for scan_type, scan_type_info in self.get_scan_types(collected_only=True).items():
+
+            if scan_types is not None and scan_type not in scan_types:
+                continue
+
+            scan_details = scan_type_info.scan_details
+            num_expected_files = scan_type_info.num_expected_files
+
+            if stage:
+                delta = self._get_staging_delta(scan_info, sub_id, scan_details, scan_type, log=False)
+                runs_to_stage = delta["copy"] + delta["replace"] + delta["check"]
+                runs = runs_to_stage + delta["up_to_date"]
+            else:
+                delta = {"replace": []}
+                runs_to_stage = []
+                runs = self._get_staged_runs(sub_id, scan_info["ses_id"], scan_type)
+
+            for run in runs:
+
+                if (run_ids is not None and run["run_id"] not in run_ids) or \
+                        (scan_names is not None and run["scan_name"] not in scan_names):
+                    continue
+
+                dependencies = []
+                run_bytes = self._get_dir_size_bytes(run["raw_path"] if run in runs_to_stage else
+                                                     run["destination_path"])
+
+                if run in runs_to_stage:
+                    stage_task = graph.add_task(
+                        work_graph.Task("stage_run:{0}:{1}:{2}".format(zk_id, scan_type, run["bids_name"]),
+                                        "stage_run",
+                                        zk_id,
+                                        dict(common_kwargs,
+                                             scan_type=scan_type,
+                                             num_expected_files=num_expected_files,
+                                             replace_existing=run in delta["replace"],
+                                             **run),
+                                        estimated_bytes=run_bytes,
+                                        estimated_seconds=self._estimate_task_seconds("stage", run_bytes)))
+                    dependencies = [stage_task.task_id]
+
+                if convert and scan_type_info.converter and \
+                        (run in delta["replace"] or
+                         not self._run_is_converted(sub_id, scan_info["ses_id"], scan_type, run["bids_name"])):
+                    convert_task = graph.add_task(
+                        work_graph.Task("convert_run:{0}:{1}:{2}".format(zk_id, scan_type, run["bids_name"]),
+                                        "convert_run",
+                                        zk_id,
+                                        dict(common_kwargs,
+                                             scan_type=scan_type,
+                                             bids_name=run["bids_name"]),
+                                        dependencies=dependencies,
+                                        estimated_bytes=run_bytes,
+                                        estimated_seconds=self._estimate_task_seconds("convert", run_bytes)))
+                    dependencies = [convert_task.task_id]
+
+                if recon and scan_type_info.recon and \
+                        not self._run_has_recon(sub_id, scan_info["ses_id"], run["bids_name"]):
+                    graph.add_task(
+                        work_graph.Task("recon_run:{0}:{1}:{2}".format(zk_id, scan_type, run["bids_name"]),
+                                        "recon_run",
+                                        zk_id,
+                                        dict(common_kwargs,
+                                             scan_type=scan_type,
+                                             bids_name=run["bids_name"]),
+                                        dependencies=dependencies,
+                                        estimated_bytes=run_bytes,
+                                        estimated_seconds=self._estimate_task_seconds("recon", run_bytes)))
+
+    def _plan_session_to_download(self, graph, common_kwargs, session_bytes, download, stage, convert, recon):
+        """
+        Add session-level tasks for a session not yet in raw_scans. Runs cannot be
+        known until the data is downloaded. See plan_work()
+        """
+        if not download:
+            return
+
+        zk_id = common_kwargs["scan_info"]["zk_id"]
+        dependencies = []
+
+        for kind, stage_name, do_task in [["download", "download", True],
+                                          ["extract", "extract", True],
+                                          ["stage_session", "stage", stage],
+                                          ["convert_session", "convert", convert],
+                                          ["recon_session", "recon", recon]]:
+            if not do_task:
+                continue
+
+            task = graph.add_task(work_graph.Task("{0}:{1}".format(kind, zk_id),
+                                                  kind,
+                                                  zk_id,
+                                                  dict(common_kwargs),
+                                                  dependencies=dependencies,
+                                                  estimated_bytes=session_bytes,
+                                                  estimated_seconds=self._estimate_task_seconds(stage_name,
+                                                                                                session_bytes)))
+            dependencies = [task.task_id]
+
+    def _get_mean_manifest_session_bytes(self):
+        """
+        Mean size of the raw scans of downloaded sessions from their archive manifests
+        (see archive_raw_scans()), None if no session has a manifest.
+        """
+        if not os.path.isdir(self.raw_scans_path):
+            return None
+
+        session_bytes = []
+        for zk_id in os.listdir(self.raw_scans_path):
+            manifest_filepath = archive.get_manifest_filepath(os.path.join(self.raw_scans_path, zk_id), zk_id)
+            if os.path.isfile(manifest_filepath):
+                session_bytes.append(sum(archive.load_manifest(manifest_filepath).values()))
+
+        return sum(session_bytes) / len(session_bytes) if session_bytes else None
+
+    def _estimate_task_seconds(self, stage_name, num_bytes):
+        if num_bytes is None:
+            return None
+        return num_bytes / self.planning_bytes_per_second[stage_name]
+
+    def _get_staged_runs(self, sub_id, ses_id, scan_type):
+        """
+        Return the runs already copied to preprocessing/sub/ses/scan_type/raw in the
+        same format as _get_runs_to_copy()
+        """
+        raw_path = os.path.join(self.preprocessing_path, sub_id, ses_id, scan_type, "raw")
+        if not os.path.isdir(raw_path):
+            return []
+
+        runs = []
+        with os.scandir(raw_path) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if entry.is_dir() and not entry.name.startswith("."):  # see _get_staging_paths()
+                    runs.append({"scan_name": entry.name.split("_", 4)[-1],
+                                 "run_id": entry.name.split("_")[3],
+                                 "bids_name": entry.name,
+                                 "raw_path": None,
+                                 "destination_path": entry.path})
+        return runs
+
+    def _run_is_converted(self, sub_id, ses_id, scan_type, bids_name):
+        if scan_type == "mrs":
+            return os.path.isfile(self._get_mrs_npy_filepath(sub_id, ses_id, bids_name))
+        return self._run_has_nii(sub_id, ses_id, scan_type, bids_name)
+
+    def _run_has_nii(self, sub_id, ses_id, scan_type, bids_name):
+        nii_path = os.path.join(self.preprocessing_path, sub_id, ses_id, scan_type, "nii", bids_name)
+        if not os.path.isdir(nii_path):
+            return False
+        with os.scandir(nii_path) as entries:
+            return any(entry.name.endswith((".nii", ".nii.gz")) for entry in entries)
+
+    def _run_has_recon(self, sub_id, ses_id, bids_name):
+        subjects_dir, subject_id, __ = self._get_recon_all_paths(sub_id, ses_id, bids_name)
+        legacy_recon_done_filepath = os.path.join(self.preprocessing_path, sub_id, ses_id, "anat", "nii", bids_name,
+                                                  sub_id, "scripts", "recon-all.done")  # subjects_dir was in nii/
+        return freesurfer.is_finished(subjects_dir, subject_id) or os.path.isfile(legacy_recon_done_filepath)
+
+    def run_task(self, task):
+        """
+        Execute a single task from plan_work(). Return True if the task succeeded.
+        """
+        kwargs = task.kwargs
+        sub_id = kwargs["sub_info"]["sub_id"]
+        ses_id = kwargs["scan_info"]["ses_id"]
+
+        self.init_logging(kwargs["scan_info"]["date"],
+                          kwargs["scan_info"]["zk_id"])
+
+        if task.kind == "download":
+            if self.scan_already_downloaded(kwargs["scan_info"]["zk_id"]):
+                return False
+            return self._pull_scans_to_raw_scans(kwargs["wbic_id"], kwargs["scan_info"])
+
+        elif task.kind == "extract":
+            return self._extract_and_test_download(kwargs["wbic_id"], kwargs["scan_info"])
+
+        elif task.kind == "stage_session":
+            return self.move_raw_to_preprocessing(kwargs["wbic_id"], kwargs["sub_info"], kwargs["scan_info"])
+
+        elif task.kind == "stage_run":
+            self._check_ses_exists_mkdir_if_not(sub_id, kwargs["scan_info"], log=True)
+            staged = self._copy_run_to_preprocessing(kwargs["raw_path"],
+                                                     kwargs["destination_path"],
+                                                     kwargs["num_expected_files"],
+                                                     kwargs.get("replace_existing", False))
+            self._dump_info_file_in_session_dir(kwargs["wbic_id"], kwargs["scan_info"], kwargs["sub_info"])
+            return staged
+
+        elif task.kind == "convert_run" and self.get_scan_types()[kwargs["scan_type"]].converter == "mrs":
+            return self._consolidate_mrs_runs([[sub_id, ses_id, "mrs", kwargs["bids_name"]]]) == 1
+
+        elif task.kind == "convert_run":
+            results = self._convert_runs_with_dcm2niix([[sub_id, ses_id, kwargs["scan_type"], kwargs["bids_name"]]], {})
+            return results[0].succeeded()
+
+        elif task.kind == "convert_session":
+            self.convert_session(sub_id, ses_id)
+            return True
+
+        elif task.kind == "recon_run":
+            return self._run_recon_all_jobs([[sub_id, ses_id, "anat", kwargs["bids_name"]]],
+                                            num_cores=self.recon_all_threads_per_job)
+
+        elif task.kind == "recon_session":
+            # one recon-all job at a time, the recon pool already runs as many tasks as fit on the cores
+            self.recon_session(sub_id, ses_id, num_cores=self.recon_all_threads_per_job)
+            return True
+
+        assert False, "Task kind {0} is not recognised".format(task.kind)
+
+    def execute_work_graph(self, graph):
+        """
+        Run all tasks in the graph one at a time in order. If a task fails (returns False or raises),
+        all tasks that depend on it are skipped but other sessions continue.
+        Return dict {task_id: "done" / "failed" / "skipped"}
+        """
+        status = {}
+        for task in graph.topological_order():
+
+            if any(status[dependency] != "done" for dependency in task.dependencies):
+                status[task.task_id] = "skipped"
+                continue
+
+            try:
+                status[task.task_id] = "done" if self.run_task(task) else "failed"
+            except Exception as error:
+                self.log("TASK FAILED",
+                         "{0} failed with error: {1}".format(task.task_id, error))
+                status[task.task_id] = "failed"
+
+        return status
+
+    def run_work_graph_with_scheduler(self, graph, run_task_func=None):
+        """
+        Run all tasks in the graph with the PipelineScheduler (backend/utils/scheduler.py). Each task
+        kind runs on its own worker pool (self.scheduler_task_kind_pools, sized by self.scheduler_pool_sizes)
+        so network-bound downloads, disk-bound copies and cpu-bound conversions for different
+        sessions run at the same time. As in execute_work_graph(), a failed task only skips the
+        remaining tasks of its own session. run_task_func replaces run_task() (see _run_leased_sessions()).
+        Return dict {task_id: "done" / "failed" / "skipped"}
+        """
+        pipeline_scheduler = scheduler.PipelineScheduler(run_task_func or self.run_task,
+                                                         self.get_scheduler_pool_sizes(),
+                                                         self.scheduler_task_kind_pools,
+                                                         log_func=self.log,
+                                                         admission_controller=self.make_admission_controller(),
+                                                         admission_retry_seconds=self.admission_retry_seconds,
+                                                         admission_max_wait_seconds=self.admission_max_wait_seconds)
+        return pipeline_scheduler.run(graph)
+
+    def get_scheduler_pool_sizes(self):
+        """
+        Return a copy of self.scheduler_pool_sizes. A recon pool size of None is worked out here
+        rather than in __init__(), so a config that changes recon_all_threads_per_job or
+        num_recon_all_cores gets the matching number of recon-all jobs.
+        """
+        pool_sizes = dict(self.scheduler_pool_sizes)
+        if pool_sizes.get("recon") is None:
+            num_cores = self.num_recon_all_cores or mri_preprocessing_wrappers.get_num_available_cores()
+            pool_sizes["recon"] = max(1, num_cores // self.recon_all_threads_per_job)
+        return pool_sizes
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Disk Space Admission Control
+# ----------------------------------------------------------------------------------------------------------------------
+
+    def make_admission_controller(self):
+        """
+        AdmissionController (backend/utils/admission.py) for the project volumes: the HPC
+        hpc-work dir, raw_scans and preprocessing. Each task needs its estimated bytes times
+        self.admission_write_factors on each volume it writes to. None if admission_control is off.
+        """
+        if not self.admission_control:
+            return None
+
+        return admission.AdmissionController(self._get_volume_free_bytes,
+                                             self._get_task_needed_bytes,
+                                             safety_margin_bytes=self.admission_safety_margin_bytes,
+                                             io_budget_bytes=self.admission_io_budget_bytes)
+
+    def _get_task_needed_bytes(self, task):
+        return self._get_needed_bytes(task.kind, task.estimated_bytes)
+
+    def _get_needed_bytes(self, kind, num_bytes):
+        """
+        Return dict {volume: bytes} written by a task of kind that handles num_bytes of raw data.
+        Local dirs on the same filesystem are the same volume so their bytes add up.
+        """
+        if kind == "extract" and not self.archive_raw_scans_after_download:
+            return {}
+
+        needed_bytes = {}
+        for volume_name, factor in self.admission_write_factors.get(kind, {}).items():
+            volume = self._get_volume(volume_name)
+            needed_bytes[volume] = needed_bytes.get(volume, 0) + int((num_bytes or 0) * factor)
+        return needed_bytes
+
+    def _get_volume(self, volume_name):
+        """
+        "hpc:account" for the HPC, or the mount point of raw_scans / preprocessing, so dirs on the
+        same filesystem (e.g. the same ZFS dataset) and projects on it share a volume.
+        """
+        if volume_name == "hpc":
+            return "hpc:" + self.account
+
+        path = os.path.abspath(self.raw_scans_path if volume_name == "raw_scans" else self.preprocessing_path)
+        while not os.path.isdir(path):
+            path = os.path.dirname(path)
+        while not os.path.ismount(path):
+            path = os.path.dirname(path)
+        return path
+
+    def _get_volume_free_bytes(self, volume):
+        if not volume.startswith("hpc:"):
+            return shutil.disk_usage(volume).free
+
+        import paramiko  # heavy backends are imported only when used, see benchmark_startup.py
+
+        try:
+            stdout = self._run_ssh_to_hpc(self.hpc_free_bytes_command.format(account=self.account))
+            return int(stdout.split()[-1])
+        except (AssertionError, ValueError, IndexError, OSError, EOFError, paramiko.SSHException) as error:
+            self.log("Disk space",
+                     "could not measure free space on the HPC ({0}), not checked".format(error))
+            return float("inf")
+
+    def _has_space_to_write(self, kind, num_bytes, description):
+        """
+        Check there is space for a task of kind writing num_bytes outside of the scheduler
+        (e.g. download_scans_from_hpc(), move_raw_to_preprocessing()). Log and return False if not.
+        """
+        admission_controller = self.make_admission_controller()
+        if admission_controller is None:
+            return True
+
+        shortfall = admission_controller.get_shortfall(self._get_needed_bytes(kind, num_bytes))
+        if shortfall:
+            self.log("Disk space",
+                     "ERROR: not enough space to {0}, skipped. {1}".format(description, shortfall))
+            return False
+        return True
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Distributed Execution
+# ----------------------------------------------------------------------------------------------------------------------
+
+    def get_task_queue(self):
+        """
+        FileTaskQueue (backend/utils/task_queue.py) in self.distributed_queue_path (default docs/task_queue),
+        which must be on the filesystem shared by the coordinator and all worker hosts.
+        """
+        return task_queue.FileTaskQueue(self.distributed_queue_path or os.path.join(self.docs_path, "task_queue"),
+                                        lease_seconds=self.distributed_lease_seconds)
+
+    def run_work_graph_distributed(self, graph, num_local_workers=0):
+        """
+        Run the graph on workers on several hosts (run_project.py worker, see run_distributed_worker()).
+        Each session is queued as one item so its tasks run on one worker. This process only coordinates:
+
+            - a session whose tasks failed is re-queued with the tasks not yet done, after
+              self.distributed_retry_seconds, until self.distributed_max_attempts
+            - a session whose worker stops heartbeating for self.distributed_lease_seconds
+              (e.g. its host went down) is revoked and re-queued in the same way, but only
+              claimable self.distributed_lease_seconds + self.distributed_requeue_grace_seconds
+              after it was revoked
+
+        A worker that is still running finds out its lease was revoked at its next heartbeat and
+        starts no further task of the session, but a task already running is not stopped. The
+        delay before the session can be claimed again is what keeps two workers from writing the
+        same runs, so it must be longer than the longest task (e.g. recon-all).
+
+        num_local_workers worker processes are started on this host for the run (e.g. to test with
+        several workers on one machine, or to use this host as well).
+        Return dict {task_id: "done" / "failed" / "skipped"}
+        """
+        queue = self.get_task_queue()
+        run_id = task_queue.make_run_id()
+        self.init_logging(None, None, logging_path=self.logs_path, log_filename="distributed.log")
+
+        items = {}  # {name: payload} of sessions not yet finished
+        for index, (session_key, tasks) in enumerate(task_queue.split_graph_by_session(graph).items()):
+            name = "{0}-{1:05}".format(run_id, index)
+            items[name] = {"session_key": session_key,
+                           "tasks": [task_queue.task_to_dict(task) for task in tasks],
+                           "attempt": 1}
+            queue.put(name, items[name])
+
+        self.log("Distributed run started",
+                 "{0}: {1} tasks of {2} sessions queued in {3}".format(run_id, len(graph), len(items), queue.queue_path))
+
+        workers = self._start_local_workers(num_local_workers, run_id)
+        status = {}
+        try:
+            while items:
+                for name, worker_id, payload, result in queue.pop_results(run_id):
+                    self._finish_or_requeue_session(queue, items, name, payload, result, status,
+                                                    "finished on {0}".format(worker_id),
+                                                    self.distributed_retry_seconds)
+
+                for name, worker_id, payload in queue.requeue_expired(run_id):
+                    self._finish_or_requeue_session(queue, items, name, payload, {}, status,
+                                                    "lease of {0} expired".format(worker_id),
+                                                    self.distributed_lease_seconds +
+                                                    self.distributed_requeue_grace_seconds)
+
+                if items:
+                    time.sleep(self.distributed_poll_seconds)
+        finally:
+            queue.remove_run(run_id)
+            for worker in workers:
+                worker.terminate()
+                worker.join()
+
+        self.log("Distributed run finished",
+                 "{0}: {1} of {2} tasks done".format(run_id, list(status.values()).count("done"), len(status)))
+        return status
+
+    def _finish_or_requeue_session(self, queue, items, name, payload, result, status, reason, retry_seconds):
+        """
+        Record the result {task_id: status} of a session item (empty if its lease expired). Tasks not
+        done are queued again (claimable after retry_seconds) unless the session is out of attempts,
+        when they are failed / skipped.
+        """
+        if name not in items:
+            return
+
+        status.update({task_id: task_status for task_id, task_status in result.items() if task_status == "done"})
+        remaining_tasks = [task_dict for task_dict in payload["tasks"] if result.get(task_dict["task_id"]) != "done"]
+
+        if not remaining_tasks:
+            del items[name]
+            return
+
+        if payload["attempt"] < self.distributed_max_attempts:
+            items[name] = dict(payload,
+                               tasks=remaining_tasks,
+                               attempt=payload["attempt"] + 1,
+                               not_before=time.time() + retry_seconds)
+            queue.put(name, items[name])
+            self.log("SESSION REQUEUED",
+                     "{0} {1}, {2} tasks not done. Attempt {3} of {4} in {5} s".format(payload["session_key"],
+                                                                                     reason,
+                                                                                     len(remaining_tasks),
+                                                                                     payload["attempt"] + 1,
+                                                                                     self.distributed_max_attempts,
+                                                                                     retry_seconds))
+            return
+
+        del items[name]
+        for task_dict in remaining_tasks:
+            status[task_dict["task_id"]] = result.get(task_dict["task_id"], "failed")
+        self.log("SESSION FAILED",
+                 "{0} {1}, {2} tasks not done after {3} attempts".format(payload["session_key"],
+                                                                        reason,
+                                                                        len(remaining_tasks),
+                                                                        payload["attempt"]))
+
+    def _start_local_workers(self, num_workers, run_id):
+        """
+        Fork num_workers worker processes that run the items of run_id until they are terminated.
+        They are not daemonic as daemonic processes cannot start the process pools of tasks
+        (e.g. deidentify_staged_dicoms), run_work_graph_distributed() terminates them instead.
+        """
+        import multiprocessing  # only imported if used, see benchmark_startup.py
+
+        context = multiprocessing.get_context("fork")  # the project instance cannot be pickled
+        workers = [context.Process(target=self._run_local_worker, args=(run_id,), daemon=False)
+                   for __ in range(num_workers)]
+        for worker in workers:
+            worker.start()
+        return workers
+
+    def _run_local_worker(self, run_id):
+        self.ssh_pool = None  # connections cannot be shared with the parent process
+        self.run_distributed_worker(run_id=run_id)
+
+    def run_distributed_worker(self, idle_exit_seconds=None, run_id=None):
+        """
+        Claim sessions from the task queue (see run_work_graph_distributed()) and run their tasks with
+        the scheduler, self.distributed_worker_sessions sessions at a time, until the queue has been
+        empty for idle_exit_seconds (None to run until interrupted). Start on every host that shares
+        the project filesystem with run_project.py worker. run_id only runs the items of one run.
+        Return the number of sessions run.
+        """
+        queue = self.get_task_queue()
+        worker_id = task_queue.get_worker_id()
+        self.init_logging(None, None, logging_path=self.logs_path, log_filename="distributed.log")
+        self.log("Worker started", "{0} polling {1}".format(worker_id, queue.queue_path))
+
+        num_sessions = 0
+        idle_since = time.monotonic()
+        while True:
+            leases = []
+            while len(leases) < self.distributed_worker_sessions:
+                lease = queue.claim(worker_id, run_id)
+                if lease is None:
+                    break
+                leases.append(lease)
+
+            if not leases:
+                if idle_exit_seconds is not None and time.monotonic() - idle_since > idle_exit_seconds:
+                    self.log("Worker stopped", "{0} ran {1} sessions".format(worker_id, num_sessions))
+                    return num_sessions
+                time.sleep(self.distributed_poll_seconds)
+                continue
+
+            self._run_leased_sessions(queue, leases)
+            num_sessions += len(leases)
+            idle_since = time.monotonic()
+
+    def _run_leased_sessions(self, queue, leases):
+        """
+        Run the tasks of the leased sessions with one scheduler, renewing the leases every
+        self.distributed_heartbeat_seconds, then put back the status of every task. Once a lease is
+        lost (the coordinator revoked it to re-queue the session) no further task of its session is
+        started. A task already running carries on; the session only becomes claimable by another
+        worker after distributed_lease_seconds + distributed_requeue_grace_seconds (see
+        run_work_graph_distributed()).
+        """
+        self.log("SESSIONS CLAIMED",
+                 "{0}: {1}".format(leases[0].worker_id, ", ".join(lease.payload["session_key"] for lease in leases)))
+
+        graph = task_queue.tasks_to_graph([task_dict for lease in leases for task_dict in lease.payload["tasks"]])
+
+        logger = self._logging_state.logger
+        stop_heartbeat = threading.Event()
+        lost_leases = []
+
+        def heartbeat():
+            self._logging_state.logger = logger
+            while not stop_heartbeat.wait(self.distributed_heartbeat_seconds):
+                for lease in leases:
+                    if lease not in lost_leases and not queue.heartbeat(lease):
+                        lost_leases.append(lease)
+                        self.log("LEASE LOST",
+                                 "{0} was re-queued by the coordinator, running tasks of the session "
+                                 "carry on but no further task is started".format(lease.payload["session_key"]))
+
+        session_leases = {lease.payload["session_key"]: lease for lease in leases}
+
+        def run_leased_task(task):
+            lease = session_leases[task.session_key]
+            if lease in lost_leases or not queue.heartbeat(lease):
+                self.log("LEASE LOST",
+                         "{0} not started, {1} was re-queued".format(task.task_id, task.session_key))
+                return False
+            return self.run_task(task)
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            status = self.run_work_graph_with_scheduler(graph, run_task_func=run_leased_task)
+        finally:
+            stop_heartbeat.set()
+            heartbeat_thread.join()
+
+        self._logging_state.logger = logger  # run_task() switched it to the session logs
+        for lease in leases:
+            result = {task_dict["task_id"]: status.get(task_dict["task_id"], "failed")
+                      for task_dict in lease.payload["tasks"]}
+            if not queue.complete(lease, result):
+                self.log("LEASE LOST",
+                         "{0} result not returned, the session was re-queued".format(lease.payload["session_key"]))
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Watch Mode
+# ----------------------------------------------------------------------------------------------------------------------
 
-    def _copy_data_to_preprocessing(self, scan_type, scan_info, sub_info):
+    def watch_project(self, download=True, stage=True, convert=True, recon=False, use_inotify=True, max_cycles=None):
         """
-        Function to coordinate data copying from raw_scans to BIDS in preprocessing.
-        see self.move_raw_to_preprocessing()
+        Long running alternative to running run_project.py on cron (run_project.py -watch).
 
-        scan_type: "mrs", "func", "anat" or "mpm", "b0", "b1"
+        On start, all pending work for the project is planned and run once (see plan_work()).
+        After that only new work is processed: the project config file (for new participant log
+        entries) and raw_scans (for newly arrived zk_id folders) are watched with inotify,
+        or by polling if use_inotify=False or inotify is not available. Only the
+        affected scans are planned and pushed through the scheduler, so each cycle
+        costs only the new sessions rather than re-walking the whole cohort.
 
-        TODO: bit repetitive as if raw scans dir is not present it will log the same response
-        many times, but do not want to take this a level up to download_and_copy as bnecomes too verbose.
+        Changes are processed once no new change is seen for self.watch_settle_seconds (e.g. a
+        folder still being copied). Failed scans are retried every self.watch_poll_interval.
+        max_cycles is only for testing, the default runs until interrupted.
         """
-        scan_details, num_expected_files = self._get_scan_details_and_expeced_num(scan_type)
+        config_filepath = inspect.getsourcefile(type(self))
 
-        if scan_details:
+        self.init_logging(None, None, logging_path=self.logs_path, log_filename="watch.log")
 
-            raw_scan_folder = os.path.join(self.raw_scans_path, scan_info["zk_id"])
+        directory_watcher = watcher.DirectoryWatcher([self.raw_scans_path, os.path.dirname(config_filepath)],
+                                                     use_inotify=use_inotify,
+                                                     poll_interval=self.watch_poll_interval)
+        self.log("Watch mode started",
+                 "watching {0} and {1} ({2})".format(self.raw_scans_path,
+                                                     config_filepath,
+                                                     "inotify" if directory_watcher.uses_inotify() else "polling"))
 
-            if os.path.isdir(raw_scan_folder):
+        known_zk_ids = self._get_all_zk_ids_in_participant_log()
+        failed_zk_ids = set()
+        zk_ids_to_process = None  # all on first cycle
+        cycle = 0
 
-                self.log("Copying raw {0} data to preprocessing folder".format(scan_type),
-                         "Copying: {0}, {1}, {2}, {3}\n".format(scan_type,
-                                                                scan_info["zk_id"],
-                                                                sub_info["sub_id"],
-                                                                scan_info["ses_id"]))
+        try:
+            while max_cycles is None or cycle < max_cycles:
+                cycle += 1
 
-                self._copy_data_from_raw_scans_to_preprocessing(scan_info,
-                                                                sub_info["sub_id"],
-                                                                scan_details,
-                                                                scan_type,
-                                                                num_expected_files)
-            else:
-                self.log("Copying raw {0} data to preprocessing folder".format(scan_type),
-                         "no raw scans found for {0}, no data copied".format(scan_info["zk_id"]))
+                if zk_ids_to_process is None or zk_ids_to_process:
+                    failed_zk_ids -= zk_ids_to_process or known_zk_ids
+                    failed_zk_ids |= self._process_watched_zk_ids(zk_ids_to_process, download, stage, convert, recon)
 
+                changes = set((path, name) for path, name in self._wait_for_settled_changes(directory_watcher)
+                              if path == self.raw_scans_path or name == os.path.basename(config_filepath))
 
-    def check_for_duplicate_str_in_list(self, list_):
-        """
-        Set() function will remove any duplicates
-        """
-        return len(list_) == len(set(list_))
+                zk_ids_to_process = set()
+                if not changes:
+                    zk_ids_to_process |= failed_zk_ids
 
+                if any(path != self.raw_scans_path for path, __ in changes):
+                    new_zk_ids = self._reload_participant_log_from_config() - known_zk_ids
+                    known_zk_ids |= new_zk_ids
+                    zk_ids_to_process |= new_zk_ids
 
-    def _copy_data_from_raw_scans_to_preprocessing(self,  # TODO: will pprobably end up needing to write a function to unpack scan details
-                                                   scan_info,
-                                                   sub_id,
-                                                   scan_details,
-                                                   data_name,
-                                                   num_expected_files):
+                zk_ids_to_process |= set(name for path, name in changes
+                                         if path == self.raw_scans_path and name in known_zk_ids)
+        finally:
+            directory_watcher.close()
+
+    def _process_watched_zk_ids(self, zk_ids, download, stage, convert, recon):
         """
-        see  see self.move_raw_to_preprocessing()
+        Plan and run all pending work for the scans (None for all). Return set of zk_ids that
+        had a failed task.
         """
-        preprocessing_raw_data_path = os.path.join(self.preprocessing_path,
-                                                   sub_id,
-                                                   scan_info["ses_id"],
-                                                   data_name, "raw")
+        try:
+            graph = self.plan_work(download, stage, convert, recon, zk_ids=zk_ids)
+        except Exception as error:  # e.g. participant log is being edited and fails tests
+            self._log_to_watch_log("Watch mode", "planning failed: {0}".format(error))
+            return set(zk_ids or [])
 
-        for scan_name in scan_details.keys():
+        if not len(graph):
+            return set()
 
-            sequence_search_str = scan_details[scan_name]["search_str"]
-            task_name = scan_details[scan_name]["task_name"]
+        status = self.run_work_graph_with_scheduler(graph)
 
-            search_path_str = os.path.join(self.raw_scans_path,
-                                           scan_info["zk_id"], scan_info["zk_id"],  # zk_id twice for backups organisation
-                                           sequence_search_str)
+        failed_zk_ids = set(graph.get_task(task_id).session_key for task_id, task_status in status.items()
+                            if task_status == "failed")
+        self._log_to_watch_log("Watch mode",
+                               "ran {0} tasks for {1}, failed: {2}".format(len(graph),
+                                                                         sorted(set(task.session_key for task in
+                                                                                    graph.get_all_tasks())),
+                                                                         sorted(failed_zk_ids) or "none"))
+        return failed_zk_ids
 
-            ordered_scan_run_paths = sorted(glob.glob(search_path_str))
+    def _wait_for_settled_changes(self, directory_watcher):
+        """
+        Wait up to watch_poll_interval for changes, then keep collecting them
+        until none are seen for watch_settle_seconds.
+        """
+        changes = directory_watcher.wait_for_changes(self.watch_poll_interval)
+        while changes:
+            new_changes = directory_watcher.wait_for_changes(self.watch_settle_seconds)
+            if not new_changes:
+                break
+            changes |= new_changes
+        return changes
 
-            if any(ordered_scan_run_paths) and \
-                    self.check_for_duplicate_str_in_list(ordered_scan_run_paths):
-                self.log(None, "WARNING! Duplicate run detected in raw scans for " + scan_name)
+    def _reload_participant_log_from_config(self):
+        """
+        Re-import the project config module and take its participant log.
+        Return the set of all zk_ids in the (new) participant log. If the config
+        cannot be loaded (e.g. mid-edit), the current participant log is kept.
+        """
+        try:
+            config_module = importlib.reload(sys.modules[type(self).__module__])
+            reloaded_project = getattr(config_module, type(self).__name__)()
+            reloaded_project._test_participant_log(copy.deepcopy(reloaded_project._participant_log))
+            self._participant_log = reloaded_project._participant_log
+        except Exception as error:
+            self._log_to_watch_log("Watch mode", "could not reload project config: {0}".format(error))
 
-            saved_run_idx = 0
-            for true_run_idx, raw_data_to_copy in enumerate(ordered_scan_run_paths):  # TODO: own function?
+        return self._get_all_zk_ids_in_participant_log()
 
-                if "flags" in scan_info:
-                    if self._skip_run_based_on_flags(scan_info, true_run_idx, data_name):
-                        continue
+    def _get_all_zk_ids_in_participant_log(self):
+        return set(scan_info["zk_id"] for sub_info in self._participant_log.values()
+                   for scan_info in sub_info["scans"].values())
 
-                bids_file_name = self._get_bids_filename(sub_id, scan_info["ses_id"], task_name,
-                                                         saved_run_idx, scan_name)
-                destination_path = os.path.join(preprocessing_raw_data_path,
-                                                bids_file_name)
+    def _log_to_watch_log(self, title, message):
+        self.init_logging(None, None, logging_path=self.logs_path, log_filename="watch.log")
+        self.log(title, message)
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Preprocessing - Run Commands
+# ----------------------------------------------------------------------------------------------------------------------
 
-                self._copy_dir_contents(raw_data_to_copy,
-                                        destination_path)
+    def convert_session(self, sub_id, ses_id):
+        """
+        Run dcm2niix on every run of all configured scan types in the session, and consolidate MRS.
+        """
+        for scan_type, scan_type_info in self.get_scan_types(collected_only=True, converter="dcm2niix").items():
+            self.run_dcm2niix([sub_id], [ses_id], ["all"], scan_type_info.scan_names, [scan_type])
 
-                self._test_and_log_expected_file_number(destination_path,
-                                                       num_expected_files)
+        for scan_type_info in self.get_scan_types(collected_only=True, converter="mrs").values():
+            self.run_mrs_consolidation([sub_id], [ses_id], ["all"], scan_type_info.scan_names)
 
-                saved_run_idx += 1
+    def recon_session(self, sub_id, ses_id, num_cores=None):
+        for scan_type, scan_type_info in self.get_scan_types(collected_only=True, recon=True).items():
+            self.run_recon_all([sub_id], [ses_id], ["all"], scan_type_info.scan_names, [scan_type],
+                               num_cores=num_cores)
 
-    def _skip_run_based_on_flags(self, scan_info, run_idx, data_name):  # TEST!!!!
+    def run_recon_all(self, sub_ids, ses_ids, run_ids, scan_names, scan_types, slurm_array=False,
+                      dependency_job_ids=None, use_nipype=False, num_cores=None, **kwargs):
         """
-        Runs to skip copying are set in the "flags" entry of the "scan" dict field
-        in self.participant log. All
+        Run FreeSurfer recon-all on the converted anatomical runs. Each run is a subject
+        (subject id bids_name) in the subjects dir preprocessing/sub/ses/anat/freesurfer.
+
+        By default runs are orchestrated locally (see _run_recon_all_jobs()): each job uses
+        self.recon_all_threads_per_job threads and as many jobs as fit on num_cores (default
+        self.num_recon_all_cores) run at once.
+        Subjects that were stopped part way are resumed from the last finished autorecon stage
+        and finished subjects are skipped (backend/analysis/freesurfer.py).
+
+        If slurm_array, all runs are submitted in a single SLURM job array (see
+        utils.run_commands_as_slurm_arrays) using self.slurm_resource_hints for the scan type,
+        and the job ids are returned. Pass dependency_job_ids (e.g. from run_dcm2niix)
+        to start only after those jobs finish. use_nipype runs a nipype ReconAll node per run.
         """
-        scan_specific_flags = [flag for flag in scan_info["flags"] if data_name in flag]
+        if slurm_array:
+            command_func = self.get_recon_all_command_func(kwargs)
+            return self._submit_preprocessing_job_array("recon_all", command_func, sub_ids, ses_ids, run_ids,
+                                                        scan_names, scan_types, dependency_job_ids)
 
-        if any(scan_specific_flags):
+        if use_nipype:
+            run_func = self.get_recon_all_func(kwargs)
+            self._run_preprocessing_job(run_func, sub_ids, ses_ids, run_ids, scan_names, scan_types)
+            return
 
-            runs_to_ignore = [flag.split("_")[2].lstrip("0") for flag in scan_specific_flags]  # ignore leading zeros in case the user input as "001" format
+        targets = self._get_preprocessing_job_targets(sub_ids, ses_ids, run_ids, scan_names, scan_types, "nii")
+        return self._run_recon_all_jobs(list(targets), num_cores)
+
+    def _run_recon_all_jobs(self, targets, num_cores=None):
+        """
+        Run recon-all for all targets (list of (sub_id, ses_id, "anat", bids_name)) with
+        freesurfer.run_recon_all_jobs(), packing self.recon_all_threads_per_job thread jobs onto
+        num_cores (default self.num_recon_all_cores, or all available). Output is logged to
+        logs/recon_all.log. Return True if all jobs succeeded (or were already finished).
+        """
+        jobs = [self._get_recon_all_paths(sub_id, ses_id, bids_name) for sub_id, ses_id, __, bids_name in targets]
+        num_cores = num_cores or self.num_recon_all_cores or mri_preprocessing_wrappers.get_num_available_cores()
 
-            if str(run_idx + 1) in runs_to_ignore:  # TODO: does this fail the case where run=1 and runs to ingore contains ["10"]. Shouldnt but check
+        with commands.CommandLog(os.path.join(self.logs_path, "recon_all.log")) as command_log:
+            results = freesurfer.run_recon_all_jobs(jobs,
+                                                    num_cores,
+                                                    self.recon_all_threads_per_job,
+                                                    recon_all_path=self.recon_all_path,
+                                                    command_log=command_log)
 
+        all_succeeded = True
+        for (subjects_dir, subject_id, __), result in zip(jobs, results):
+            if result is None:
+                self.log(None, "recon-all already finished for {0}, skipping".format(subject_id))
+            elif not result.succeeded():
                 self.log(None,
-                          "Did not copy run {0} for scan {1} "
-                          "based on the flags {2}".format(run_idx + 1,
-                                                          scan_info["zk_id"],
-                                                          scan_specific_flags))
-                return True
-        return False
+                         "ERROR: recon-all failed for {0} after finishing stages {1}".format(
+                             subject_id, freesurfer.get_finished_stages(subjects_dir, subject_id)))
+                self._log_failed_command(result)
+                all_succeeded = False
+        return all_succeeded
 
-    def _dump_info_file_in_session_dir(self, wbic_id, scan_info, sub_info):
+    def _get_recon_all_paths(self, sub_id, ses_id, bids_name):
         """
-        Write a file to a ses-XXX dir containing all information about the
-        sub / session. This file is used for tests on the scan datetime.
+        Return (subjects_dir, subject_id, t1_filepath) for an anat run
         """
-        ses_path = os.path.join(self.preprocessing_path,
-                                sub_info["sub_id"],
-                                scan_info["ses_id"])
+        return (os.path.join(self.preprocessing_path, sub_id, ses_id, "anat", "freesurfer"),
+                bids_name,
+                os.path.join(self.preprocessing_path, sub_id, ses_id, "anat", "nii", bids_name, bids_name + ".nii.gz"))
 
-        if os.path.isdir(ses_path):
+    def run_dcm2niix(self, sub_ids, ses_ids, run_ids, scan_names, scan_types, slurm_array=False,
+                     dependency_job_ids=None, use_nipype=False, **kwargs):  # need to be careful specified keyworks do not overlap with nipype keywords
+        """
+        Convert the runs in preprocessing/sub/ses/scan_type/raw to nii/. By default all runs are
+        converted locally in one batch (see _convert_runs_with_dcm2niix()), use_nipype runs
+        a nipype Dcm2niix node per run on SLURM. See run_recon_all() for slurm_array.
+        """
+        if slurm_array:
+            command_func = self.get_dcm2niix_command_func(kwargs)
+            return self._submit_preprocessing_job_array("dcm2niix", command_func, sub_ids, ses_ids, run_ids,
+                                                        scan_names, scan_types, dependency_job_ids)
 
-            info = "project_code: {0}\n" \
-                   "wbic_id: {1}\n" \
-                   "sub_id: {2}\n" \
-                   "ses_id {3}\n" \
-                   "zk_id: {4}\n" \
-                   "scan_date: {5}\n" \
-                   "scan_start_time: {6}\n" \
-                   "\nDo not edit this file".format(self.project_code,
-                                                    wbic_id,
-                                                    sub_info["sub_id"],
-                                                    scan_info["ses_id"],
-                                                    scan_info["zk_id"],
-                                                    scan_info["date"],
-                                                    scan_info["time_start"])
+        if use_nipype:
+            run_func = self.get_dcm2niix_func(kwargs)
+            self._run_preprocessing_job(run_func, sub_ids, ses_ids, run_ids, scan_names, scan_types)
+            return
 
-            filename = scan_info["ses_id"] + "_info.txt"
+        targets = self._get_preprocessing_job_targets(sub_ids, ses_ids, run_ids, scan_names, scan_types, "raw")
+        return self._convert_runs_with_dcm2niix(list(targets), kwargs)
 
-            with open(os.path.join(
-                                   ses_path, filename), "w") as file:
-                file.write(info)
+    def _convert_runs_with_dcm2niix(self, targets, kwargs):
+        """
+        Convert all runs in one batch with mri_preprocessing_wrappers.run_dcm2niix_batch(), running dcm2niix
+        directly on a pool of self.num_conversion_workers (default all cores). Runs of scan types in
+        self.in_process_conversion_scan_types (small series e.g. b0 / b1) are first converted
+        in-process (backend/analysis/dicom_to_nifti.py) and only fall back to dcm2niix if not supported.
 
-# ----------------------------------------------------------------------------------------------------------------------
-# Preprocessing - Run Commands
-# ----------------------------------------------------------------------------------------------------------------------
+        targets: list of (sub_id, ses_id, scan_type, bids_name). Log failed conversions
+        and return list of Dcm2niixResult.
+        """
+        jobs = []
+        use_in_process = []
+        for sub_id, ses_id, scan_type, bids_name in targets:
+            source_dir = os.path.join(self.preprocessing_path, sub_id, ses_id, scan_type, 'raw', bids_name)
+            output_dir = os.path.join(self.preprocessing_path, sub_id, ses_id, scan_type, 'nii', bids_name)
+            out_filename = bids_name if "out_filename" not in kwargs else kwargs["out_filename"]
+            jobs.append([source_dir, output_dir, out_filename])
+            use_in_process.append(scan_type in self.in_process_conversion_scan_types)
+
+        results = [None] * len(jobs)
+        with commands.CommandLog(os.path.join(self.logs_path, "dcm2niix.log")) as command_log:
+            for try_in_process in [True, False]:
+                job_idxs = [idx for idx in range(len(jobs)) if use_in_process[idx] == try_in_process]
+                batch_results = mri_preprocessing_wrappers.run_dcm2niix_batch([jobs[idx] for idx in job_idxs],
+                                                                              num_workers=self.num_conversion_workers,
+                                                                              dcm2niix_path=self.dcm2niix_path,
+                                                                              command_log=command_log,
+                                                                              try_in_process=try_in_process)
+                for idx, result in zip(job_idxs, batch_results):
+                    results[idx] = result
+        for result in results:
+            if not result.succeeded():
+                self.log(None,
+                         "ERROR: dcm2niix failed for {0} with return code {1}:\n{2}".format(result.source_dir,
+                                                                                        result.returncode,
+                                                                                        "\n".join(result.output_tail)))
+        return results
 
-    def run_recon_all(self, sub_ids, ses_ids, run_ids, scan_names, scan_types, **kwargs):
+    def run_mrs_consolidation(self, sub_ids, ses_ids, run_ids, scan_names):
         """
+        Read the spectroscopy DICOMs of each MRS run in preprocessing/sub/ses/mrs/raw in a single pass
+        and write the run as one contiguous array preprocessing/sub/ses/mrs/npy/<bids_name>.npy
+        with a .json sidecar (see backend/analysis/mrs.py). Runs already consolidated are skipped.
+        Return the number of runs consolidated.
         """
-        run_func = self.get_recon_all_func(kwargs)
-        self._run_preprocessing_job(run_func, sub_ids, ses_ids, run_ids, scan_names, scan_types)
+        targets = self._get_preprocessing_job_targets(sub_ids, ses_ids, run_ids, scan_names, ["mrs"], "raw")
+        return self._consolidate_mrs_runs([target for target in targets
+                                           if not self._run_is_converted(*target)])
 
-    def run_dcm2niix(self, sub_ids, ses_ids, run_ids, scan_names, scan_types, **kwargs):  # need to be careful specified keyworks do not overlap with nipype keywords
+    def _consolidate_mrs_runs(self, targets):
         """
+        targets: list of (sub_id, ses_id, "mrs", bids_name). Runs that cannot be read are logged.
         """
-        run_func = self.get_dcm2niix_func(kwargs)
-        self._run_preprocessing_job(run_func, sub_ids, ses_ids, run_ids, scan_names, scan_types)
+        from backend.analysis import mrs  # numpy
+
+        num_consolidated = 0
+        for sub_id, ses_id, scan_type, bids_name in targets:
+            source_dir = os.path.join(self.preprocessing_path, sub_id, ses_id, scan_type, "raw", bids_name)
+            npy_filepath = self._get_mrs_npy_filepath(sub_id, ses_id, bids_name)
+            try:
+                __, sidecar = mrs.consolidate_mrs_run(source_dir, os.path.dirname(npy_filepath), bids_name)
+            except mrs.MrsReadError as error:
+                self.log(None,
+                         "ERROR: MRS consolidation failed for {0}: {1}".format(source_dir, error))
+                continue
+
+            self.log(None,
+                     "Consolidated {0} transients of {1} points to {2}".format(sidecar["NumberOfTransients"],
+                                                                               sidecar["NumberOfPoints"],
+                                                                               npy_filepath))
+            num_consolidated += 1
+        return num_consolidated
+
+    def _get_mrs_npy_filepath(self, sub_id, ses_id, bids_name):
+        return os.path.join(self.preprocessing_path, sub_id, ses_id, "mrs", "npy", bids_name + ".npy")
 
     def get_recon_all_func(self, kwargs):  # TODO: use ke and mengxin options!
         """
         """
         def run_recon_all_func(preprocessing_path, sub_id, ses_id, scan_types, bids_name, kwargs=kwargs):  # TODO: ensure scan type is anat
+            import nipype.pipeline.engine as pe
             from nipype.interfaces.freesurfer import ReconAll
-            source_dir = os.path.join(preprocessing_path, sub_id, ses_id, scan_types, 'nii', bids_name)  # TODO: check if file already exists! for all!
+            subjects_dir, subject_id, t1_filepath = self._get_recon_all_paths(sub_id, ses_id, bids_name)
+            self._mkdir(subjects_dir)
 
             reconall_node = pe.Node(name='reconall_node',
-                                    interface=ReconAll(subject_id=sub_id,
+                                    interface=ReconAll(subject_id=subject_id,
                                                        directive="all",
-                                                       subjects_dir=source_dir,
-                                                       T1_files=os.path.join(source_dir, bids_name + ".nii.gz")))
+                                                       subjects_dir=subjects_dir,
+                                                       T1_files=t1_filepath))
 
             workflow = pe.Workflow(name='reconall')
-            workflow.base_dir = source_dir
+            workflow.base_dir = subjects_dir
             workflow.add_nodes([reconall_node])
             workflow.run(plugin="SLURMGraph", plugin_args = {'dont_resubmit_completed_jobs': True})
 
@@ -602,6 +2424,8 @@ class ProjectMaster():
         """
         """
         def run_dcm2niix_func(preprocessing_path, sub_id, ses_id, scan_types, bids_name, kwargs=kwargs):
+            import nipype.pipeline.engine as pe
+            from nipype.interfaces.dcm2nii import Dcm2niix
 
             source_dir = os.path.join(preprocessing_path, sub_id, ses_id, scan_types, 'raw', bids_name)
             output_dir = os.path.join(preprocessing_path, sub_id, ses_id, scan_types, 'nii', bids_name)
@@ -620,94 +2444,137 @@ class ProjectMaster():
 
         return run_dcm2niix_func
 
+    def get_recon_all_command_func(self, kwargs):
+        """
+        As get_recon_all_func() but return the recon-all command (argv list) for
+        the run rather than running it, for submitting as a SLURM job array. Threads
+        match the cpus requested for anat. None if recon-all is already finished.
+        """
+        def recon_all_command_func(preprocessing_path, sub_id, ses_id, scan_types, bids_name, kwargs=kwargs):
+            subjects_dir, subject_id, t1_filepath = self._get_recon_all_paths(sub_id, ses_id, bids_name)
+            self._mkdir(subjects_dir)
+            freesurfer.remove_failed_import(subjects_dir, subject_id)
+
+            threads_per_job = self.slurm_resource_hints.get("anat", {}).get("cpus", self.recon_all_threads_per_job)
+            return freesurfer.get_recon_all_command(subjects_dir, subject_id, t1_filepath, threads_per_job,
+                                                    self.recon_all_path)
+
+        return recon_all_command_func
+
+    def get_dcm2niix_command_func(self, kwargs):
+        """
+        As get_dcm2niix_func() but return the dcm2niix command (argv list), see get_recon_all_command_func()
+        """
+        def dcm2niix_command_func(preprocessing_path, sub_id, ses_id, scan_types, bids_name, kwargs=kwargs):
+            source_dir = os.path.join(preprocessing_path, sub_id, ses_id, scan_types, 'raw', bids_name)
+            output_dir = os.path.join(preprocessing_path, sub_id, ses_id, scan_types, 'nii', bids_name)
+            self._mkdir(output_dir)
+
+            out_filename = bids_name if "out_filename" not in kwargs else kwargs["out_filename"]
+            return [self.dcm2niix_path] + \
+                mri_preprocessing_wrappers.get_dcm2niix_args(output_dir, out_filename=out_filename) + [source_dir]
+
+        return dcm2niix_command_func
+
 # ----------------------------------------------------------------------------------------------------------------------  # TODO: unit test
 # Preprocessing - Run Commands
 # ----------------------------------------------------------------------------------------------------------------------
 
-    def _run_preprocessing_job(self, command_func, sub_ids, ses_ids, run_ids, scan_names, scan_types, slurm=True, parallel=False, log=False, **kwargs):  # TODO: rename scan_type to scan_types
+    def _run_preprocessing_job(self, command_func, sub_ids, ses_ids, run_ids, scan_names, scan_types, **kwargs):  # TODO: rename scan_type to scan_types
         """
         note will ignore sessions that do not exist. Make a log?
         """
-        # TODO: cannot run parallel and without slurm
-        sub_ids, ses_ids, run_ids, scan_names, scan_types = self._process_all_job_args(sub_ids, ses_ids, run_ids, scan_names, scan_types)
         nii_or_raw = "raw" if "dcm2nii" in command_func.__name__ else "nii"
 
+        for sub_id, ses_id, scan_type, bids_name in self._get_preprocessing_job_targets(sub_ids, ses_ids, run_ids,
+                                                                                        scan_names, scan_types,
+                                                                                        nii_or_raw):
+            command_func(self.preprocessing_path, sub_id, ses_id, scan_type, bids_name)
+
+    def _submit_preprocessing_job_array(self, job_name, command_func, sub_ids, ses_ids, run_ids, scan_names,
+                                        scan_types, dependency_job_ids=None):
+        """
+        Collect the command for every run and submit as SLURM job arrays, one array
+        per set of resources (see self.slurm_resource_hints). Return list of job ids.
+        """
+        nii_or_raw = "raw" if "dcm2nii" in command_func.__name__ else "nii"
+
+        tasks = []
+        for sub_id, ses_id, scan_type, bids_name in self._get_preprocessing_job_targets(sub_ids, ses_ids, run_ids,
+                                                                                        scan_names, scan_types,
+                                                                                        nii_or_raw):
+            command = command_func(self.preprocessing_path, sub_id, ses_id, scan_type, bids_name)
+            if command is None:
+                continue
+            tasks.append([command, self.slurm_resource_hints.get(scan_type)])
+
+        if not tasks:
+            return []
+
+        job_name = job_name + "_" + datetime.datetime.now().strftime("%m%d%Y_%H%M%S")
+        job_ids = utils.run_commands_as_slurm_arrays(job_name,
+                                                     self.slurm_logs_path,
+                                                     self.slurm_logs_path,
+                                                     tasks,
+                                                     max_concurrent=self.slurm_max_concurrent_tasks,
+                                                     dependency_job_ids=dependency_job_ids)
+        self.log("Submitted SLURM job array",
+                 "{0}: {1} tasks, job ids {2}".format(job_name, len(tasks), job_ids))
+        return job_ids
+
+    def _get_preprocessing_job_targets(self, sub_ids, ses_ids, run_ids, scan_names, scan_types, nii_or_raw):
+        """
+        Yield (sub_id, ses_id, scan_type, bids_name) for every run in preprocessing
+        matching the job arguments (see _process_all_job_args()). Sessions / runs that do not
+        exist are ignored.
+        """
+        sub_ids, ses_ids, run_ids, scan_names, scan_types = self._process_all_job_args(sub_ids, ses_ids, run_ids, scan_names, scan_types)
+
         for sub_id in sub_ids:
 
-            if ses_ids == ["all"]:
-                ses_ids = self.get_all_ses_for_sub(sub_id)
+            sub_ses_ids = self.get_all_ses_for_sub(sub_id) if ses_ids == ["all"] else ses_ids
 
-            for ses_id in ses_ids:
+            for ses_id in sub_ses_ids:
 
                 if not self.sub_has_ses(sub_id, ses_id):  # TEST
                     continue
 
                 for scan_type in scan_types:
 
+                    scan_details = self.get_scan_types()[scan_type].scan_details
+
                     for scan_name in scan_names:
 
+                        if not scan_details or scan_name not in scan_details:
+                            continue
+
                         if not self.ses_has_at_least_one_scan_name_run(sub_id, ses_id, scan_type, nii_or_raw, scan_name):
                             continue
 
-                        if run_ids == ["all"]:
-                            run_ids = self.get_all_runs_in_folder(sub_id, ses_id, scan_type, nii_or_raw, scan_name)
+                        scan_run_ids = self.get_all_runs_in_folder(sub_id, ses_id, scan_type, nii_or_raw, scan_name) \
+                            if run_ids == ["all"] else run_ids
 
-                        for run_id in run_ids:
+                        for run_id in scan_run_ids:
                             if not self.ses_has_run(sub_id, ses_id, scan_type, nii_or_raw, scan_name, run_id):
                                 continue
 
-                            scan_details, __ = self._get_scan_details_and_expeced_num(scan_type)
                             task_name = scan_details[scan_name]["task_name"]  # mixing tasks and scan_names is not supported
                             run_idx = int(run_id[4:]) - 1  # TODO: fix _get_bids_filename?
                             bids_name = self._get_bids_filename(sub_id, ses_id, task_name, run_idx, scan_name)
 
-                            ##### NEW FUNCTION
-                            command = command_func(self.preprocessing_path, sub_id, ses_id, scan_type, bids_name)  # TODO: pipe output
-
-                  #          if log_filepath:
-                   #             open_type = "w" if not os.path.isfile(log_filepath) else "a"
-                    #            with open(log_filepath, open_type) as f:
-                     #               f.write(output_str)
-                      #              f.write("\n")
-                       #         f.close()  # necessary?
-                        #    else:
-                         #       print(output_str)
-
-    #                        if slurm:
-     #                           all_commands_to_run += command + " &\n"
-      #                          ntasks += 1
-       #                     else:
-        #                        log_filepath = os.path.join(self.preprocessing_path, sub_id, "mri_command_logs.log") if log else None
-         #                       self._run_subprocess(command, log_filepath)
+                            yield sub_id, ses_id, scan_type, bids_name
 
-         #   if slurm:
-          #      job_name = "recon_all" + "_" + datetime.datetime.now().strftime("%m%d%Y_%H%M")  # TODO: FIX NAME !!
-           #     utils.run_command_with_slurm(job_name, self.slurm_logs_path, self.slurm_logs_path, ntasks, all_commands_to_run)
-
-    def _run_subprocess(self, command, log_filepath=False):  # TODO: MOVE TO UTILS, CHANGE NAME OF UTILS MODULE TO ONE BASED AROUND RUNNING COMMANDS.
+    def _run_subprocess(self, command, log_filepath=False, timeout=None):
         """
-        DOC where from
+        Run a command (argv list, or str split with shlex) with backend.utils.commands. Output
+        is appended to log_filepath, or printed if no log_filepath. Return the CommandResult
+        (return code, duration and the tail of the output).
         """
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True)
-        while True:
-            output = process.stdout.readline()
-
-            if output == '' and process.poll() is not None:
-                break
+        if not log_filepath:
+            return commands.run_command(command, timeout=timeout, echo=True)
 
-            if output:
-                output_str = output.strip().decode()
-
-                if log_filepath:
-                    open_type = "w" if not os.path.isfile(log_filepath) else "a"
-                    with open(log_filepath, open_type) as f:
-                        f.write(output_str)
-                        f.write("\n")
-                    f.close()  # necessary?
-                else:
-                    print(output_str)
-        rc = process.poll()
-        return rc
+        with commands.CommandLog(log_filepath) as command_log:
+            return commands.run_command(command, command_log=command_log, timeout=timeout)
 
 # Check Arguments ------------------------------------------------------------------------------------------------------
 
@@ -723,7 +2590,7 @@ class ProjectMaster():
         run_ids = self.process_mixed_list_of_ids(run_ids, "run-")
 
         if scan_types == ["all"]:
-            scan_types = ["func", "anat", "b0", "b1"]  # TODO: move to configs
+            scan_types = list(self.get_scan_types(converter="dcm2niix"))
 
         return sub_ids, ses_ids, run_ids, scan_names, scan_types
 
@@ -837,15 +2704,23 @@ class ProjectMaster():
         return ses_folders
 
 # ----------------------------------------------------------------------------------------------------------------------
-# Utils - Can move these to dedicated module when large enough
+# Command Line
 # ----------------------------------------------------------------------------------------------------------------------
 
-    def process_args(self):
+    def process_args(self, argv=None):
         """
-        Process the flags for run_project.py. See project README.md for details on usage.
-        TODO: can move
+        Process the command line for run_project.py. See project README.md for details on usage.
+
+        Subcommands run a single stage (download, stage, convert, recon) for the selected subjects,
+        sessions, runs and scans, or check (validate) and report on (status) the project. Selectors
+        take the process_mixed_list_of_ids() syntax e.g. -sub_ids 1 4:6 sub-010.
+
+        Without a subcommand the flags (-download_from_hpc, -move_to_preprocessing ...) run the
+        selected stages for every session as before.
+
+        Return the argparse Namespace (args.command is None if no subcommand is given).
         """
-        parser = argparse.ArgumentParser()
+        parser = argparse.ArgumentParser(description="Download, organise and preprocess project MRI scans")
         parser.add_argument("-download_from_hpc", "--download_from_hpc",
                             action="store_true",
                             help="Flag to download raw scans from HPC to the raw scans folder and format for ABL backups")
@@ -863,55 +2738,524 @@ class ProjectMaster():
                             action="store_true",
                             help="Flag to run dcm2niix on all scans")
 
-        args_dict = parser.parse_args()
+        parser.add_argument("-run_qc", "--run_qc",
+                            action="store_true",
+                            help="Flag to compute QC metrics for all converted runs and write the cohort table "
+                                 "once the other stages have run")
+
+        parser.add_argument("-write_bids_metadata", "--write_bids_metadata",
+                            action="store_true",
+                            help="Flag to write the scans tables and custom layout index for all sessions "
+                                 "once the other stages have run")
+
+        parser.add_argument("-scheduler", "--scheduler",
+                            action="store_true",
+                            help="Run the selected stages for all sessions at once with the dependency-aware "
+                                 "scheduler, so downloads, copies and conversions of different sessions overlap")
+
+        parser.add_argument("-watch", "--watch",
+                            action="store_true",
+                            help="Keep running and process new participant log entries and new raw_scans folders "
+                                 "as they appear, for the selected stages (instead of running on cron)")
+
+        parser.add_argument("-dry_run", "--dry_run",
+                            action="store_true",
+                            help="Print all pending work for the selected flags with estimated size and time, "
+                                 "without touching any data")
+
+        selection_parser = argparse.ArgumentParser(add_help=False)
+        for prefix, id_type in [["sub", "Subjects"], ["ses", "Sessions"], ["run", "Runs"]]:
+            selection_parser.add_argument("-{0}_ids".format(prefix), "--{0}_ids".format(prefix),
+                                          nargs="+",
+                                          default=["all"],
+                                          help="{0} to process e.g. {1}-001 2 5:10 (default all)".format(id_type, prefix))
+
+        selection_parser.add_argument("-scan_names", "--scan_names",
+                                      nargs="+",
+                                      default=["all"],
+                                      help="Scan names to process from the *_scan_details in project_configs.py "
+                                           "e.g. mp2rage (default all)")
+
+        selection_parser.add_argument("-scan_types", "--scan_types",
+                                      nargs="+",
+                                      default=["all"],
+                                      choices=list(self.get_scan_types()) + ["all"],
+                                      help="Scan types to process (default all)")
+
+        execution_parser = argparse.ArgumentParser(add_help=False)
+        execution_parser.add_argument("-jobs", "--jobs",
+                                      type=int,
+                                      default=None,
+                                      help="Maximum number of tasks to run at once (default: scheduler_pool_sizes, "
+                                           "num_conversion_workers, num_recon_all_cores in project_configs.py)")
+
+        execution_parser.add_argument("-executor", "--executor",
+                                      choices=["scheduler", "serial", "slurm", "distributed"],
+                                      default="scheduler",
+                                      help="scheduler: run tasks in parallel worker pools (default). serial: one task "
+                                           "at a time. slurm: submit as SLURM job arrays (convert and recon only). "
+                                           "distributed: queue sessions for run_project.py worker on every host")
+
+        execution_parser.add_argument("-local_workers", "--local_workers",
+                                      type=int,
+                                      default=0,
+                                      help="With -executor distributed, also start this many workers on this host")
+
+        execution_parser.add_argument("-dry_run", "--dry_run",  # SUPPRESS so a -dry_run given before the
+                                      action="store_true",       # subcommand is not reset to False
+                                      default=argparse.SUPPRESS,
+                                      help="Print the pending tasks with estimated size and time without running them")
+
+        subparsers = parser.add_subparsers(dest="command", metavar="command")
+
+        for command, help_ in [["download", "Download scans from the HPC to raw_scans"],
+                               ["stage", "Copy runs from raw_scans to preprocessing"],
+                               ["convert", "Convert staged runs with dcm2niix (and consolidate MRS)"],
+                               ["recon", "Run FreeSurfer recon-all on converted anat runs"]]:
+            subparsers.add_parser(command, parents=[selection_parser, execution_parser], help=help_)
+
+        worker_parser = subparsers.add_parser("worker",
+                                              help="Run sessions queued by -executor distributed on this host")
+        worker_parser.add_argument("-idle_exit_seconds", "--idle_exit_seconds",
+                                   type=float,
+                                   default=None,
+                                   help="Stop once the queue has been empty this long (default run until interrupted)")
+        worker_parser.add_argument("-jobs", "--jobs",
+                                   type=int,
+                                   default=None,
+                                   help="Maximum number of tasks to run at once on each worker pool")
+
+        subparsers.add_parser("validate", parents=[selection_parser],
+                              help="Check the participant log, downloads, staged file numbers and scan date order")
+
+        subparsers.add_parser("deidentify", parents=[selection_parser],
+                              help="Rewrite patient identifiers in place in raw_scans and the staged runs "
+                                   "(see docs/logs/deidentify_audit.tsv)")
+
+        qc_parser = subparsers.add_parser("qc", parents=[selection_parser],
+                                          help="Compute QC metrics for converted runs, write docs/qc_metrics.tsv "
+                                               "and print the runs that fail qc_thresholds with suggested flags")
+        qc_parser.add_argument("-overwrite", "--overwrite",
+                               action="store_true",
+                               help="Compute metrics again for runs that already have them")
+        qc_parser.add_argument("-jobs", "--jobs",
+                               type=int,
+                               default=None,
+                               help="Number of runs to check at once (default num_qc_workers in project_configs.py)")
+
+        subparsers.add_parser("bids", parents=[selection_parser],
+                              help="Write scans.tsv and the custom layout index for the converted runs "
+                                   "(only changed files are written)")
+
+        status_parser = subparsers.add_parser("status", parents=[selection_parser],
+                                              help="Print a per-session table of download, staging, conversion "
+                                                   "and recon-all status")
+        status_parser.add_argument("-format", "--format",
+                                   choices=["table", "tsv", "json"],
+                                   default="table",
+                                   help="table (default), tsv (one column per scan type summary) "
+                                        "or json (including every run)")
+        status_parser.add_argument("-output", "--output",
+                                   default=None,
+                                   help="File to write the status to instead of printing")
+
+        return parser.parse_args(argv)
+
+    def run_command_line(self, args):
+        """
+        Run a subcommand parsed by process_args(). Return True on success.
+        """
+        if args.command == "worker":
+            if args.jobs:
+                self._set_max_jobs(args.jobs)
+            self.run_distributed_worker(idle_exit_seconds=args.idle_exit_seconds)
+            return True
+
+        selection = self._get_command_line_selection(args)
+
+        if args.command == "validate":
+            return self.validate_project(**selection)
+
+        if args.command == "status":
+            return self._print_project_status(args.format, args.output, selection)
+
+        if args.command == "deidentify":
+            return self.deidentify_sessions(selection["sub_ids"], selection["ses_ids"])
+
+        if args.command == "qc":
+            return self._print_qc(args, selection)
+
+        if args.command == "bids":
+            summary = self.write_bids_metadata(selection["sub_ids"], selection["ses_ids"])
+            print("bids: {0} files written, {1} sessions re-indexed".format(summary["files_written"],
+                                                                          summary["sessions_indexed"]))
+            return True
+
+        if args.jobs:
+            self._set_max_jobs(args.jobs)
+
+        assert args.executor != "slurm" or args.command in ["convert", "recon"], \
+            "-executor slurm is only supported for convert and recon"
+
+        graph = self.plan_work(download=args.command == "download",
+                               stage=args.command == "stage",
+                               convert=args.command == "convert",
+                               recon=args.command == "recon",
+                               **selection)
+        if args.dry_run:
+            print(graph.format_dry_run())
+            return True
+
+        if not self.is_initialised():
+            self.init_project_directory_tree()
+
+        if args.executor == "slurm":
+            return bool(self._submit_selection_to_slurm(args.command, selection))
+
+        if args.executor == "scheduler":
+            status = self.run_work_graph_with_scheduler(graph)
+        elif args.executor == "distributed":
+            status = self.run_work_graph_distributed(graph, args.local_workers)
+        else:
+            status = self.execute_work_graph(graph)
+
+        num_done = list(status.values()).count("done")
+        print("{0}: {1} of {2} tasks done".format(args.command, num_done, len(status)))
+        for task_id in sorted(task_id for task_id, task_status in status.items() if task_status != "done"):
+            print("    {0}: {1}".format(status[task_id], task_id))
+
+        return num_done == len(status)
+
+    def _get_command_line_selection(self, args):
+        """
+        Expand the selectors to the keyword arguments of plan_work(), None for all.
+        """
+        selection = {}
+        for arg_name, prefix in [["sub_ids", "sub-"], ["ses_ids", "ses-"], ["run_ids", "run-"],
+                                 ["scan_names", None], ["scan_types", None]]:
+            ids = getattr(args, arg_name)
+            if "all" in ids:
+                selection[arg_name] = None
+            elif prefix == "sub-":
+                selection[arg_name] = self.check_and_process_sub_args(ids)
+            elif prefix:
+                selection[arg_name] = self.process_mixed_list_of_ids(ids, prefix)
+            else:
+                selection[arg_name] = ids
+        return selection
+
+    def _print_project_status(self, format_, output_filepath, selection):
+        rows = self.get_project_status(**selection)
+        scan_types = [scan_type for scan_type in self.get_scan_types(collected_only=True)
+                      if selection["scan_types"] is None or scan_type in selection["scan_types"]]
+
+        if format_ == "tsv":
+            status = project_status.format_status_tsv(rows, scan_types)
+        elif format_ == "json":
+            status = project_status.format_status_json(rows)
+        else:
+            status = project_status.format_status_table(rows, scan_types)
+
+        if output_filepath:
+            with open(output_filepath, "w") as file:
+                file.write(status)
+        else:
+            print(status)
+        return True
+
+    def _print_qc(self, args, selection):
+        if args.jobs:
+            self.num_qc_workers = args.jobs
+
+        num_checked, failed, rows = self.run_qc(overwrite=args.overwrite, **selection)
+        print("qc: {0} runs checked ({1} failed), {2} runs in {3}".format(num_checked,
+                                                                        len(failed),
+                                                                        len(rows),
+                                                                        os.path.join(self.docs_path, "qc_metrics.tsv")))
+        for bids_name, error in failed:
+            print("    ERROR: {0}: {1}".format(bids_name, error))
+        for row in rows:
+            if row["reasons"]:
+                print("    {0}: {1}\n        suggested flag for {2} {3}: {4}".format(
+                    row["bids_name"],
+                    ", ".join(row["reasons"]),
+                    row["wbic_id"],
+                    row["ses_id"],
+                    row["suggested_flag"] or "unknown raw run number, check raw_scans"))
+        return not failed
+
+    def _set_max_jobs(self, max_jobs):
+        self.scheduler_pool_sizes = {pool: max_jobs for pool in self.scheduler_pool_sizes}
+        self.num_conversion_workers = max_jobs
+        self.num_recon_all_cores = max_jobs * self.recon_all_threads_per_job
+        self.slurm_max_concurrent_tasks = max_jobs
+
+    def _submit_selection_to_slurm(self, command, selection):
+        """
+        Submit all selected runs for convert / recon as SLURM job arrays. Return list of job ids.
+        """
+        scan_types = selection["scan_types"] or (["all"] if command == "convert" else ["anat"])
+
+        scan_names = selection["scan_names"]
+        if scan_names is None:
+            scan_names = []
+            for scan_type_info in self.get_scan_types(converter="dcm2niix").values():
+                scan_names += scan_type_info.scan_names
+
+        job_args = [selection["sub_ids"] or ["all"],
+                    selection["ses_ids"] or ["all"],
+                    selection["run_ids"] or ["all"],
+                    scan_names,
+                    scan_types]
+
+        if command == "convert":
+            job_ids = self.run_dcm2niix(*job_args, slurm_array=True)
+        else:
+            job_ids = self.run_recon_all(*job_args, slurm_array=True)
+
+        print("{0}: submitted SLURM job ids {1}".format(command, job_ids))
+        return job_ids
+
+    def deidentify_sessions(self, sub_ids=None, ses_ids=None):
+        """
+        De-identify raw_scans and the staged runs of the selected sessions (None for all). An existing
+        raw scans archive (see archive_raw_scans()) still holds the identifiers, so it is rebuilt from
+        the de-identified raw scans. If the raw scans were pruned the archive cannot be rebuilt, this
+        is logged as an error. Return True if every file was read and every archive rebuilt.
+        """
+        all_succeeded = True
+        for __, sub_info, scan_info in self._get_selected_scans(self.get_participant_log(), sub_ids, None, ses_ids):
+            self.init_logging(scan_info["date"],
+                              scan_info["zk_id"])
+
+            zk_id = scan_info["zk_id"]
+            zk_id_base_path = os.path.join(self.raw_scans_path, zk_id)
+            archive_filepath = archive.get_archive_filepath(zk_id_base_path, zk_id)
+
+            if os.path.isdir(os.path.join(zk_id_base_path, zk_id)):
+                all_succeeded &= self.deidentify_raw_scans(zk_id, sub_info["sub_id"])
+
+                if os.path.isfile(archive_filepath):  # also if some files were not read, the rest are de-identified
+                    all_succeeded &= self._rebuild_raw_scans_archive(zk_id)
+
+            elif os.path.isfile(archive_filepath):
+                self.log("De-identify raw scans",
+                         "ERROR: {0} may still hold patient identifiers, the raw scans were pruned so it cannot "
+                         "be rebuilt. Extract it, run deidentify again and archive it again".format(archive_filepath))
+                all_succeeded = False
+
+            all_succeeded &= self.deidentify_staged_runs(sub_info["sub_id"], scan_info["ses_id"])
+
+        return all_succeeded
+
+    def validate_project(self, sub_ids=None, ses_ids=None, run_ids=None, scan_names=None, scan_types=None):
+        """
+        Check the participant log formatting, every selected downloaded session (_test_download(),
+        or its archive against the manifest if the raw scans were pruned), the number of files in
+        every selected staged run against num_expected_*_files and the sub / ses scan date order of
+        the selected sessions. Print a report and return True if all checks passed.
+        """
+        participant_log = self.get_participant_log()  # asserts if not formatted correctly
+        report = ["participant log: OK"]
+        all_passed = True
+
+        for wbic_id, sub_info, scan_info in self._get_selected_scans(participant_log, sub_ids, None, ses_ids):
+            session_name = "{0} {1} ({2})".format(sub_info["sub_id"], scan_info["ses_id"], scan_info["zk_id"])
+
+            if not self.scan_already_downloaded(scan_info["zk_id"]):
+                report.append("{0}: not downloaded".format(session_name))
+                continue
+
+            if self._raw_scans_are_pruned(scan_info["zk_id"]):
+                archive_errors = self._test_archive(scan_info["zk_id"])
+                if archive_errors:
+                    report.append("{0}: FAILED archive check of pruned raw scans:\n    {1}".format(
+                        session_name, "\n    ".join(archive_errors)))
+                    all_passed = False
+            else:
+                download_failed, __ = self._test_download(scan_info["zk_id"])
+                if download_failed:
+                    report.append("{0}: FAILED download check, some scan dirs have no {1}".format(session_name,
+                                                                                               self.scanner_format))
+                    all_passed = False
+
+            for scan_type, scan_type_info in self.get_scan_types().items():
+
+                if scan_types is not None and scan_type not in scan_types:
+                    continue
+
+                num_expected_files = scan_type_info.num_expected_files
+
+                for run in self._get_staged_runs(sub_info["sub_id"], scan_info["ses_id"], scan_type):
+
+                    if (run_ids is not None and run["run_id"] not in run_ids) or \
+                            (scan_names is not None and run["scan_name"] not in scan_names):
+                        continue
+
+                    num_files = len(os.listdir(run["destination_path"]))
+                    if num_expected_files and num_files != num_expected_files:
+                        report.append("{0}: FAILED {1} has {2} files but expecting {3}".format(session_name,
+                                                                                               run["bids_name"],
+                                                                                               num_files,
+                                                                                               num_expected_files))
+                        all_passed = False
+
+        order_error_log = self._test_project_scan_and_ses_ids_match_date_order(sub_ids, ses_ids)
+        if order_error_log:
+            report.append(order_error_log.strip())
+            all_passed = False
+        else:
+            report.append("sub / ses date order: OK")
+
+        report.append("All checks passed" if all_passed else "Some checks FAILED")
+        print("\n".join(report))
+        return all_passed
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Utils - Can move these to dedicated module when large enough
+# ----------------------------------------------------------------------------------------------------------------------
+
+    def get_scan_types(self, collected_only=False, **settings):
+        """
+        Return OrderedDict {scan_type: ScanType} of the project (backend/utils/scan_types.py), built
+        once from the *_scan_details, num_expected_*_files and scan_type_settings of the config.
+
+        collected_only:  only types with scan details
+        settings:        only types with these settings e.g. converter="dcm2niix", qc=True (any qc)
+        """
+        if self._scan_types is None:
+            self._scan_types = scan_type_registry.build_registry(self)
 
-        args = [v for __, v in sorted(vars(args_dict).items())]  # sort dict alphabetically, be careful with order if adding new flags
-        download_from_hpc, move_to_preprocessing, run_dcm2niix, run_recon_all = args  # could * expand, but better to be explicit about output order
+        if not collected_only and not settings:
+            return self._scan_types
 
-        return download_from_hpc, move_to_preprocessing, run_dcm2niix, run_recon_all
+        selected = collections.OrderedDict()
+        for name, scan_type in self._scan_types.items():
+            if collected_only and not scan_type.is_collected():
+                continue
+            if any(not getattr(scan_type, key) if value is True else getattr(scan_type, key) != value
+                   for key, value in settings.items()):
+                continue
+            selected[name] = scan_type
+        return selected
 
+    def _get_raw_series_names(self, zk_id):
+        """
+        Sorted names of the raw series dirs in raw_scans/zk_id/zk_id. Listed again only when
+        the dir changes (its mtime), so the search_str of every scan name is matched against
+        one listing.
+        """
+        raw_series_path = os.path.join(self.raw_scans_path, zk_id, zk_id)
+        try:
+            mtime_ns = os.stat(raw_series_path).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            return []
 
-    def _get_scan_details_and_expeced_num(self, scan_type):
-        scans_infos = {"mrs": [self.mrs_scan_details, self.num_expected_mrs_files],
-                       "func": [self.func_scan_details, self.num_expected_func_files],
-                       "anat": [self.anat_scan_details, self.num_expected_anat_files],
-                       "mpm": [self.mpm_scan_details, self.num_expected_anat_files],
-                       "b0": [self.b0_scan_details, self.num_expected_b0_files],
-                       "b1": [self.b1_scan_details, self.num_expected_b1_files],
-        }
-        scan_details, expected_num_files = scans_infos[scan_type]
+        cached = self._raw_series_names.get(raw_series_path)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
 
-        return scan_details, expected_num_files
+        names = sorted(os.listdir(raw_series_path))
+        if time.time() - mtime_ns / 1e9 > 2:  # a dir changed in the last mtime tick may still change unseen
+            self._raw_series_names[raw_series_path] = (mtime_ns, names)
+        return names
 
-    def _copy_dir_contents(self, source_path, destination_path, log=True):
+    def _copy_dir_contents(self, source_path, destination_path, log=True, pseudonym=None):
         """
         Call linux os directly to copy files and log the process.
 
         Could not get shutil.copy / copytree to work, "operation not permitted".
+
+        If pseudonym is given the files are de-identified as they are copied instead
+        (see _deidentify_files()). This fails unless every file was de-identified to its
+        destination, as files that could not be read are not copied.
         """
         self._mkdir(destination_path)
         source_path_contents = source_path + "/*"
-        subprocess.run(" ".join(["cp", source_path_contents, destination_path]),
-                       shell=True)
+
+        if pseudonym is not None:
+            jobs = [[filepath, os.path.join(destination_path, os.path.basename(filepath))]
+                    for filepath in sorted(glob.glob(source_path_contents)) if os.path.isfile(filepath)]
+            results = self._deidentify_files(jobs, pseudonym)
+            if log:
+                self.log(None,
+                         "copied and de-identified from: {0} \ncopied to: {1}".format(source_path_contents,
+                                                                                    destination_path))
+            return len(results) == len(jobs) and \
+                all(result.succeeded() and [result.source, result.destination] == job and
+                    os.path.isfile(result.destination) for result, job in zip(results, jobs))
+
+        result = commands.run_command(["cp"] + sorted(glob.glob(source_path_contents)) + [destination_path])
 
         if log:
             self.log(None,
                      "copied from: {0} \ncopied to: {1}".format(source_path_contents,
                                                                 destination_path))
+            self._log_failed_command(result)
+
+        return result.succeeded()
+
+    def _deidentify_files(self, jobs, pseudonym):
+        """
+        De-identify jobs (list of (source, destination)) across num_deidentify_workers processes,
+        adding every file to docs/logs/deidentify_audit.tsv. Files that could not be read are
+        logged and not written: a copy leaves no destination file and a file de-identified in
+        place is left unchanged, with its identifiers. Return list of deidentify.DeidentifyResult.
+        """
+        results = deidentify.deidentify_files(jobs,
+                                              pseudonym,
+                                              num_workers=self.num_deidentify_workers,
+                                              audit_filepath=os.path.join(self.logs_path, "deidentify_audit.tsv"))
+
+        failed = [result for result in results if not result.succeeded()]
+        self.log(None, "De-identified {0} of {1} files ({2} unchanged, {3} not read)".format(
+            sum(1 for result in results if result.status == "deidentified"),
+            len(results),
+            sum(1 for result in results if result.status == "unchanged"),
+            len(failed)))
+        for result in failed:
+            self.log(None, "WARNING: {0} was not de-identified: {1}".format(result.source, result.message))
+
+        return results
 
     def _move(self, dir_to_move, destination_path, move_contents_only=False):
         """
         Call linux os directly to move files and log the results.
         """
-        if move_contents_only:
-            dir_to_move = dir_to_move + "/*"
+        paths_to_move = sorted(glob.glob(dir_to_move + "/*")) if move_contents_only else [dir_to_move]
 
-        subprocess.run([" ".join(["mv", dir_to_move, destination_path])],
-                       shell=True)
+        result = commands.run_command(["mv"] + paths_to_move + [destination_path])
 
         self.log(None,
-                 "moved from: " + dir_to_move +
+                 "moved from: " + (dir_to_move + "/*" if move_contents_only else dir_to_move) +
                  "\nmoved to: " + destination_path)
+        self._log_failed_command(result)
+
+        return result.succeeded()
+
+    def _log_failed_command(self, result):
+        if not result.succeeded():
+            self.log(None,
+                     "ERROR: command failed with return code {0} after {1:.1f} s: {2}\n{3}".format(result.returncode,
+                                                                                                result.duration,
+                                                                                                " ".join(result.argv[:3]) + " ...",
+                                                                                                "\n".join(result.output_tail)))
+
+    def _get_dir_size_bytes(self, path):
+        """
+        Total size of all files in a directory tree (os.scandir is much faster than os.walk
+        + os.path.getsize as stat is cached on the entry)
+        """
+        total_bytes = 0
+        dirs_to_scan = [path]
+        while dirs_to_scan:
+            with os.scandir(dirs_to_scan.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs_to_scan.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        total_bytes += entry.stat(follow_symlinks=False).st_size
+        return total_bytes
 
     def _mkdir(self, dir):
         if not os.path.isdir(dir):
@@ -941,6 +3285,36 @@ class ProjectMaster():
 
         return scan_datetime
 
+    def _get_sessions_cache(self):
+        """
+        Return the sub / ses structure of preprocessing with the scan datetime of every session
+        (see backend/utils/sessions_cache.py), brought up to date with the dir and info file mtimes.
+        The cache is saved to docs/ so the next run only re-reads what changed.
+        """
+        cache_filepath = os.path.join(self.docs_path, "preprocessing_sessions_cache.json")
+
+        if self._sessions_cache is None:
+            self._sessions_cache = sessions_cache.load_cache(cache_filepath)
+
+        changed = sessions_cache.update_cache(self._sessions_cache,
+                                              self.preprocessing_path,
+                                              self._extract_date_time_from_sub_info_file)
+        if changed and os.path.isdir(self.docs_path):
+            sessions_cache.save_cache(cache_filepath, self._sessions_cache)
+
+        return self._sessions_cache
+
+    def _get_session_datetime(self, cache, sub_id, ses_id):
+        """
+        Scan datetime of the session from the sessions cache, asserting (as _glob_one_result()) if the
+        session has no ses-XXX_info.txt
+        """
+        scan_datetime = sessions_cache.get_session_datetime(cache, sub_id, ses_id)
+        if scan_datetime is None:
+            info_path = self._glob_one_result(os.path.join(self.preprocessing_path, sub_id, ses_id, ses_id + "_info.txt"))
+            scan_datetime = self._extract_date_time_from_sub_info_file(info_path)
+        return scan_datetime
+
     def _glob_one_result(self, search_str):
         """
         Return glob checked for only one result - log and error if less or more.
@@ -1012,15 +3386,19 @@ class ProjectMaster():
                                                                                                                              zk_id)
 
                 if "flags" in scan_info:
-                    for flag in scan_info["flags"]:
-                        ignore_,  scan_name, run_to_ignore = flag.split("_")
-
-                        assert ignore_ == "ignore", "flags: 'ignore' is not spelled correctly for wbic_id: {0}, zk_id {1}".format(wbic_id,
-                                                                                                                     zk_id)
-                        assert scan_name in ["mrs", "func", "anat", "mpm", "b0", "b1"], "flags; scan type is not correct for wbic_id: {0}, zk_id {1}".format(wbic_id,
-                                                                                                                     zk_id)
-                        assert run_to_ignore.isnumeric(), "flags: run to ignore is not an interger for wbic_id: {0}, zk_id {1}".format(wbic_id,
-                                                                                                                     zk_id)
+                    try:
+                        exclusion_table = self._get_flag_exclusion_table(scan_info)
+                    except flags.FlagError as error:
+                        raise AssertionError("flags: {0} for wbic_id: {1}, zk_id {2}".format(error, wbic_id, zk_id))
+
+                    for scan_type, scan_type_table in exclusion_table.items():
+                        scan_details = self.get_scan_types()[scan_type].scan_details
+                        for scan_name in scan_type_table:
+                            assert scan_name is None or scan_name in (scan_details or {}), \
+                                "flags: scan name {0} is not in {1}_scan_details for wbic_id: {2}, zk_id {3}".format(scan_name,
+                                                                                                                 scan_type,
+                                                                                                                 wbic_id,
+                                                                                                                 zk_id)
 
     def _test_no_scan_id_are_duplicate(self,participant_log):
         """
@@ -1084,6 +3462,26 @@ class ProjectMaster():
 
         return fail_flag, log_
 
+    def _raw_scans_are_pruned(self, zk_id):
+        """
+        The second level zk_id dir was removed by prune_archived_raw_scans() and only the archive is left
+        """
+        zk_id_base_path = os.path.join(self.raw_scans_path, zk_id)
+        return not os.path.isdir(os.path.join(zk_id_base_path, zk_id)) and \
+            os.path.isfile(archive.get_archive_filepath(zk_id_base_path, zk_id))
+
+    def _test_archive(self, zk_id):
+        """
+        Check the archive of zk_id against its manifest (see archive_raw_scans()). Return list of errors.
+        """
+        zk_id_base_path = os.path.join(self.raw_scans_path, zk_id)
+        manifest_filepath = archive.get_manifest_filepath(zk_id_base_path, zk_id)
+        if not os.path.isfile(manifest_filepath):
+            return ["no manifest {0}, the archive was not verified".format(manifest_filepath)]
+
+        return archive.verify_archive_against_manifest(archive.get_archive_filepath(zk_id_base_path, zk_id),
+                                                       archive.load_manifest(manifest_filepath))
+
     def _test_and_log_expected_file_number(self, destination_path, num_expected_files):
         """
 
@@ -1102,23 +3500,19 @@ class ProjectMaster():
                                   "\n"])
                          )
 
-    def _test_all_subs_are_in_correct_order(self):   # Run a motion correction in ANFI / SPM. Meet with Avraam
+    def _test_all_subs_are_in_correct_order(self, cache=None):   # Run a motion correction in ANFI / SPM. Meet with Avraam
         """
         Iterate through all subjects in order and check the date / time of the first scan
         is after that of the preceding subject.
         """
-        all_subs = self.get_all_subs_and_ses_in_preprocessing()
+        cache = cache or self._get_sessions_cache()
+        all_subs = sessions_cache.get_subs_and_ses(cache)
         all_sub_ids = sorted(all_subs.keys())
 
         all_sub_datetimes = []
         for sub_id in all_sub_ids:
 
-            first_ses_info_path = self._glob_one_result(
-                                                       os.path.join(self.preprocessing_path,
-                                                                    sub_id, "ses-001", "ses-001_info.txt"))
-
-            scan_datetime = self._extract_date_time_from_sub_info_file(
-                                                                      first_ses_info_path)
+            scan_datetime = self._get_session_datetime(cache, sub_id, "ses-001")
 
             all_sub_datetimes.append(scan_datetime)
 
@@ -1127,9 +3521,10 @@ class ProjectMaster():
 
         return bad_subs
 
-    def _test_all_sessions_are_in_correct_order(self):
+    def _test_all_sessions_are_in_correct_order(self, cache=None):
 
-        all_subs = self.get_all_subs_and_ses_in_preprocessing()
+        cache = cache or self._get_sessions_cache()
+        all_subs = sessions_cache.get_subs_and_ses(cache)
         all_sub_ids = sorted(all_subs.keys())
 
         bad_subs = []
@@ -1139,11 +3534,8 @@ class ProjectMaster():
             all_ses_ids = sorted(all_subs[sub_id])
             for ses_id in all_ses_ids:
 
-                ses_info_path = self._glob_one_result(
-                                                      os.path.join(self.preprocessing_path,
-                                                                   sub_id, ses_id, ses_id + "_info.txt"))
                 ses_datetimes.append(
-                                     self._extract_date_time_from_sub_info_file(ses_info_path))
+                                     self._get_session_datetime(cache, sub_id, ses_id))
 
             bad_ses = self._test_datetimes_are_in_order(ses_datetimes,
                                                         all_ses_ids)
@@ -1166,18 +3558,26 @@ class ProjectMaster():
 
         return bad_subs
 
-    def _test_project_scan_and_ses_ids_match_date_order(self):
+    def _test_project_scan_and_ses_ids_match_date_order(self, sub_ids=None, ses_ids=None):
         """
-
+        The sessions cache is brought up to date once and shared by both tests. Only errors of
+        sub_ids / ses_ids are reported (None for all).
         """
-        sub_ids_out_of_datetime_order = self._test_all_subs_are_in_correct_order()
+        cache = self._get_sessions_cache()
+
+        sub_ids_out_of_datetime_order = [sub_id for sub_id in self._test_all_subs_are_in_correct_order(cache)
+                                         if sub_ids is None or sub_id in sub_ids]
 
         log_ = ""
         if any(sub_ids_out_of_datetime_order):
             log_ += "ERROR: The following sub_ids do not " \
                     "match scan times {0}\n".format(sub_ids_out_of_datetime_order)
 
-        subs_with_ses_ids_out_of_order = self._test_all_sessions_are_in_correct_order()
+        subs_with_ses_ids_out_of_order = []
+        for sub_id, bad_ses in self._test_all_sessions_are_in_correct_order(cache):
+            bad_ses = [ses_id for ses_id in bad_ses if ses_ids is None or ses_id in ses_ids]
+            if bad_ses and (sub_ids is None or sub_id in sub_ids):
+                subs_with_ses_ids_out_of_order.append([sub_id, bad_ses])
 
         if any(subs_with_ses_ids_out_of_order):
             log_ += "ERROR: The following sessions are not in " \
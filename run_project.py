@@ -1,14 +1,49 @@
+import atexit
 from project_configs import Project
 
 # Setup Project and arguments ------------------------------------------------------------------------------------------
 
 project = Project()
+atexit.register(project.close_ssh_pool)  # also on the early exits below
 
-download_from_hpc, move_to_preprocessing, run_dcm2niix, run_recon_all = project.process_args()
+args = project.process_args()
+
+if args.command:  # e.g. run_project.py convert -sub_ids 1:3 -scan_types anat, see README.md
+    raise SystemExit(0 if project.run_command_line(args) else 1)
+
+download_from_hpc = args.download_from_hpc
+move_to_preprocessing = args.move_to_preprocessing
+run_dcm2niix = args.run_dcm2niix
+run_recon_all = args.run_recon_all
+
+if args.dry_run or args.scheduler:
+    work_graph = project.plan_work(download=download_from_hpc,
+                                   stage=move_to_preprocessing,
+                                   convert=run_dcm2niix,
+                                   recon=run_recon_all)
+if args.dry_run:
+    print(work_graph.format_dry_run())
+    raise SystemExit
 
 if not project.is_initialised():
     project.init_project_directory_tree()
 
+if args.watch:
+    project.watch_project(download=download_from_hpc,
+                          stage=move_to_preprocessing,
+                          convert=run_dcm2niix,
+                          recon=run_recon_all)
+    raise SystemExit
+
+if args.scheduler:
+    project.run_work_graph_with_scheduler(work_graph)
+    if args.run_qc:
+        project.run_qc()
+    if args.write_bids_metadata:
+        project.write_bids_metadata()
+    project.run_scan_sub_order_tests()
+    raise SystemExit
+
 # Iterate through all scans for all participants, skipping if data is already downloaded / copied
 
 participant_log = project.get_participant_log()
@@ -23,9 +58,6 @@ for wbic_id in sorted(participant_log.keys()):  # TODO: this is sorted on WBIC I
 
 # Run based on selected options ----------------------------------------------------------------------------------------
 
-        if sub_info["sub_id"] != "sub-002" and scan_info["ses_id"] != "ses-002":
-            continue
-
         if download_from_hpc:
             if not project.download_scans_from_hpc(wbic_id,
                                                    scan_info):
@@ -35,10 +67,16 @@ for wbic_id in sorted(participant_log.keys()):  # TODO: this is sorted on WBIC I
             project.move_raw_to_preprocessing(wbic_id, sub_info, scan_info)
 
         if run_dcm2niix:
-            project.run_dcm2niix(sub_ids=[sub_info["sub_id"]],
-                                 ses_ids=[scan_info["ses_id"]],
-                                 run_ids=["all"],
-                                 scan_names=["mp2rage"])
+            project.convert_session(sub_info["sub_id"], scan_info["ses_id"])
+
+        if run_recon_all:
+            project.recon_session(sub_info["sub_id"], scan_info["ses_id"])
+
+if args.run_qc:
+    project.run_qc()
+
+if args.write_bids_metadata:
+    project.write_bids_metadata()
 
 # Run Tests ------------------------------------------------------------------------------------------------------------
 
@@ -0,0 +1,69 @@
+"""
+Run several projects in one process within one resource budget (e.g. nightly ingestion
+for every study). Each config file is a copy of project_configs.py for one study. The
+selected stages of all projects run on one scheduler with shared worker pools, SSH
+connections and disk space admission, see backend/utils/multi_project.py
+
+Run from the project directory:
+    python3 run_projects.py configs/gp_7t.py configs/vision_7t.py -download_from_hpc -move_to_preprocessing -run_dcm2niix
+    python3 run_projects.py configs/*.py -move_to_preprocessing -dry_run
+"""
+import argparse
+from backend.utils import multi_project
+
+
+def process_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the selected stages for several projects at once")
+    parser.add_argument("config_filepaths",
+                        nargs="+",
+                        help="Project config files, each a copy of project_configs.py")
+
+    for flag, help_ in [["download_from_hpc", "Download raw scans from the HPC"],
+                        ["move_to_preprocessing", "Copy runs from raw scans to preprocessing"],
+                        ["run_dcm2niix", "Convert runs with dcm2niix"],
+                        ["run_recon_all", "Run recon-all on anatomical runs"],
+                        ["run_qc", "Compute QC metrics for every project once the other stages have run"],
+                        ["write_bids_metadata", "Write the scans tables and layout index for every project once the other "
+                                                "stages have run"],
+                        ["dry_run", "Print the pending work of all projects without touching any data"]]:
+        parser.add_argument("-" + flag, "--" + flag,
+                            action="store_true",
+                            help=help_)
+
+    parser.add_argument("-jobs", "--jobs",
+                        type=int,
+                        default=None,
+                        help="Maximum number of tasks to run at once on each worker pool, shared by all projects "
+                             "(default: scheduler_pool_sizes of the first project)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+
+    args = process_args()
+    projects = multi_project.load_projects(args.config_filepaths)
+
+    combined_graph = multi_project.plan_projects(projects,
+                                                 download=args.download_from_hpc,
+                                                 stage=args.move_to_preprocessing,
+                                                 convert=args.run_dcm2niix,
+                                                 recon=args.run_recon_all)
+    if args.dry_run:
+        print(combined_graph.format_dry_run())
+        raise SystemExit
+
+    status = multi_project.run_projects(projects, combined_graph, args.jobs)
+
+    for name, project in projects.items():
+        if args.run_qc:
+            project.run_qc()
+        if args.write_bids_metadata:
+            project.write_bids_metadata()
+        project.run_scan_sub_order_tests()
+
+        task_ids = [task_id for task_id in status if task_id.startswith(name + "/")]
+        print("{0}: {1} of {2} tasks done".format(name,
+                                                 sum(status[task_id] == "done" for task_id in task_ids),
+                                                 len(task_ids)))
+
+    raise SystemExit(0 if all(task_status == "done" for task_status in status.values()) else 1)
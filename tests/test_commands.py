@@ -0,0 +1,15 @@
+import time
+from backend.utils import commands
+
+
+def test_timeout_kills_child_processes_holding_the_pipes():
+    start_time = time.monotonic()
+    result = commands.run_command(["sh", "-c", "sleep 30 | cat"], timeout=1)
+    assert result.timed_out and not result.succeeded()
+    assert time.monotonic() - start_time < 10
+
+
+def test_output_tail():
+    result = commands.run_command(["sh", "-c", "echo out; echo err >&2"])
+    assert result.succeeded()
+    assert sorted(result.output_tail) == ["[stderr] err", "out"]
@@ -0,0 +1,64 @@
+import pytest
+from backend.utils import flags
+
+SCAN_TYPES = ["mrs", "anat", "func", "mpm", "b0", "b1"]
+
+
+def test_parse_runs():
+    assert flags.parse_runs("2") == {2}
+    assert flags.parse_runs("002") == {2}
+    assert flags.parse_runs("1-3") == {1, 2, 3}
+    assert flags.parse_runs("1,4-5") == {1, 4, 5}
+    assert flags.parse_runs("3-3") == {3}
+
+
+@pytest.mark.parametrize("runs_str", ["", "a", "0", "3-1", "1-", "-2", "1,,2", "1-b"])
+def test_parse_runs_rejects_invalid(runs_str):
+    with pytest.raises(flags.FlagError):
+        flags.parse_runs(runs_str)
+
+
+def test_parse_flag_scan_type():
+    assert flags.parse_flag("ignore_func_2", SCAN_TYPES) == ("func", None, {2})
+    assert flags.parse_flag("ignore_b1_1-2", SCAN_TYPES) == ("b1", None, {1, 2})
+
+
+def test_parse_flag_scan_name_with_underscores():
+    assert flags.parse_flag("ignore_func-fleet_mb_1-3", SCAN_TYPES) == ("func", "fleet_mb", {1, 2, 3})
+    assert flags.parse_flag("ignore_func-fleet_sbref_inv_1,4", SCAN_TYPES) == ("func", "fleet_sbref_inv", {1, 4})
+
+
+@pytest.mark.parametrize("flag", ["func_2", "ignore_dwi_1", "ignore_func", "ignore_func_x", "ignore_b2_1", None])
+def test_parse_flag_rejects_invalid(flag):
+    with pytest.raises(flags.FlagError):
+        flags.parse_flag(flag, SCAN_TYPES)
+
+
+def test_run_is_excluded():
+    table = flags.get_exclusion_table(["ignore_func_2", "ignore_func-fleet_mb_3-4", "ignore_anat_1"], SCAN_TYPES)
+
+    assert flags.run_is_excluded(table, "func", "fleet_mb", 2)       # all func scan names
+    assert flags.run_is_excluded(table, "func", "fleet_sbref", 2)
+    assert flags.run_is_excluded(table, "func", "fleet_mb", 4)       # only fleet_mb
+    assert not flags.run_is_excluded(table, "func", "fleet_sbref", 4)
+    assert not flags.run_is_excluded(table, "func", "fleet_mb", 1)
+    assert flags.run_is_excluded(table, "anat", "mp2rage", 1)
+    assert not flags.run_is_excluded(table, "mrs", "slaser", 1)      # no flags for the type
+
+
+def test_b1_is_not_matched_by_other_flags():
+    # the old substring test ("b1" in flag) matched these to the b1 scans
+    table = flags.get_exclusion_table(["ignore_func-fleet_b1_1", "ignore_b0_1", "ignore_anat-b1map_2"], SCAN_TYPES)
+    assert not flags.run_is_excluded(table, "b1", "b1map", 1)
+    assert not flags.run_is_excluded(table, "b1", "b1map", 2)
+    assert flags.run_is_excluded(table, "func", "fleet_b1", 1)
+
+    table = flags.get_exclusion_table(["ignore_b1_2"], SCAN_TYPES)
+    assert flags.run_is_excluded(table, "b1", "b1map", 2)
+    assert not flags.run_is_excluded(table, "b0", "b0map", 2)
+    assert not flags.run_is_excluded(table, "b1", "b1map", 1)
+
+
+def test_exclusion_table_merges_runs_of_repeated_flags():
+    table = flags.get_exclusion_table(["ignore_func_1", "ignore_func_3-4"], SCAN_TYPES)
+    assert table == {"func": {None: frozenset({1, 3, 4})}}
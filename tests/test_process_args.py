@@ -0,0 +1,23 @@
+from project_master import ProjectMaster
+
+
+def test_dry_run_flag_does_not_download():
+    args = ProjectMaster().process_args(["-dry_run"])
+    assert args.dry_run
+    assert not args.download_from_hpc
+    assert args.command is None
+
+
+def test_stage_flags_are_parsed_by_name():
+    args = ProjectMaster().process_args(["-download_from_hpc", "-run_dcm2niix"])
+    assert args.download_from_hpc and args.run_dcm2niix
+    assert not any([args.dry_run, args.move_to_preprocessing, args.run_recon_all, args.scheduler, args.watch])
+
+
+def test_dry_run_before_or_after_subcommand():
+    for argv in [["-dry_run", "stage", "-sub_ids", "1"], ["stage", "-sub_ids", "1", "-dry_run"]]:
+        args = ProjectMaster().process_args(argv)
+        assert args.command == "stage"
+        assert args.dry_run, argv
+
+    assert not ProjectMaster().process_args(["stage"]).dry_run